@@ -1,71 +1,182 @@
 import cPickle as pickle
+import hmac
+import math
+import time
 
-from eventlet import monkey_patch
-from flask import Flask, json, jsonify, render_template
-from flask_socketio import SocketIO, emit
+from argparse import ArgumentParser
+from collections import namedtuple
+from datetime import datetime
 
+from eventlet import monkey_patch, spawn
+from flask import Flask, Response, abort, json, jsonify, render_template, \
+    request
+from flask_socketio import SocketIO, join_room, leave_room
+
+import API_KEYS
 from API_KEYS import mapbox_key
-from static import Edge, PrevStops, Segment, Stop, StopGraph, StopID  # noqa: F401
+from static import (  # noqa: F401
+    Edge, PrevStops, ScheduleIndex, Segment, Stop, StopGraph, StopID,
+    StopSearch, Timetable)
 
+import arrivals
+import broadcaster
+import bus
+import datasets
 import feed
+import headways
+import history
+import metrics
+import profiler
+import raptor
+import replay
+import router
+import travel_times
+import workers
 
 monkey_patch()
 
-JSON_DIR = "static/json/"
-PICKLE_DIR = ".cache/"
+# Key required by admin routes; admin routes are disabled if it is not set.
+ADMIN_KEY = getattr(API_KEYS, "admin_key", None)
 
 app = Flask(__name__)
 socketio = SocketIO(app)
-feed_event = None
-with open(PICKLE_DIR + "graph.pkl", "rb") as graph_f, \
-        open(PICKLE_DIR + "prev_stops.pkl", "rb") as prev_stops_f, \
-        open(JSON_DIR + "shapes.json", "r") as shapes_f, \
-        open(JSON_DIR + "stops.json", "r") as stops_f:
-    graph = pickle.load(graph_f)
-    prev_stops = pickle.load(prev_stops_f)
-    shapes = json.load(shapes_f)
-    stops = json.load(stops_f)
-
-demos = [
-    [
-        {
-            "path": [[-73.96411, 40.807722], [-73.958372, 40.815581]],
-            "progress": 0.5,
-            "remaining_time": 10
-        },
-        {
-            "path": graph.get_path("118", "119", shapes),
-            "progress": 0.3,
-            "remaining_time": 15
-        }
-    ],
-    [
-        {
-            "path": [[-73.96411, 40.807722], [-73.959874, 40.77362]],
-            "progress": 0.5,
-            "remaining_time": 10
-        },
-        {
-            "path": [[-73.958372, 40.815581], [-73.987691, 40.755477]],
-            "progress": 0.3,
-            "remaining_time": 25
-        },
-    ],
-    [
-        {
-            "path": [[-73.958372, 40.815581], [-73.987691, 40.755477]],
-            "progress": 0.3,
-            "remaining_time": 25
-        },
-        {
-            "path": [[-73.992629, 40.730328], [-73.989951, 40.734673]],
-            "progress": 0.3,
-            "remaining_time": 15
-        }
-    ]
-]
+# Sends each tick to clients as the 'feed' event, skipping ticks for clients
+# that have yet to acknowledge the previous one.
+feed_broadcaster = broadcaster.Broadcaster(socketio, 'feed')
+active_profiler = None
+# Written by static.py to the pickle directory of the dataset
+VERSION_FILE = "version"
+# UNIX socket of the message bus in the pickle directory of the dataset
+BUS_FILE = "bus.sock"
+# Seconds between checks for a new version of the static data
+STATIC_POLL_INTERVAL = 10
+# Number of arrivals returned per station by default, and at most
+DEFAULT_ARRIVALS = 10
+MAX_ARRIVALS = 50
+# Bounding boxes of the vehicles endpoint are widened to multiples of this
+# many degrees (about a kilometer), so that nearby map views share cached
+# responses, of which at most MAX_VEHICLES_RESPONSES are cached per tick
+BBOX_DEGREES = 0.01
+MAX_VEHICLES_RESPONSES = 256
+# Number of stations returned per search by default, and at most
+DEFAULT_SEARCH_RESULTS = 10
+MAX_SEARCH_RESULTS = 50
+# Seconds between feeds, which is how long responses derived from a tick
+# may be cached
+poll_interval = feed.POLL_INTERVAL
+# Number of feed intervals without a live tick after which scheduled
+# positions are broadcast instead (see schedule_timer)
+STALE_FEED_INTERVALS = 3
+# Longest window of history that may be queried or played back at once
+MAX_HISTORY_SECONDS = 24 * 3600
+
+StaticData = namedtuple('StaticData', ['version', 'graph', 'prev_stops',
+                                       'shapes', 'stops', 'schedule',
+                                       'search', 'timetable'])
+
+
+def get_static_version():
+    """ Returns the version of the static data written by static.py, or None
+    if there is no version stamp.
+    """
+    try:
+        with open(feed.dataset.pickle_dir + VERSION_FILE, "r") as version_f:
+            return version_f.read().strip()
+    except IOError:
+        return None
+
+
+def load_static_data(pause=None):
+    """ Returns the static data of the dataset as of the current version.
 
-# _t_hash = feed.train_id_hash()
+    Arguments
+    ---------
+    pause: function
+        If given, called after each file is loaded
+    """
+    version = get_static_version()
+    # Station IDs and the time zone are read from files of the same version
+    feed.dataset.clear_cache()
+    pickle_dir = feed.dataset.pickle_dir
+    json_dir = feed.dataset.json_dir
+    files = {
+        "graph": (pickle_dir + "graph.pkl", pickle.load),
+        "prev_stops": (pickle_dir + "prev_stops.pkl", pickle.load),
+        "shapes": (json_dir + "shapes.json", json.load),
+        "stops": (json_dir + "stops.json", json.load),
+        "schedule": (pickle_dir + "schedule.pkl", pickle.load),
+        "search": (pickle_dir + "search.pkl", pickle.load),
+        "timetable": (pickle_dir + "timetable.pkl", pickle.load)
+    }
+
+    fields = {"version": version}
+    for field, (path, load) in files.iteritems():
+        with open(path, "rb") as static_f:
+            fields[field] = load(static_f)
+        if pause is not None:
+            pause()
+
+    return StaticData(**fields)
+
+
+# All static data is swapped at once by reassigning this reference; anything
+# that uses the static data (such as a broadcast in progress) should hold on
+# to the reference it started with, so that it never mixes two versions. It
+# is loaded once the dataset is known (see __main__).
+static_data = None
+current_tick = {"timestamp": None, "vehicles": []}
+# Time the latest live tick was received
+last_feed_time = None
+# Predicted arrivals of the latest tick, and serialized responses of the
+# arrivals endpoint, which are cleared on every tick.
+arrival_index = arrivals.ArrivalIndex()
+arrivals_cache = {}
+# Timestamp and predictions of the latest live tick, and the delays of its
+# trips as of a version of the static data (see get_trip_delays), which are
+# computed when first needed to plan a journey.
+live_trips = None
+trip_delays = (None, None)
+# Time the latest tick was broadcast; the subway cars of the latest tick,
+# each serialized once along with its route and position; and serialized
+# responses of the vehicles endpoint, by routes and bounding box (see
+# parse_bbox). All are reset on every tick.
+tick_time = time.time()
+serialized_vehicles = []
+vehicles_cache = {}
+# Latest headways of each route, direction and station, keyed by (route,
+# direction, station ID), which are updated by the headways of each live
+# tick and pushed to clients in HEADWAYS_ROOM.
+headway_entries = {}
+HEADWAYS_ROOM = "headways"
+# Reader of recorded ticks, if history is enabled (see --history), and the
+# green thread playing back history to each client that requested it
+history_reader = None
+playbacks = {}
+
+PROCESSING_SECONDS = metrics.Histogram(
+    "livesubway_tick_processing_seconds",
+    "Time to build the subway cars of a feed"
+)
+VEHICLES = metrics.Gauge(
+    "livesubway_tick_vehicles",
+    "Subway cars in the latest broadcast"
+)
+EMIT_SECONDS = metrics.Histogram(
+    "livesubway_emit_seconds",
+    "Time to emit a broadcast to all clients"
+)
+STATIC_RELOADS = metrics.Counter(
+    "livesubway_static_reloads_total",
+    "Reloads of the static data after a new version was written"
+)
+SCHEDULED_TICKS = metrics.Counter(
+    "livesubway_scheduled_ticks_total",
+    "Ticks of scheduled positions sent in place of the live feed"
+)
+CONNECTED_CLIENTS = metrics.Gauge(
+    "livesubway_connected_clients",
+    "Clients currently connected over Socket.IO"
+)
 
 
 @app.route('/')
@@ -76,12 +187,15 @@ def index():
 @app.route('/map_json')
 def map_json():
     # Documentation for shapes.json:
-    # shape_id: {
-    #      sequence: number of points,
-    #      color: route color,
-    #      points: [[lon, lat],...,]
+    # tracks: [[[lon, lat],...,],...,],
+    # shapes: {
+    #     shape_id: {
+    #          sequence: number of points,
+    #          color: route color,
+    #          tracks: [track index (or ~index if reversed),...,]
+    #     }
     # }
-    return jsonify(shapes)
+    return jsonify(static_data.shapes)
 
 
 @app.route('/stops_json')
@@ -94,33 +208,839 @@ def stops_json():
     #      },
     #      name: name
     # }
-    return jsonify(stops)
+    return jsonify(static_data.stops)
 
 
-# @socketio.on('get_feed')
-# def subway_cars():
-#     global feed_event
-#     if feed_event is None:
-#         feed_event = socketio.start_background_task(target=subway_cars_timer)
+@app.route('/stops/search')
+def stop_search():
+    # Stations best matching a search of their names, best match first,
+    # e.g. /stops/search?q=times+sq&limit=5:
+    # [{stop_id, name, coordinates: [lon, lat]},...,]
+    limit = max(min(request.args.get("limit", DEFAULT_SEARCH_RESULTS,
+                                     type=int), MAX_SEARCH_RESULTS), 0)
 
-#     print "Emitted."
-#     emit('feed', demos[0])
+    return Response(json.dumps(static_data.search.search(
+        request.args.get("q", ""), limit)), mimetype="application/json")
 
 
-def subway_cars_timer():
-    counter = 1
-    while True:
-        socketio.sleep(30)
-        demo_emit = demos[counter % len(demos)]
-        print "Emitted."
-        socketio.emit('feed', demo_emit)
-        counter += 1
+@app.route('/stops/<stop_id>/arrivals')
+def stop_arrivals(stop_id):
+    # Next predicted arrivals at a station (a key of stops.json) as of the
+    # latest feed, e.g. /stops/127/arrivals?limit=5:
+    # stop_id: station ID,
+    # timestamp: header timestamp of feed,
+    # arrivals: [{trip_id, route, stop_id (of platform), time},...,]
+    limit = max(min(request.args.get("limit", DEFAULT_ARRIVALS, type=int),
+                    MAX_ARRIVALS), 0)
+    key = (stop_id, limit)
+    response = arrivals_cache.get(key)
+    metrics.record_cache("arrivals", response is not None)
 
+    if response is None:
+        if stop_id not in static_data.stops:
+            abort(404)
+        timestamp = current_tick["timestamp"]
+        response = arrivals_cache[key] = json.dumps({
+            "stop_id": stop_id,
+            "timestamp": timestamp,
+            "arrivals": arrival_index.get_arrivals(stop_id, timestamp or 0,
+                                                   limit)
+        })
 
-if __name__ == "__main__":
-    feed_thread = feed.start_timer()
+    return Response(response, mimetype="application/json")
+
+
+def get_trip_delays(data):
+    """ Returns the delays of the trips of the latest live tick (see
+    raptor.get_delays), computed once per tick and version of the static
+    data.
+    """
+    global trip_delays
+    version, delays = trip_delays
+    if live_trips is None:
+        return {}
+    if delays is None or version != data.version:
+        delays = raptor.get_delays(data.timetable, live_trips[1],
+                                   live_trips[0])
+        trip_delays = (data.version, delays)
 
+    return delays
+
+
+@app.route('/plan')
+def plan_journey():
+    # Journeys between two stations (keys of stops.json) leaving now or at a
+    # time, with the delays of the latest feed unless live=0, e.g.
+    # /plan?from=127&to=A27&time=1478505600:
+    # [{departure, arrival, transfers, legs: [{type: trip, trip_id, route,
+    # from_stop, to_stop, departure, arrival, stops, delay} or {type:
+    # transfer, from_stop, to_stop, departure, arrival},...,]},...,]
+    # (see raptor.plan); the first journey arrives the earliest, and each
+    # following journey arrives later with fewer transfers.
+    data = static_data
+    origin = request.args.get("from")
+    destination = request.args.get("to")
+    if origin not in data.stops or destination not in data.stops:
+        abort(404)
+    departure = request.args.get("time", type=int)
+    if departure is None:
+        departure = int(time.time())
+    delays = get_trip_delays(data) if request.args.get("live") != "0" \
+        else None
+
+    return Response(json.dumps(raptor.plan(data.timetable, origin,
+                                           destination, departure, delays)),
+                    mimetype="application/json")
+
+
+def get_vehicle_position(vehicle):
+    """ Returns the current coordinates of a subway car along its path, of
+    the form [lon, lat], or None if its path is empty.
+    """
+    path = vehicle["path"]
+    if not path:
+        return None
+
+    return path[int(round(vehicle["progress"] * (len(path) - 1)))]
+
+
+def in_bbox(position, bbox):
+    """ Returns whether a position [lon, lat] is within a bounding box
+    (min_lon, min_lat, max_lon, max_lat).
+    """
+    return position is not None and \
+        bbox[0] <= position[0] <= bbox[2] and bbox[1] <= position[1] <= bbox[3]
+
+
+def parse_bbox(bbox):
+    """ Returns the bounding box of the form "min_lon,min_lat,max_lon,
+    max_lat" as a tuple of floats, widened to multiples of BBOX_DEGREES, or
+    aborts the request if it is invalid.
+    """
     try:
-        socketio.run(app, debug=True)
+        min_lon, min_lat, max_lon, max_lat = map(float, bbox.split(","))
+    except ValueError:
+        abort(400)
+
+    return tuple(math.floor(x / BBOX_DEGREES) * BBOX_DEGREES
+                 for x in (min_lon, min_lat)) + \
+        tuple(math.ceil(x / BBOX_DEGREES) * BBOX_DEGREES
+              for x in (max_lon, max_lat))
+
+
+@app.route('/vehicles')
+def vehicles_json():
+    # Subway cars of the latest tick, optionally only those of some routes
+    # and within a bounding box, e.g. /vehicles?route=A,C&bbox=min_lon,
+    # min_lat,max_lon,max_lat:
+    # timestamp: header timestamp of feed,
+    # vehicles: [subway car (see feed.get_vehicles),...,]
+    # Responses carry an ETag of the feed timestamp, and may be cached until
+    # the next feed is expected.
+    routes = request.args.get("route")
+    routes = frozenset(routes.split(",")) if routes else None
+    bbox = request.args.get("bbox")
+    bbox = parse_bbox(bbox) if bbox else None
+
+    key = (routes, bbox)
+    data = vehicles_cache.get(key)
+    metrics.record_cache("vehicles", data is not None)
+
+    if data is None:
+        data = '{"timestamp": %s, "vehicles": [%s]}' % (
+            json.dumps(current_tick["timestamp"]),
+            ", ".join(
+                serialized for route, position, serialized
+                in serialized_vehicles
+                if (routes is None or route in routes) and
+                (bbox is None or in_bbox(position, bbox))
+            )
+        )
+        if len(vehicles_cache) < MAX_VEHICLES_RESPONSES:
+            vehicles_cache[key] = data
+
+    response = Response(data, mimetype="application/json")
+    response.set_etag(str(current_tick["timestamp"]))
+    response.cache_control.public = True
+    response.cache_control.max_age = max(
+        int(math.ceil(tick_time + poll_interval - time.time())), 0)
+
+    return response.make_conditional(request)
+
+
+@app.route('/headways')
+def headways_json():
+    # Latest headways of each route, direction and station, optionally only
+    # those of some routes, e.g. /headways?route=A,C:
+    # [{route, direction, station, last_departure, last_trip_id, headway,
+    # median_headway, mean_headway, samples, bunched},...,]
+    # (see headways.HeadwayTracker.get_entry)
+    routes = request.args.get("route")
+    routes = frozenset(routes.split(",")) if routes else None
+
+    return Response(json.dumps([
+        entry for key, entry in sorted(headway_entries.iteritems())
+        if routes is None or entry["route"] in routes
+    ]), mimetype="application/json")
+
+
+def parse_history_window(args):
+    """ Returns the window of time (start, end) and routes (or None) of a
+    history query, or raises ValueError if the query is invalid.
+    """
+    start = int(args["start"])
+    end = int(args["end"])
+    if not 0 < end - start <= MAX_HISTORY_SECONDS:
+        raise ValueError("Window must be at most {} seconds".format(
+            MAX_HISTORY_SECONDS))
+
+    routes = args.get("routes")
+    return start, end, routes or None
+
+
+@app.route('/history')
+def history_json():
+    # Recorded subway cars within a window of at most MAX_HISTORY_SECONDS,
+    # optionally only those of some routes, streamed one tick per line,
+    # e.g. /history?start=1478505600&end=1478509200&route=A,C:
+    # {timestamp: timestamp of tick, vehicles: [subway car (see
+    # history.HistoryReader.get_ticks),...,]}
+    if history_reader is None:
+        abort(404)
+
+    routes = request.args.get("route")
+    try:
+        start, end, routes = parse_history_window({
+            "start": request.args.get("start"),
+            "end": request.args.get("end"),
+            "routes": routes.split(",") if routes else None
+        })
+    except (TypeError, ValueError):
+        abort(400)
+
+    def generate():
+        for timestamp, vehicles in history_reader.get_ticks(start, end,
+                                                            routes):
+            yield json.dumps({"timestamp": timestamp,
+                              "vehicles": vehicles}) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+@app.route('/metrics')
+def metrics_text():
+    return Response(metrics.render(),
+                    mimetype="text/plain; version=0.0.4")
+
+
+def check_admin():
+    """ Aborts the request unless it carries the admin key, either in the
+    X-Admin-Key header or the key query parameter.
+    """
+    key = request.headers.get("X-Admin-Key", request.args.get("key", ""))
+    if ADMIN_KEY is None:
+        abort(404)
+    if not hmac.compare_digest(str(key), str(ADMIN_KEY)):
+        abort(403)
+
+
+def parse_profile_window(args):
+    """ Returns the duration and interval (seconds, interval) of a profile,
+    clamped to the limits of the profiler, or raises ValueError if either is
+    not a positive number.
+    """
+    seconds = float(args["seconds"])
+    interval = float(args["interval"])
+    # Written this way round so that NaN is rejected as well
+    if not (0 < seconds < float("inf") and 0 < interval < float("inf")):
+        raise ValueError("Duration and interval must be positive")
+
+    seconds = min(seconds, profiler.MAX_DURATION)
+    return seconds, min(max(interval, profiler.MIN_INTERVAL),
+                        profiler.MAX_INTERVAL, seconds)
+
+
+@app.route('/admin/profile')
+def profile():
+    # Samples the server for the given number of seconds (at most
+    # profiler.MAX_DURATION) every interval seconds (between
+    # profiler.MIN_INTERVAL and profiler.MAX_INTERVAL) and responds with
+    # collapsed stacks, e.g.
+    # curl -H "X-Admin-Key: ..." /admin/profile?seconds=10 | flamegraph.pl
+    global active_profiler
+    check_admin()
+    if active_profiler is not None:
+        abort(409)
+
+    try:
+        seconds, interval = parse_profile_window({
+            "seconds": request.args.get("seconds", 10),
+            "interval": request.args.get("interval",
+                                         profiler.DEFAULT_INTERVAL)
+        })
+    except ValueError:
+        abort(400)
+
+    active_profiler = profiler.SamplingProfiler(interval)
+    active_profiler.start()
+    try:
+        socketio.sleep(seconds)
     finally:
-        feed_thread.cancel()
+        active_profiler.stop()
+        collapsed = active_profiler.collapsed()
+        active_profiler = None
+
+    return Response(collapsed, mimetype="text/plain")
+
+
+@app.route('/admin/clients')
+def clients():
+    # Frames in flight and lag of every connected client, keyed by session
+    # ID (see broadcaster.Broadcaster.get_clients)
+    check_admin()
+    return jsonify(feed_broadcaster.get_clients())
+
+
+@socketio.on('connect')
+def connect():
+    CONNECTED_CLIENTS.inc()
+    feed_broadcaster.add_client(request.sid)
+
+
+@socketio.on('disconnect')
+def disconnect():
+    CONNECTED_CLIENTS.dec()
+    feed_broadcaster.remove_client(request.sid)
+    thread = playbacks.pop(request.sid, None)
+    if thread is not None:
+        thread.kill()
+
+
+@socketio.on('get_feed')
+def subway_cars():
+    # Resumes the live feed of a client playing back history
+    thread = playbacks.pop(request.sid, None)
+    if thread is not None:
+        thread.kill()
+        feed_broadcaster.add_client(request.sid)
+    feed_broadcaster.send_latest(request.sid)
+
+
+@socketio.on('subscribe_headways')
+def subscribe_headways():
+    # Sends the client the latest headways, and then the headways that
+    # change with each tick, as 'headways' events
+    join_room(HEADWAYS_ROOM)
+    socketio.emit('headways', headway_entries.values(), room=request.sid)
+
+
+@socketio.on('unsubscribe_headways')
+def unsubscribe_headways():
+    leave_room(HEADWAYS_ROOM)
+
+
+@socketio.on('playback')
+def start_playback(args):
+    # Plays back the recorded subway cars within a window to the client as
+    # 'feed' events, in place of the live feed until the client emits
+    # 'get_feed' again, e.g. {start: 1478505600, end: 1478509200, routes:
+    # ["A", "C"], speed: 60}. Returns an error message if the window is
+    # invalid or history is disabled.
+    if history_reader is None:
+        return "History is disabled"
+    try:
+        start, end, routes = parse_history_window(args)
+        speed = float(args.get("speed", 1))
+        if speed <= 0:
+            raise ValueError("Speed must be positive")
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        return str(e)
+
+    sid = request.sid
+    feed_broadcaster.remove_client(sid)
+    thread = playbacks.pop(sid, None)
+    if thread is not None:
+        thread.kill()
+    playbacks[sid] = spawn(playback, sid, start, end, routes, speed)
+
+
+def playback(sid, start, end, routes, speed):
+    """ Sends the recorded ticks within a window to a client, at the pace
+    they were recorded.
+
+    Arguments
+    ---------
+    sid: str
+        Session ID of client
+    start: int
+        Start of window, in seconds since the epoch
+    end: int
+        End of window, in seconds since the epoch
+    routes: list[str]
+        If given, only send subway cars of these routes
+    speed: float
+        Speed of playback relative to real time
+    """
+    data = static_data
+    last_timestamp = None
+    for timestamp, rows in history_reader.get_ticks(start, end, routes):
+        if last_timestamp is not None:
+            socketio.sleep((timestamp - last_timestamp) / speed)
+        last_timestamp = timestamp
+
+        vehicles = []
+        for row in rows:
+            try:
+                row["path"] = feed.get_path(data.graph, row["prev_stop"],
+                                            row["stop"], data.shapes)
+            except KeyError:
+                continue
+            vehicles.append(row)
+
+        socketio.emit('feed', json.dumps(vehicles), room=sid)
+
+
+def process_feed(columns):
+    """ Returns the tick of subway cars to render for a new feed.
+
+    Arguments
+    ---------
+    columns: feed.FeedColumns
+        Columns of feed (see feed.decode_feed)
+
+    Returns
+    -------
+    dict
+        Tick of the form {
+            timestamp: header timestamp of feed,
+            vehicles: list of subway cars (see feed.get_vehicles),
+            trips: predicted arrivals of each trip (see
+                feed.FeedColumns.get_trips)
+        }
+    """
+    start = time.time()
+    tick = build_tick(columns, static_data)
+    PROCESSING_SECONDS.observe(time.time() - start)
+
+    return tick
+
+
+def build_tick(columns, data):
+    """ Returns the tick of subway cars to render for a feed, given a
+    version of the static data (see process_feed).
+    """
+    return {
+        "timestamp": columns.timestamp,
+        "vehicles": feed.get_vehicles(columns, data.graph, data.prev_stops,
+                                      data.shapes),
+        "trips": columns.get_trips()
+    }
+
+
+def ingest_feed(feed_id, version):
+    """ Retrieves, parses and processes a feed in a worker process.
+
+    Arguments
+    ---------
+    feed_id: int
+        Feed ID of feed
+    version: str
+        Version of static data to process the feed with; if the worker
+        has an older version, the new version is loaded first
+
+    Returns
+    -------
+    tuple[dict, dict[str -> float]]
+        Tick of subway cars (see process_feed), and statistics of the feed
+        (see feed.load_feed) along with processing_seconds
+    """
+    global static_data
+    if static_data.version != version:
+        static_data = load_static_data()
+
+    columns, stats = feed.load_feed(feed_id)
+    start = time.time()
+    tick = build_tick(columns, static_data)
+    stats["processing_seconds"] = time.time() - start
+
+    return tick, stats
+
+
+def ingest_timer(pool, interval, callback):
+    """ Ingests a feed in a worker process every interval, and passes each
+    tick to a callback on the hub.
+
+    Arguments
+    ---------
+    pool: workers.WorkerPool
+        Pool of worker processes
+    interval: float
+        Seconds between feeds
+    callback: function
+        Function of tick
+    """
+    while True:
+        try:
+            tick, stats = pool.execute(ingest_feed, feed.dataset.feed_id,
+                                       static_data.version)
+        except workers.WorkerError as e:
+            feed.FETCH_ERRORS.labels(feed.dataset.feed_id).inc()
+            print "Failed to ingest feed: {}".format(e)
+        else:
+            feed.record_stats(feed.dataset.feed_id, stats)
+            PROCESSING_SECONDS.observe(stats["processing_seconds"])
+            callback(tick)
+        socketio.sleep(interval)
+
+
+def start_ingest_timer(pool, interval, callback):
+    """ Starts ingest_timer in a green thread, like feed.start_timer, and
+    returns it, so that it can be waited on or killed (unlike the threads of
+    socketio.start_background_task).
+    """
+    return spawn(ingest_timer, pool, interval, callback)
+
+
+def build_scheduled_tick(now, data):
+    """ Returns the tick of subway cars at their scheduled positions.
+
+    Subway cars are of the same form as in the live feed (see
+    feed.get_vehicles), with "scheduled": true.
+
+    Arguments
+    ---------
+    now: float
+        Time of tick, in seconds since the epoch
+    data: StaticData
+        Static data
+
+    Returns
+    -------
+    dict
+        Tick of subway cars (see process_feed)
+    """
+    vehicles = []
+    for position in data.schedule.get_positions_at(
+            datetime.fromtimestamp(now, feed.get_timezone())):
+        try:
+            path = feed.get_path(data.graph, position.prev_stop,
+                                 position.stop, data.shapes)
+        except KeyError:
+            continue
+
+        vehicles.append({
+            "trip_id": position.trip_id,
+            "route": position.route,
+            "prev_stop": position.prev_stop,
+            "stop": position.stop,
+            "path": path,
+            "progress": position.progress,
+            "remaining_time": position.remaining_time,
+            "scheduled": True
+        })
+
+    return {"timestamp": int(now), "vehicles": vehicles}
+
+
+def schedule_timer(interval, callback, stale_seconds=None):
+    """ Passes a tick of scheduled positions to a callback every interval.
+
+    Scheduled positions are found at the time of day in the time zone of
+    the agency (see feed.get_timezone), whatever the time zone of the
+    server.
+
+    Arguments
+    ---------
+    interval: float
+        Seconds between ticks
+    callback: function
+        Function of tick
+    stale_seconds: float
+        If given, ticks are only passed on while no live tick has been
+        received for this many seconds (or since the timer started), so
+        that scheduled positions fill gaps in the live feed
+    """
+    started = time.time()
+    while True:
+        socketio.sleep(interval)
+        now = time.time()
+        if stale_seconds is not None and \
+                now - (last_feed_time or started) < stale_seconds:
+            continue
+
+        SCHEDULED_TICKS.inc()
+        callback(build_scheduled_tick(now, static_data))
+
+
+def broadcast(tick):
+    """ Sends a tick of subway cars to all clients.
+
+    The subway cars are sent as a JSON string, serialized once for all
+    clients, which clients acknowledge on receipt (see
+    broadcaster.Broadcaster).
+
+    Arguments
+    ---------
+    tick: dict
+        Tick of subway cars (see process_feed)
+    """
+    global current_tick, serialized_vehicles, tick_time, live_trips, \
+        trip_delays
+    # Ticks of scheduled positions carry no predictions, so the predictions
+    # of the latest feed are kept until the next one.
+    if "trips" in tick:
+        arrival_index.update(tick["trips"])
+        live_trips = (tick["timestamp"], tick["trips"])
+        trip_delays = (None, None)
+    if tick.get("headways"):
+        for entry in tick["headways"]:
+            headway_entries[(entry["route"], entry["direction"],
+                             entry["station"])] = entry
+        socketio.emit('headways', tick["headways"], room=HEADWAYS_ROOM)
+    arrivals_cache.clear()
+    vehicles_cache.clear()
+    tick_time = time.time()
+    current_tick = tick
+    VEHICLES.set(len(tick["vehicles"]))
+
+    start = time.time()
+    serialized_vehicles = [
+        (vehicle["route"], get_vehicle_position(vehicle), json.dumps(vehicle))
+        for vehicle in tick["vehicles"]
+    ]
+    feed_broadcaster.publish(
+        "[" + ", ".join(serialized for _, _, serialized
+                        in serialized_vehicles) + "]")
+    EMIT_SECONDS.observe(time.time() - start)
+    print "Emitted."
+
+
+def subscribe(address):
+    """ Broadcasts the ticks published by an ingest process.
+
+    Arguments
+    ---------
+    address: str
+        Address of message bus
+    """
+    for frame in bus.Subscriber(address):
+        broadcast(json.loads(frame))
+
+
+def static_watcher(interval=STATIC_POLL_INTERVAL):
+    """ Reloads the static data whenever static.py writes a new version.
+
+    Clients are served from the old version until the new version is loaded
+    in full, and then swapped in. Loading holds the GIL, so it is not moved
+    to a real thread; instead the watcher yields to other green threads
+    after each file. Other green threads (broadcasts, requests) are then
+    held up for at most the time to load the largest file rather than all
+    of them: with the synthetic data of scripts/benchmark.py, about the
+    size of the MTA's, a reload takes about 0.3 s in total, and the longest
+    pause is just under 0.2 s, while prev_stops.pkl is loaded.
+
+    Arguments
+    ---------
+    interval: float
+        Seconds between checks for a new version
+    """
+    global static_data
+    while True:
+        socketio.sleep(interval)
+        version = get_static_version()
+        if version == static_data.version:
+            continue
+
+        print "Loading static data version {}...".format(version)
+        try:
+            new_static_data = load_static_data(
+                pause=lambda: socketio.sleep(0))
+        except Exception as e:
+            print "Failed to load static data: {}".format(e)
+            continue
+
+        # If static.py wrote another version while we were loading, the
+        # files may be from different versions, so we try again later.
+        if new_static_data.version != get_static_version():
+            continue
+
+        static_data = new_static_data
+        STATIC_RELOADS.inc()
+        print "Loaded static data version {}.".format(version)
+
+
+def get_parser():
+    """ Returns argument parser. """
+    parser = ArgumentParser(
+        description="Runs the Live Subway server. By default a single " +
+        "process both retrieves the feeds and serves clients; to serve " +
+        "clients from several processes, run one ingest process and any " +
+        "number of web processes on different ports. To serve several " +
+        "datasets, run a server for each dataset and a router in front " +
+        "of them."
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["standalone", "ingest", "web", "router"],
+        default="standalone",
+        help="Whether to retrieve feeds and serve clients (standalone), " +
+        "only retrieve feeds and publish ticks to the message bus " +
+        "(ingest), only serve clients the ticks from the bus (web), or " +
+        "route requests to the servers of each dataset (router)"
+    )
+    parser.add_argument(
+        "--dataset",
+        choices=sorted(datasets.DATASETS),
+        default=datasets.DEFAULT_DATASET,
+        help="Dataset to serve, from the files static.py writes for it"
+    )
+    parser.add_argument(
+        "--shard",
+        action="append",
+        metavar="DATASET=HOST:PORT",
+        help="Address of the server of a dataset to route requests under " +
+        "/<dataset>/ to (router only; may be repeated, and requests for " +
+        "no dataset are routed to the first)"
+    )
+    parser.add_argument(
+        "--bus",
+        help="Address of message bus: path of UNIX socket, or host:port " +
+        "(by default a UNIX socket in the directory of the dataset)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of worker processes to retrieve, parse and process " +
+        "feeds in, outside of the server's event loop (by default feeds " +
+        "are processed in the server process)"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--endpoint",
+        help="URL of feed endpoint, formatted with the API key and feed " +
+        "ID (by default that of the dataset)"
+    )
+    parser.add_argument(
+        "--record",
+        metavar="ARCHIVE",
+        help="Record retrieved feeds to an archive"
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="ARCHIVE",
+        help="Replay feeds from an archive instead of retrieving them"
+    )
+    parser.add_argument(
+        "--history",
+        metavar="DIRECTORY",
+        help="Record the subway cars of every live tick to a directory, " +
+        "and serve queries and playback of them (web processes only read " +
+        "the history recorded by the ingest process)"
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=["off", "fill", "only"],
+        default="fill",
+        help="Whether to never send scheduled positions (off), send them " +
+        "while the feed is unavailable (fill), or send only scheduled " +
+        "positions without retrieving feeds (only)"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Speed of replay relative to real time"
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.mode == "router":
+        if not args.shard:
+            parser.error("--mode router requires at least one --shard")
+        try:
+            shards = [router.parse_shard(shard) for shard in args.shard]
+        except ValueError:
+            parser.error("--shard must be of the form DATASET=HOST:PORT")
+        router.Router(shards).serve(args.host, args.port)
+        raise SystemExit
+
+    feed.dataset = datasets.get_dataset(args.dataset)
+    if args.endpoint:
+        feed.dataset.endpoint = args.endpoint
+    elif feed.dataset.endpoint is None and args.mode != "web" and \
+            args.schedule != "only" and not args.replay:
+        parser.error(("Dataset {} has no feed endpoint; pass --endpoint, " +
+                      "or --schedule only").format(args.dataset))
+    static_data = load_static_data()
+    if args.record:
+        feed.recorder = replay.FeedRecorder(args.record)
+    if args.replay:
+        feed.transport = replay.FeedReplay(args.replay, args.speed, loop=True)
+
+    # Progress and remaining time of subway cars are estimated from travel
+    # times learned from the live ticks, and headways are followed from the
+    # departures between ticks; live ticks all pass through this process
+    # (see live_callback), which adds the headways that changed to them.
+    travel_model_path = feed.dataset.pickle_dir + \
+        travel_times.TRAVEL_TIMES_FILE
+    travel_model = travel_times.load_model(travel_model_path)
+    headway_tracker = headways.HeadwayTracker()
+    history_writer = None
+    if args.history:
+        history_reader = history.HistoryReader(args.history)
+        if args.mode != "web":
+            history_writer = history.HistoryWriter(args.history)
+
+    interval = poll_interval = feed.POLL_INTERVAL / args.speed
+    feed_broadcaster.ack_timeout = 2 * interval
+    spawn(static_watcher)
+
+    def start_timer(callback):
+        if args.schedule == "only":
+            return spawn(schedule_timer, interval, callback)
+        elif args.schedule == "fill":
+            spawn(schedule_timer, interval, callback,
+                  STALE_FEED_INTERVALS * interval)
+
+        def live_callback(tick):
+            global last_feed_time
+            last_feed_time = time.time()
+            tick["headways"] = headway_tracker.add_departures(
+                travel_model.update(tick))
+            if travel_model.should_save():
+                travel_model.save(travel_model_path)
+            if history_writer is not None:
+                history_writer.append(tick)
+            callback(tick)
+
+        if args.workers:
+            pool = workers.WorkerPool(args.workers)
+            return start_ingest_timer(pool, interval, live_callback)
+        else:
+            return feed.start_timer(interval, lambda columns:
+                                    live_callback(process_feed(columns)))
+
+    bus_address = args.bus or feed.dataset.pickle_dir + BUS_FILE
+    if args.mode == "ingest":
+        publisher = bus.Publisher(bus_address)
+        ingest_thread = start_timer(
+            lambda tick: publisher.publish(json.dumps(tick)))
+        try:
+            ingest_thread.wait()
+        finally:
+            ingest_thread.kill()
+    elif args.mode == "web":
+        spawn(subscribe, bus_address)
+        socketio.run(app, args.host, args.port, debug=True)
+    else:
+        feed_thread = start_timer(broadcast)
+        try:
+            socketio.run(app, args.host, args.port, debug=True)
+        finally:
+            feed_thread.kill()
@@ -0,0 +1,108 @@
+from bisect import bisect_left, insort
+
+from feed import get_station_id
+
+
+class ArrivalIndex:
+    """ ArrivalIndex class.
+
+    Used primarily to look up the next trains at a station. Predicted
+    arrivals are kept in a sorted list per station, of (arrival time, trip
+    ID, route, stop ID) tuples, so that the arrivals after a given time are
+    found by bisection.
+
+    The index is updated incrementally from the predictions of each feed:
+    arrivals of a trip are only removed or inserted where they differ from
+    the predictions of the previous feed, and the arrivals of trips no
+    longer in the feed are removed.
+    """
+    def __init__(self):
+        """ Constructor. """
+        self._arrivals = {}
+        self._trips = {}
+
+    def _insert(self, trip_id, route, stop_id, arrival_time):
+        arrivals = self._arrivals.setdefault(get_station_id(stop_id), [])
+        insort(arrivals, (arrival_time, trip_id, route, stop_id))
+
+    def _remove(self, trip_id, route, stop_id, arrival_time):
+        station_id = get_station_id(stop_id)
+        arrivals = self._arrivals[station_id]
+        entry = (arrival_time, trip_id, route, stop_id)
+        del arrivals[bisect_left(arrivals, entry)]
+        if not arrivals:
+            del self._arrivals[station_id]
+
+    def update(self, trips):
+        """ Updates the index with the predictions of a feed.
+
+        Arguments
+        ---------
+        trips: dict[str -> list]
+            Map of trip ID -> [route, [stop ID, ...], [arrival time, ...]]
+            for every trip in the feed (see feed.FeedColumns.get_trips)
+        """
+        for trip_id in self._trips.keys():
+            if trip_id not in trips:
+                route, old_arrivals = self._trips.pop(trip_id)
+                for stop_id, arrival_time in old_arrivals.iteritems():
+                    self._remove(trip_id, route, stop_id, arrival_time)
+
+        for trip_id, (route, stop_ids, arrival_times) in trips.iteritems():
+            # Arrival times of 0 are missing predictions (e.g. at the first
+            # stop of a trip, where only the departure is predicted)
+            new_arrivals = {
+                stop_id: arrival_time
+                for stop_id, arrival_time in zip(stop_ids, arrival_times)
+                if arrival_time > 0
+            }
+            old_route, old_arrivals = self._trips.get(trip_id, (route, {}))
+            if old_route != route:
+                for stop_id, arrival_time in old_arrivals.iteritems():
+                    self._remove(trip_id, old_route, stop_id, arrival_time)
+                old_arrivals = {}
+
+            for stop_id, arrival_time in old_arrivals.iteritems():
+                if new_arrivals.get(stop_id) != arrival_time:
+                    self._remove(trip_id, route, stop_id, arrival_time)
+            for stop_id, arrival_time in new_arrivals.iteritems():
+                if old_arrivals.get(stop_id) != arrival_time:
+                    self._insert(trip_id, route, stop_id, arrival_time)
+
+            self._trips[trip_id] = (route, new_arrivals)
+
+    def get_arrivals(self, station_id, after, limit):
+        """ Returns the next predicted arrivals at a station.
+
+        Arguments
+        ---------
+        station_id: str
+            Station ID of station (must be a parent station)
+        after: int
+            Time after which to return arrivals, in seconds since the epoch
+        limit: int
+            Maximum number of arrivals to return
+
+        Returns
+        -------
+        list[dict]
+            List of arrivals, sorted by arrival time, of the form {
+                trip_id: trip ID,
+                route: route ID,
+                stop_id: stop ID of platform,
+                time: predicted arrival time
+            }
+        """
+        arrivals = self._arrivals.get(station_id, [])
+        start = bisect_left(arrivals, (after,))
+
+        return [
+            {
+                "trip_id": trip_id,
+                "route": route,
+                "stop_id": stop_id,
+                "time": arrival_time
+            }
+            for arrival_time, trip_id, route, stop_id
+            in arrivals[start:start + limit]
+        ]
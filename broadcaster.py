@@ -0,0 +1,276 @@
+import time
+
+from collections import OrderedDict
+
+import metrics
+
+# Seconds to wait for a client to acknowledge a frame before parking it, i.e.
+# holding its latest frame until it acknowledges the frame in flight
+DEFAULT_ACK_TIMEOUT = 60
+# Most bytes of frames sent to clients and not yet acknowledged, summed over
+# every client; frames that would exceed it wait for clients to acknowledge
+DEFAULT_MAX_OUTSTANDING_BYTES = 256 * 2 ** 20
+
+ACK_SECONDS = metrics.Histogram(
+    "livesubway_client_ack_seconds",
+    "Time for a client to acknowledge a frame",
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+)
+FRAMES_SENT = metrics.Counter(
+    "livesubway_frames_sent_total",
+    "Frames sent to clients"
+)
+FRAMES_DROPPED = metrics.Counter(
+    "livesubway_frames_dropped_total",
+    "Frames superseded by a newer frame before they could be sent to a " +
+    "client"
+)
+ACK_TIMEOUTS = metrics.Counter(
+    "livesubway_ack_timeouts_total",
+    "Frames not acknowledged by a client in time"
+)
+OUTSTANDING_BYTES = metrics.Gauge(
+    "livesubway_outstanding_bytes",
+    "Bytes of frames sent to clients and not yet acknowledged"
+)
+LAGGING_CLIENTS = metrics.Gauge(
+    "livesubway_lagging_clients",
+    "Clients with a newer frame waiting for them"
+)
+PARKED_CLIENTS = metrics.Gauge(
+    "livesubway_parked_clients",
+    "Clients that have not acknowledged a frame in time"
+)
+
+
+class _Client:
+    """ State of the frames of a client. """
+    def __init__(self):
+        self.sent_id = 0
+        self.sent_time = None
+        self.sent_bytes = 0
+        self.parked = False
+        self.pending = None
+        self.last_ack_seconds = None
+        self.frames_sent = 0
+        self.frames_dropped = 0
+
+
+class Broadcaster:
+    """ Broadcaster class.
+
+    Used primarily to send each tick to every client without letting slow
+    clients build up a backlog. Each client has at most one frame in flight:
+    a frame is only sent once the client has acknowledged the previous one,
+    and frames published in the meantime replace one another, so that a
+    slow client skips straight to the latest frame. A client that has not
+    acknowledged its frame within the ack timeout is parked: it is sent
+    nothing more until it does, however long that takes. Frames are
+    serialized once and shared by all clients, so the memory held for
+    clients is bounded by one frame in flight and one pending frame per
+    client, and the frames in flight by max_outstanding_bytes.
+    """
+    def __init__(self, socketio, event, ack_timeout=DEFAULT_ACK_TIMEOUT,
+                 max_outstanding_bytes=DEFAULT_MAX_OUTSTANDING_BYTES):
+        """ Constructor.
+
+        Arguments
+        ---------
+        socketio: flask_socketio.SocketIO
+            SocketIO object to emit frames with
+        event: str
+            Name of event of frames
+        ack_timeout: float
+            Seconds to wait for a client to acknowledge a frame before
+            parking it
+        max_outstanding_bytes: int
+            Most bytes of frames in flight, summed over every client
+        """
+        self.socketio = socketio
+        self.event = event
+        self.ack_timeout = ack_timeout
+        self.max_outstanding_bytes = max_outstanding_bytes
+        self.latest = None
+        self.outstanding_bytes = 0
+        self._clients = {}
+        # Clients whose frame is held back by max_outstanding_bytes, in the
+        # order they were held
+        self._held = OrderedDict()
+
+        OUTSTANDING_BYTES.set_function(lambda: self.outstanding_bytes)
+        LAGGING_CLIENTS.set_function(
+            lambda: sum(1 for client in self._clients.itervalues()
+                        if client.pending is not None))
+        PARKED_CLIENTS.set_function(
+            lambda: sum(1 for client in self._clients.itervalues()
+                        if client.parked))
+
+    def add_client(self, sid):
+        """ Adds a client, which is sent frames from the next one published.
+
+        A client added again (e.g. reconnecting with the same session ID)
+        starts afresh, as if it had been removed first.
+
+        Arguments
+        ---------
+        sid: str
+            Session ID of client
+        """
+        old_client = self._clients.get(sid)
+        self.remove_client(sid)
+        client = self._clients[sid] = _Client()
+        # Frames keep being numbered from those sent before, so that late
+        # acknowledgements of those frames are ignored
+        if old_client is not None:
+            client.sent_id = old_client.sent_id
+
+    def remove_client(self, sid):
+        """ Removes a client.
+
+        Arguments
+        ---------
+        sid: str
+            Session ID of client
+        """
+        client = self._clients.pop(sid, None)
+        self._held.pop(sid, None)
+        if client is not None and client.sent_bytes:
+            self.outstanding_bytes -= client.sent_bytes
+            self._offer_held(time.time())
+
+    def publish(self, frame):
+        """ Sends a frame to every client, or replaces the frame waiting for
+        clients that have yet to acknowledge their previous frame.
+
+        Arguments
+        ---------
+        frame: str
+            Serialized frame
+        """
+        self.latest = frame
+        now = time.time()
+        for sid, client in self._clients.items():
+            self._offer(sid, client, frame, now)
+
+    def send_latest(self, sid):
+        """ Sends the latest frame to a client, e.g. when it first asks.
+
+        Arguments
+        ---------
+        sid: str
+            Session ID of client
+        """
+        client = self._clients.get(sid)
+        if client is not None and self.latest is not None:
+            self._offer(sid, client, self.latest, time.time())
+
+    def _offer(self, sid, client, frame, now):
+        if client.sent_time is not None:
+            if not client.parked and \
+                    now - client.sent_time >= self.ack_timeout:
+                client.parked = True
+                ACK_TIMEOUTS.inc()
+            self._hold(client, frame)
+        elif self.outstanding_bytes and self.outstanding_bytes + \
+                len(frame) > self.max_outstanding_bytes:
+            # The frame is offered again once other clients make room for
+            # it (see _offer_held), or with the next one published
+            self._hold(client, frame)
+            self._held[sid] = True
+        else:
+            self._send(sid, client, frame, now)
+
+    def _hold(self, client, frame):
+        """ Replaces the frame waiting for a client. """
+        if client.pending is not None:
+            client.frames_dropped += 1
+            FRAMES_DROPPED.inc()
+        client.pending = frame
+
+    def _send(self, sid, client, frame, now):
+        if client.pending is not None and client.pending is not frame:
+            client.frames_dropped += 1
+            FRAMES_DROPPED.inc()
+        client.sent_id += 1
+        client.sent_time = now
+        client.sent_bytes += len(frame)
+        self.outstanding_bytes += len(frame)
+        client.pending = None
+        self._held.pop(sid, None)
+        client.frames_sent += 1
+        FRAMES_SENT.inc()
+
+        sent_id = client.sent_id
+        self.socketio.emit(self.event, frame, room=sid,
+                           callback=lambda *args: self._ack(sid, sent_id))
+
+    def _offer_held(self, now):
+        """ Offers their waiting frames to clients held back by
+        max_outstanding_bytes, in the order they were held, until there is
+        no more room.
+        """
+        while self._held:
+            sid = next(iter(self._held))
+            client = self._clients.get(sid)
+            if client is None or client.pending is None:
+                del self._held[sid]
+                continue
+            frame, client.pending = client.pending, None
+            self._offer(sid, client, frame, now)
+            if client.pending is not None:
+                break
+
+    def _ack(self, sid, sent_id):
+        """ Handles the acknowledgement of a frame by a client, and sends
+        the client the frame waiting for it, if any, as well as the frames
+        of clients held back until the acknowledgement made room for them.
+        """
+        client = self._clients.get(sid)
+        if client is None or sent_id != client.sent_id or \
+                client.sent_time is None:
+            return
+
+        now = time.time()
+        client.last_ack_seconds = now - client.sent_time
+        ACK_SECONDS.observe(client.last_ack_seconds)
+        client.sent_time = None
+        client.parked = False
+        self.outstanding_bytes -= client.sent_bytes
+        client.sent_bytes = 0
+
+        if client.pending is not None:
+            frame, client.pending = client.pending, None
+            self._offer(sid, client, frame, now)
+        self._offer_held(now)
+
+    def get_clients(self):
+        """ Returns the state of the frames of every client.
+
+        Returns
+        -------
+        dict[str -> dict]
+            Map of session ID -> {
+                outstanding_bytes: bytes of frames sent and not
+                    acknowledged,
+                lag_seconds: seconds since the frame in flight was sent,
+                parked: whether the frame in flight has timed out,
+                last_ack_seconds: time to acknowledge the previous frame,
+                pending: whether a newer frame is waiting for the client,
+                frames_sent: frames sent to the client,
+                frames_dropped: frames superseded before being sent
+            }
+        """
+        now = time.time()
+        return {
+            sid: {
+                "outstanding_bytes": client.sent_bytes,
+                "lag_seconds": now - client.sent_time
+                if client.sent_time is not None else 0,
+                "parked": client.parked,
+                "last_ack_seconds": client.last_ack_seconds,
+                "pending": client.pending is not None,
+                "frames_sent": client.frames_sent,
+                "frames_dropped": client.frames_dropped
+            }
+            for sid, client in self._clients.iteritems()
+        }
@@ -0,0 +1,178 @@
+import os
+import socket
+import struct
+
+import eventlet
+from eventlet.queue import Full, LightQueue
+
+# Frames are length-prefixed messages
+FRAME_HEADER = struct.Struct("!I")
+
+DEFAULT_ADDRESS = ".cache/bus.sock"
+# Number of frames buffered for a subscriber before the oldest are dropped
+SUBSCRIBER_BACKLOG = 2
+RECONNECT_INTERVAL = 1
+
+
+def _parse_address(address):
+    """ Returns the socket family and address of a bus address, which is
+    either "host:port" for TCP or a path for a UNIX socket.
+    """
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    else:
+        return socket.AF_UNIX, address
+
+
+def send_frame(sock, data):
+    """ Sends a frame over a socket.
+
+    Arguments
+    ---------
+    sock: socket.socket
+        Socket
+    data: str
+        Contents of frame
+    """
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    """ Returns exactly size bytes from a socket, or None if the socket is
+    closed first.
+    """
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return "".join(chunks)
+
+
+def recv_frame(sock):
+    """ Returns the next frame received over a socket, or None if the socket
+    is closed.
+
+    Arguments
+    ---------
+    sock: socket.socket
+        Socket
+
+    Returns
+    -------
+    str
+        Contents of frame
+    """
+    header = _recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+
+    return _recv_exactly(sock, FRAME_HEADER.unpack(header)[0])
+
+
+class Publisher:
+    """ Publisher class.
+
+    Used primarily by the ingest process to publish each tick to any number
+    of subscribed web workers. Each subscriber is sent frames from its own
+    green thread, so that a slow subscriber never holds up the publisher or
+    the other subscribers; if a subscriber falls behind by more than
+    SUBSCRIBER_BACKLOG frames, its oldest frames are dropped.
+    """
+    def __init__(self, address=DEFAULT_ADDRESS):
+        """ Constructor.
+
+        Arguments
+        ---------
+        address: str
+            "host:port" to listen on over TCP, or path of UNIX socket
+        """
+        family, bind_address = _parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(bind_address):
+            os.remove(bind_address)
+
+        self._server = eventlet.listen(bind_address, family=family)
+        self._queues = set()
+        self.last_frame = None
+        eventlet.spawn(self._accept)
+
+    def _accept(self):
+        """ Accepts subscribers. """
+        while True:
+            sock, _ = self._server.accept()
+            eventlet.spawn(self._serve, sock)
+
+    def _serve(self, sock):
+        """ Sends frames to a subscriber until it disconnects. """
+        queue = LightQueue(SUBSCRIBER_BACKLOG)
+        # New subscribers immediately receive the latest frame
+        if self.last_frame is not None:
+            queue.put(self.last_frame)
+        self._queues.add(queue)
+
+        try:
+            while True:
+                send_frame(sock, queue.get())
+        except socket.error:
+            pass
+        finally:
+            self._queues.discard(queue)
+            sock.close()
+
+    def publish(self, data):
+        """ Publishes a frame to all subscribers.
+
+        Arguments
+        ---------
+        data: str
+            Contents of frame
+        """
+        self.last_frame = data
+        for queue in list(self._queues):
+            while True:
+                try:
+                    queue.put_nowait(data)
+                    break
+                except Full:
+                    queue.get_nowait()
+
+
+class Subscriber:
+    """ Subscriber class.
+
+    Used primarily by web workers to receive the ticks published by the
+    ingest process; reconnects whenever the connection is lost.
+    """
+    def __init__(self, address=DEFAULT_ADDRESS):
+        """ Constructor.
+
+        Arguments
+        ---------
+        address: str
+            "host:port" to connect to over TCP, or path of UNIX socket
+        """
+        self._family, self._address = _parse_address(address)
+
+    def __iter__(self):
+        """ Yields frames as they are published. """
+        while True:
+            try:
+                sock = eventlet.connect(self._address, family=self._family)
+            except socket.error:
+                eventlet.sleep(RECONNECT_INTERVAL)
+                continue
+
+            try:
+                while True:
+                    frame = recv_frame(sock)
+                    if frame is None:
+                        break
+                    yield frame
+            except socket.error:
+                pass
+            finally:
+                sock.close()
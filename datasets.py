@@ -0,0 +1,443 @@
+import cPickle as pickle
+
+from datetime import date
+
+import pytz
+
+# Directories of the static transit data of each dataset, and of the files
+# static.py writes from it; every dataset but the subway (which predates
+# datasets) has a subdirectory of each named after the dataset.
+STATIC_TRANSIT_DIR = "static_transit/"
+JSON_DIR = "static/json/"
+PICKLE_DIR = ".cache/"
+# Written by static.py (see static.parse_stops)
+STATIONS_FILE = "stations.pkl"
+# Written by static.py (see static.write_static_files)
+TIMEZONE_FILE = "timezone"
+DEFAULT_DATASET = "subway"
+# Time zone of datasets whose agency time zone static.py has yet to record
+DEFAULT_TIMEZONE = "America/New_York"
+
+WEEKDAY_SERVICE_CODE = "WKD"
+SAT_SERVICE_CODE = "SAT"
+SUN_SERVICE_CODE = "SUN"
+
+MTA_ENDPOINT = "http://datamine.mta.info/mta_esi.php?key={}&feed_id={}"
+
+# We group routes by their "color" designation into sets; the reason for this
+# is that routes in a particular route group have overlap and cover overlapping
+# stops, at least in Manhattan. Thus, often times for maintenace or other
+# purposes, a train on one of these routes may be routed to another route in
+# the same group, such as a 3 train running local, which would mean it would
+# run a similar set of stops as a normal 1 train. However, this type of
+# situation is currently not covered in the static data, so we group these
+# routes up when looking at the live feed and determining what the previous
+# stop of a subway car may be from the static data.
+ROUTE_GROUPS = [
+    set(["1", "2", "3"]),
+    set(["4", "5", "6"]),
+    set(["A", "C", "E"]),
+    set(["B", "D", "F", "M"]),
+    set(["J", "Z"]),
+    set(["N", "Q", "R", "W"])
+]
+
+# Currently the new South Ferry station is closed due to the effects of
+# Hurricane Sandy, forcing the old South Ferry station to be recommissioned
+# repairs are done. However, while this is accurate in shapes.txt, the new stop
+# is still being used in stops.txt, and so we replace occurrences of the new
+# South Ferry stop with the old one until the static information is updated.
+OLD_SOUTH_FERRY = (-74.013664, 40.702068)
+NEW_SOUTH_FERRY = (-74.013205, 40.701411)
+
+# shapes.txt currently has a hole containing the York St. stop for some reason,
+# so currently while we still refer to the York St. stop as a real stop,
+# currently for purposes of convenience, we treat the closest point to the
+# York St. stop as the location of the stop along any shape, and simply use
+# this as the boundary of the tracks ending at the York St. stop.
+#
+# We may be able to have two approximate points depending on the
+# direction of the segment, but not entirely sure if this is necessary.
+# Hopefully this gets fixed in a future iteration of the static transit
+# information.
+YORK_STREET_APPROX = (-73.986885, 40.699743)
+YORK_STREET_ID = "F18"
+
+# The script currently skips paths that go along the Second Avenue Subway Line,
+# as these are part of the new N/Q (and soon to be T) lines that open up in
+# January 2017. While this data is provided as part of stops/stop_times, the
+# shapes are not provided in shapes.txt, so we skip these paths until the
+# static information is eventually updated (hopefully the next iteration once
+# the lines begin operation).
+SECOND_AVE_PATHS = set(["N..N63R", "N..N67R", "N..S16R", "Q..N16R", "Q..N19R",
+                        "Q..S16R", "Q..S19R"])
+
+
+class Dataset:
+    """ Dataset class.
+
+    Used primarily to adapt a GTFS dataset and its realtime feed to the
+    rest of the code, which only relies on the GTFS specification itself;
+    anything particular to an agency's data (how its trip IDs are built,
+    known errors in its static data, and so on) belongs in a subclass.
+
+    Datasets are pickled by name, so that objects built by static.py that
+    refer to their dataset (e.g. static.PrevStops) look it up again in
+    DATASETS when they are loaded.
+    """
+    # Sets of routes whose trains are often rerouted along each other, in
+    # which the previous stop of a train missing from its own route is
+    # looked up (see static.PrevStops.get_prev_stop)
+    route_groups = []
+
+    def __init__(self, name, endpoint=None, feed_id=1, key_name=None,
+                 subdirectory=None):
+        """ Constructor.
+
+        Arguments
+        ---------
+        name: str
+            Name of dataset, as given to static.py and app.py
+        endpoint: str
+            URL of realtime feed, formatted with the API key and feed ID, or
+            None if the dataset has no realtime feed
+        feed_id: int
+            Feed ID of realtime feed
+        key_name: str
+            Name of the API key of the realtime feed in API_KEYS.py, if any
+        subdirectory: str
+            Subdirectory of the static transit data and the files written by
+            static.py (the name of the dataset by default)
+        """
+        self.name = name
+        self.endpoint = endpoint
+        self.feed_id = feed_id
+        self.key_name = key_name
+
+        if subdirectory is None:
+            subdirectory = name + "/"
+        self.static_transit_dir = STATIC_TRANSIT_DIR + subdirectory
+        self.json_dir = JSON_DIR + subdirectory
+        self.pickle_dir = PICKLE_DIR + subdirectory
+        self._stations = None
+        self._timezone = None
+        self._service_codes = {}
+
+    def __reduce__(self):
+        return get_dataset, (self.name,)
+
+    def get_route_group(self, route):
+        """ Returns the routes that trains of a route are often rerouted
+        along (see route_groups).
+        """
+        for route_group in self.route_groups:
+            if route in route_group:
+                return route_group
+        return ()
+
+    def get_trip_path(self, trip_object):
+        """ Returns the trip path of a trip, which uniquely defines its
+        sequence of stops.
+
+        Arguments
+        ---------
+        trip_object: transitfeed.Trip
+            Trip object
+
+        Returns
+        -------
+        str
+            Trip path of trip
+        """
+        return trip_object.trip_id
+
+    def get_live_trip_id(self, trip_object):
+        """ Returns the trip ID of a trip as given in the realtime feed. """
+        return trip_object.trip_id
+
+    def get_origin_time(self, trip_id):
+        """ Returns the origin time of a trip, in any units that sort the
+        trips of a service day in order of departure, from its trip ID in
+        the realtime feed, or None if trip IDs do not carry it.
+        """
+        return None
+
+    def get_route(self, trip):
+        """ Returns the route ID of a trip of the realtime feed.
+
+        Arguments
+        ---------
+        trip: transit_realtime.TripDescriptor
+            GTFS realtime TripDescriptor object (protobuf)
+
+        Returns
+        -------
+        str
+            Route ID of trip
+        """
+        return trip.route_id
+
+    def get_stop_sequence(self, vehicle):
+        """ Returns the stop sequence of the stop of a vehicle of the
+        realtime feed, as its position along the trip counting from 1 (as
+        static.py numbers stops; see static.PrevStops), or None if it is
+        unknown.
+
+        The current_stop_sequence of the realtime feed is the stop_sequence
+        of stop_times.txt, which need only increase along a trip, so it is
+        not taken as a position unless the dataset numbers stops from 1
+        without gaps.
+
+        Arguments
+        ---------
+        vehicle: transit_realtime.VehiclePosition
+            GTFS realtime VehiclePosition object (protobuf)
+
+        Returns
+        -------
+        int
+            Stop sequence of stop of vehicle, or None
+        """
+        return None
+
+    def get_service_codes(self, trip_object, schedule):
+        """ Returns the service codes (i.e. WKD, SAT or SUN) of the days of
+        the week a trip runs on, from the service period of the trip.
+
+        Arguments
+        ---------
+        trip_object: transitfeed.Trip
+            Trip object
+        schedule: transitfeed.Schedule
+            Schedule object
+
+        Returns
+        -------
+        list[str]
+            Service codes of trip
+        """
+        service_id = trip_object.service_id
+        if service_id not in self._service_codes:
+            period = schedule.GetServicePeriod(service_id)
+            days = set(i for i in xrange(7) if period.day_of_week[i])
+            # Service periods given only by calendar_dates.txt run on the
+            # days of the week of their dates
+            if not days:
+                days = set(_get_weekday(day) for day in period.ActiveDates())
+
+            service_codes = []
+            if days & set(xrange(5)):
+                service_codes.append(WEEKDAY_SERVICE_CODE)
+            if 5 in days:
+                service_codes.append(SAT_SERVICE_CODE)
+            if 6 in days:
+                service_codes.append(SUN_SERVICE_CODE)
+            self._service_codes[service_id] = service_codes
+
+        return self._service_codes[service_id]
+
+    def get_line(self, trip_object):
+        """ Returns the line of a trip in the trip sequences table (see
+        static.get_trip_sequences), or None if it has no line.
+        """
+        return self.get_trip_path(trip_object)
+
+    def has_shape(self, trip_object):
+        """ Returns whether the stops of a trip lie along the shapes of the
+        dataset.
+        """
+        return True
+
+    def get_shape_colors(self, schedule):
+        """ Returns map of shape ID -> color of the route traveling each
+        shape (the last in the route list, if several do), as "#RRGGBB".
+
+        Arguments
+        ---------
+        schedule: transitfeed.Schedule
+            Schedule object
+
+        Returns
+        -------
+        dict[str -> str]
+            Map of shape ID -> route color
+        """
+        shape_colors = {}
+        for route_object in schedule.GetRouteList():
+            for trip_object in route_object.trips:
+                if trip_object.shape_id:
+                    shape_colors[trip_object.shape_id] = \
+                        "#" + route_object.route_color
+
+        return shape_colors
+
+    def get_stop_coordinates(self, stop_object):
+        """ Returns the (lon, lat) coordinates of a stop. """
+        return (stop_object.stop_lon, stop_object.stop_lat)
+
+    def get_station_coordinates(self, stop_object):
+        """ Returns the (lon, lat) coordinates of a station along the shapes
+        containing it.
+        """
+        return self.get_stop_coordinates(stop_object)
+
+    def get_station_id(self, stop_id):
+        """ Returns the station ID of a stop ID of the realtime feed: its
+        parent station if it has one (see static.parse_stops), and
+        otherwise the stop ID itself.
+        """
+        if self._stations is None:
+            try:
+                with open(self.pickle_dir + STATIONS_FILE, "rb") as \
+                        stations_f:
+                    self._stations = pickle.load(stations_f)
+            except IOError:
+                self._stations = {}
+
+        return self._stations.get(stop_id, stop_id)
+
+    def get_timezone(self):
+        """ Returns the time zone of the agency of the dataset, in which
+        times of the schedule (and service days) are given.
+
+        Returns
+        -------
+        pytz.tzinfo.BaseTzInfo
+            Time zone of dataset
+        """
+        if self._timezone is None:
+            try:
+                with open(self.pickle_dir + TIMEZONE_FILE) as timezone_f:
+                    timezone = timezone_f.read().strip()
+            except IOError:
+                timezone = DEFAULT_TIMEZONE
+            self._timezone = pytz.timezone(timezone)
+
+        return self._timezone
+
+    def clear_cache(self):
+        """ Forgets the station IDs and time zone read from the files of
+        static.py, so that they are read again when next needed (e.g. once
+        static.py has written a new version).
+        """
+        self._stations = None
+        self._timezone = None
+
+    def get_direction(self, stop_id):
+        """ Returns the direction of a platform stop ID of the realtime feed,
+        which tells apart the platforms of its station (see get_station_id);
+        stop IDs that do not carry a direction are their own direction.
+        """
+        return stop_id
+
+
+class NYCTSubway(Dataset):
+    """ NYCTSubway class.
+
+    Adapts the static data and realtime feed of the NYC subway. Trip IDs
+    of the static data are of the form "A20161106WKD_030048_1..N03R", of
+    a service ID ending in its service code, an origin time in hundredths
+    of a minute past midnight and a trip path, and the realtime feed omits
+    the service ID; platform stop IDs are the stop ID of their station
+    suffixed by their direction (N or S).
+    """
+    route_groups = ROUTE_GROUPS
+
+    def __init__(self):
+        """ Constructor. """
+        Dataset.__init__(self, "subway", MTA_ENDPOINT, 1, "mta_key", "")
+
+    def get_trip_path(self, trip_object):
+        return trip_object.trip_id.rsplit("_", 1)[1]
+
+    def get_live_trip_id(self, trip_object):
+        return trip_object.trip_id.split("_", 1)[1]
+
+    def get_origin_time(self, trip_id):
+        return trip_id.split("_")[0]
+
+    def get_route(self, trip):
+        return trip.trip_id.split("_")[1].split(".")[0]
+
+    def get_stop_sequence(self, vehicle):
+        # Stops are numbered from 1 without gaps
+        return vehicle.current_stop_sequence
+
+    def get_service_codes(self, trip_object, schedule):
+        return [trip_object.service_id[-3:]]
+
+    def get_line(self, trip_object):
+        trip_id = trip_object.trip_id
+        ind = trip_id.rfind(".")
+        if ind == -1:
+            return None
+        # Note that the conditional expression binds loosest, so that this
+        # is (trip_id[ind - 2] + "") if ... else (trip_id[ind - 1] +
+        # trip_id[ind + 1]); the keys are kept as they have always been.
+        return trip_id[ind - 2] + \
+            "" if trip_id[ind - 1] == "." \
+            else trip_id[ind - 1] + \
+            trip_id[ind + 1]
+
+    def has_shape(self, trip_object):
+        return self.get_trip_path(trip_object) not in SECOND_AVE_PATHS
+
+    def get_shape_colors(self, schedule):
+        # Shape IDs begin with the route they belong to
+        route_colors = {
+            route_object.route_id[0]: "#" + route_object.route_color
+            for route_object in schedule.GetRouteList()
+        }
+        return {
+            shape_object.shape_id: route_colors[shape_object.shape_id[0]]
+            for shape_object in schedule.GetShapeList()
+            if shape_object.shape_id[0] in route_colors
+        }
+
+    def get_stop_coordinates(self, stop_object):
+        coordinates = (stop_object.stop_lon, stop_object.stop_lat)
+        if coordinates == NEW_SOUTH_FERRY:
+            return OLD_SOUTH_FERRY
+        else:
+            return coordinates
+
+    def get_station_coordinates(self, stop_object):
+        if stop_object.stop_id == YORK_STREET_ID:
+            return YORK_STREET_APPROX
+        else:
+            return self.get_stop_coordinates(stop_object)
+
+    def get_station_id(self, stop_id):
+        return stop_id[:-1]
+
+    def get_direction(self, stop_id):
+        return stop_id[-1]
+
+
+def _get_weekday(day):
+    """ Returns the day of the week (0 for Monday) of a YYYYMMDD date. """
+    return date(int(day[:4]), int(day[4:6]), int(day[6:])).weekday()
+
+
+# Datasets by name. Datasets other than the subway have no realtime feed
+# configured; pass the URL of their feed to app.py with --endpoint, or
+# serve them with --schedule only.
+DATASETS = {}
+
+
+def register(dataset):
+    """ Adds a dataset to DATASETS. """
+    DATASETS[dataset.name] = dataset
+
+
+def get_dataset(name):
+    """ Returns the dataset of a name, or raises a KeyError if there is no
+    such dataset.
+    """
+    return DATASETS[name]
+
+
+register(NYCTSubway())
+register(Dataset("lirr"))
+register(Dataset("mnr"))
+register(Dataset("bus"))
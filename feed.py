@@ -1,66 +1,548 @@
+import time
+
+from array import array
+from collections import namedtuple
+
 from eventlet.greenthread import sleep, spawn
 import requests
-import transitfeed
 
-from API_KEYS import mta_key
+import API_KEYS
 
+import datasets
 import gtfs_realtime_pb2 as gtfs
+import metrics
 
 
-MTA_ENDPOINT = "http://datamine.mta.info/mta_esi.php?key={}&feed_id=1" \
-    .format(mta_key)
+POLL_INTERVAL = 30
 
 current_feed = None
+# Dataset whose realtime feed is retrieved and processed (see datasets.py)
+dataset = datasets.get_dataset(datasets.DEFAULT_DATASET)
+# Function of feed ID -> raw FeedMessage bytes used to retrieve feeds; can be
+# replaced (e.g. by a replay.FeedReplay) to run without the MTA.
+transport = None
+# If set, a replay.FeedRecorder that every retrieved feed is recorded to.
+recorder = None
 
+FETCH_SECONDS = metrics.Histogram(
+    "livesubway_feed_fetch_seconds",
+    "Time to retrieve a feed",
+    ["feed_id"]
+)
+FETCH_ERRORS = metrics.Counter(
+    "livesubway_feed_fetch_errors_total",
+    "Feeds that could not be retrieved or parsed",
+    ["feed_id"]
+)
+PAYLOAD_BYTES = metrics.Histogram(
+    "livesubway_feed_payload_bytes",
+    "Size of retrieved feeds",
+    ["feed_id"],
+    buckets=(1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7)
+)
+PARSE_SECONDS = metrics.Histogram(
+    "livesubway_feed_parse_seconds",
+    "Time to parse a retrieved feed",
+    ["feed_id"]
+)
+FEED_AGE = metrics.Gauge(
+    "livesubway_feed_age_seconds",
+    "Time since the header timestamp of the latest feed",
+    ["feed_id"]
+)
+DECODE_FALLBACKS = metrics.Counter(
+    "livesubway_feed_decode_fallbacks_total",
+    "Feeds decoded by the full protobuf parser after the selective " +
+    "decoder failed",
+    ["feed_id"]
+)
 
-class train_id_hash():
-    trip_hash = {}
+# Lightweight rows of the vehicles of a feed, with the same attributes as the
+# protobuf objects that static.PrevStops reads.
+Trip = namedtuple('Trip', ['trip_id', 'start_date', 'route_id'])
+Vehicle = namedtuple('Vehicle', ['trip', 'stop_id', 'current_stop_sequence'])
+
+# Wire types of protobuf fields
+_VARINT = 0
+_FIXED64 = 1
+_BYTES = 2
+_FIXED32 = 5
 
-    def __init__(self):
-        print "Initializing train_id_hash object..."
-        tt = transitfeed.Loader("./static_transit")
-        tf = tt.Load()
-        print "Finished loading Loader"
-        train_trips = tf.GetTripList()
-        for trip in train_trips:
-            ind = trip.trip_id.rfind(".")
-            if ind == -1:
-                print "Error with tripID"
-                continue
-            line = trip.trip_id[ind - 2] + \
-                "" if trip.trip_id[ind - 1] == "." \
-                else trip.trip_id[ind - 1] + \
-                trip.trip_id[ind + 1]
-            if line not in self.trip_hash:
-                st = trip.GetStopTimes()
-                self.trip_hash[line] = [None] * (len(st) + 1)
-                for train_stop in st:
-                    self.trip_hash[line][(int)(train_stop.stop_sequence)] = \
-                        (train_stop.stop.stop_id, train_stop.stop.stop_name)
 
-    def getPrevStop(self, route_id, stop_sequence):
-        return self.trip_hash[route_id][stop_sequence]
+def _tag(field_number, wire_type):
+    return field_number << 3 | wire_type
 
 
-def start_timer():
-    return spawn(feed_timer)
+# Tags of the fields of a FeedMessage read by decode_feed; every other field
+# (including the NYCT extensions) is skipped without being decoded.
+_FEED_HEADER = _tag(1, _BYTES)
+_FEED_ENTITY = _tag(2, _BYTES)
+_HEADER_TIMESTAMP = _tag(3, _VARINT)
+_ENTITY_TRIP_UPDATE = _tag(3, _BYTES)
+_ENTITY_VEHICLE = _tag(4, _BYTES)
+_TRIP_UPDATE_TRIP = _tag(1, _BYTES)
+_TRIP_UPDATE_STOP_TIME_UPDATE = _tag(2, _BYTES)
+_STOP_TIME_UPDATE_ARRIVAL = _tag(2, _BYTES)
+_STOP_TIME_UPDATE_STOP_ID = _tag(4, _BYTES)
+_STOP_TIME_EVENT_TIME = _tag(2, _VARINT)
+_VEHICLE_TRIP = _tag(1, _BYTES)
+_VEHICLE_STOP_SEQUENCE = _tag(3, _VARINT)
+_VEHICLE_STOP_ID = _tag(7, _BYTES)
+_TRIP_ID = _tag(1, _BYTES)
+_TRIP_START_DATE = _tag(3, _BYTES)
+_TRIP_ROUTE_ID = _tag(5, _BYTES)
 
 
-def feed_timer():
+def start_timer(interval=POLL_INTERVAL, callback=None):
+    return spawn(feed_timer, interval, callback)
+
+
+def feed_timer(interval=POLL_INTERVAL, callback=None):
     while True:
         global current_feed
-        current_feed = spawn(get_feed).wait()
-        sleep(30)
+        try:
+            current_feed = spawn(get_feed).wait()
+        except Exception as e:
+            FETCH_ERRORS.labels(dataset.feed_id).inc()
+            print "Failed to retrieve feed: {}".format(e)
+        else:
+            if callback is not None:
+                callback(current_feed)
+        sleep(interval)
+
+
+class FeedColumns:
+    """ FeedColumns class.
+
+    Holds only the fields of a feed needed to render subway cars, stored by
+    column rather than as a tree of protobuf objects. Vehicles and trip
+    updates each have their own rows; the stop time updates of trip update
+    i are rows update_offsets[i] to update_offsets[i + 1] of the stop time
+    update columns. Missing fields take the protobuf defaults ("" or 0).
+    """
+    def __init__(self):
+        self.timestamp = 0
+
+        self.vehicle_trip_ids = []
+        self.vehicle_start_dates = []
+        self.vehicle_routes = []
+        self.vehicle_stop_ids = []
+        self.vehicle_stop_sequences = array("l")
+
+        self.update_trip_ids = []
+        self.update_start_dates = []
+        self.update_routes = []
+        self.update_offsets = array("l", [0])
+
+        self.stop_ids = []
+        self.arrival_times = array("l")
+
+    def get_vehicles(self):
+        """ Returns list of vehicles of the feed, as Vehicle rows. """
+        return [Vehicle(Trip(trip_id, start_date, route_id), stop_id,
+                        stop_sequence)
+                for trip_id, start_date, route_id, stop_id, stop_sequence
+                in zip(self.vehicle_trip_ids, self.vehicle_start_dates,
+                       self.vehicle_routes, self.vehicle_stop_ids,
+                       self.vehicle_stop_sequences)]
+
+    def get_upcoming_stops(self):
+        """ Returns map of trip ID -> stop IDs of the stop time updates of
+        its trip update.
+        """
+        offsets = self.update_offsets
+        return {
+            trip_id: self.stop_ids[offsets[i]:offsets[i + 1]]
+            for i, trip_id in enumerate(self.update_trip_ids)
+        }
+
+    def get_trips(self):
+        """ Returns map of trip ID -> [route, [stop ID, ...], [arrival time,
+        ...]] of the stop time updates of its trip update.
+        """
+        offsets = self.update_offsets
+        return {
+            trip_id: [self.update_routes[i],
+                      self.stop_ids[offsets[i]:offsets[i + 1]],
+                      self.arrival_times[offsets[i]:offsets[i + 1]].tolist()]
+            for i, trip_id in enumerate(self.update_trip_ids)
+        }
+
+    def get_next_arrival_times(self):
+        """ Returns map of trip ID -> arrival time at the first stop of its
+        trip update, for trip updates with any stop time updates.
+        """
+        offsets = self.update_offsets
+        arrival_times = self.arrival_times
+        return {
+            trip_id: arrival_times[offsets[i]]
+            for i, trip_id in enumerate(self.update_trip_ids)
+            if offsets[i] < offsets[i + 1]
+        }
+
+
+def _read_varint(data, pos):
+    """ Returns the varint at a position of a buffer, and the position
+    following it.
+    """
+    byte = ord(data[pos])
+    if byte < 0x80:
+        return byte, pos + 1
+
+    result = byte & 0x7f
+    shift = 7
+    pos += 1
+    while True:
+        byte = ord(data[pos])
+        result |= (byte & 0x7f) << shift
+        pos += 1
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 70:
+            raise ValueError("Malformed varint")
+
+
+def _iter_fields(data, pos, end):
+    """ Yields the fields of a message spanning data[pos:end] as (tag, value,
+    pos), where value is the value of varint fields, or the start of the
+    contents of length-delimited fields, and pos is the position following
+    the field. Fixed-width fields are skipped.
+    """
+    while pos < end:
+        # Tags and lengths mostly fit in a single byte, so that case is
+        # decoded inline rather than by _read_varint.
+        tag = ord(data[pos])
+        if tag < 0x80:
+            pos += 1
+        else:
+            tag, pos = _read_varint(data, pos)
+
+        wire_type = tag & 7
+        if wire_type == _BYTES:
+            length = ord(data[pos])
+            if length < 0x80:
+                value = pos + 1
+            else:
+                length, value = _read_varint(data, pos)
+            pos = value + length
+        elif wire_type == _VARINT:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == _FIXED64:
+            pos += 8
+            continue
+        elif wire_type == _FIXED32:
+            pos += 4
+            continue
+        else:
+            raise ValueError("Unsupported wire type {}".format(wire_type))
+
+        if pos > end:
+            raise ValueError("Truncated message")
+        yield tag, value, pos
+
+    if pos != end:
+        raise ValueError("Truncated message")
+
+
+def _decode_trip(data, pos, end):
+    """ Returns trip ID, start date and route ID of a TripDescriptor. """
+    trip_id = start_date = route_id = ""
+    for tag, value, pos in _iter_fields(data, pos, end):
+        if tag == _TRIP_ID:
+            trip_id = data[value:pos]
+        elif tag == _TRIP_START_DATE:
+            start_date = data[value:pos]
+        elif tag == _TRIP_ROUTE_ID:
+            route_id = data[value:pos]
+
+    return trip_id, start_date, route_id
+
+
+def _decode_trip_update(data, pos, end, columns):
+    trip = ("", "", "")
+    for tag, value, pos in _iter_fields(data, pos, end):
+        if tag == _TRIP_UPDATE_TRIP:
+            trip = _decode_trip(data, value, pos)
+        elif tag == _TRIP_UPDATE_STOP_TIME_UPDATE:
+            stop_id = ""
+            arrival_time = 0
+            for stop_tag, stop_value, stop_pos in _iter_fields(
+                    data, value, pos):
+                if stop_tag == _STOP_TIME_UPDATE_STOP_ID:
+                    stop_id = data[stop_value:stop_pos]
+                elif stop_tag == _STOP_TIME_UPDATE_ARRIVAL:
+                    for time_tag, time_value, _ in _iter_fields(
+                            data, stop_value, stop_pos):
+                        if time_tag == _STOP_TIME_EVENT_TIME:
+                            # int64 fields are encoded in two's complement
+                            if time_value >= 1 << 63:
+                                time_value -= 1 << 64
+                            arrival_time = time_value
+            columns.stop_ids.append(stop_id)
+            columns.arrival_times.append(arrival_time)
+
+    trip_id, start_date, route_id = trip
+    columns.update_trip_ids.append(trip_id)
+    columns.update_start_dates.append(start_date)
+    columns.update_routes.append(route_id)
+    columns.update_offsets.append(len(columns.stop_ids))
+
+
+def _decode_vehicle(data, pos, end, columns):
+    trip = ("", "", "")
+    stop_id = ""
+    stop_sequence = 0
+    for tag, value, pos in _iter_fields(data, pos, end):
+        if tag == _VEHICLE_TRIP:
+            trip = _decode_trip(data, value, pos)
+        elif tag == _VEHICLE_STOP_ID:
+            stop_id = data[value:pos]
+        elif tag == _VEHICLE_STOP_SEQUENCE:
+            stop_sequence = value
+
+    trip_id, start_date, route_id = trip
+    columns.vehicle_trip_ids.append(trip_id)
+    columns.vehicle_start_dates.append(start_date)
+    columns.vehicle_routes.append(route_id)
+    columns.vehicle_stop_ids.append(stop_id)
+    columns.vehicle_stop_sequences.append(stop_sequence)
+
+
+def _decode_columns(data):
+    """ Decodes the fields of a raw FeedMessage needed by FeedColumns
+    directly from the protobuf wire format.
+    """
+    columns = FeedColumns()
+    for tag, value, pos in _iter_fields(data, 0, len(data)):
+        if tag == _FEED_HEADER:
+            for header_tag, header_value, _ in _iter_fields(data, value, pos):
+                if header_tag == _HEADER_TIMESTAMP:
+                    columns.timestamp = header_value
+        elif tag == _FEED_ENTITY:
+            for entity_tag, entity_value, entity_pos in _iter_fields(
+                    data, value, pos):
+                if entity_tag == _ENTITY_TRIP_UPDATE:
+                    _decode_trip_update(data, entity_value, entity_pos,
+                                        columns)
+                elif entity_tag == _ENTITY_VEHICLE:
+                    _decode_vehicle(data, entity_value, entity_pos, columns)
+
+    return columns
+
 
+def get_columns(feed_message):
+    """ Returns the FeedColumns of a parsed FeedMessage.
 
-def get_feed():
+    Arguments
+    ---------
+    feed_message: transit_realtime.FeedMessage
+        GTFS realtime FeedMessage object (protobuf)
+
+    Returns
+    -------
+    FeedColumns
+        Columns of feed
+    """
+    columns = FeedColumns()
+    columns.timestamp = feed_message.header.timestamp
+
+    for entity in feed_message.entity:
+        if entity.HasField("trip_update"):
+            trip = entity.trip_update.trip
+            columns.update_trip_ids.append(trip.trip_id)
+            columns.update_start_dates.append(trip.start_date)
+            columns.update_routes.append(trip.route_id)
+            for stop_time_update in entity.trip_update.stop_time_update:
+                columns.stop_ids.append(stop_time_update.stop_id)
+                columns.arrival_times.append(stop_time_update.arrival.time)
+            columns.update_offsets.append(len(columns.stop_ids))
+
+        if entity.HasField("vehicle"):
+            vehicle = entity.vehicle
+            columns.vehicle_trip_ids.append(vehicle.trip.trip_id)
+            columns.vehicle_start_dates.append(vehicle.trip.start_date)
+            columns.vehicle_routes.append(vehicle.trip.route_id)
+            columns.vehicle_stop_ids.append(vehicle.stop_id)
+            columns.vehicle_stop_sequences.append(
+                vehicle.current_stop_sequence)
+
+    return columns
+
+
+def decode_feed(raw_gtfs):
+    """ Decodes the fields of a raw feed needed to render subway cars.
+
+    The fields are read straight from the wire format in a single pass,
+    without building the full message tree. If the selective decoder fails,
+    the feed is parsed with the full protobuf parser instead, which either
+    validates the feed or raises a DecodeError.
+
+    Arguments
+    ---------
+    raw_gtfs: str
+        Serialized GTFS realtime FeedMessage
+
+    Returns
+    -------
+    tuple[FeedColumns, bool]
+        Columns of feed, and whether the full protobuf parser was used
+    """
+    try:
+        return _decode_columns(raw_gtfs), False
+    except (IndexError, ValueError):
+        feed_message = gtfs.FeedMessage()
+        feed_message.ParseFromString(raw_gtfs)
+        return get_columns(feed_message), True
+
+
+def fetch_feed(feed_id):
+    key = getattr(API_KEYS, dataset.key_name) if dataset.key_name else ""
+    return requests.get(dataset.endpoint.format(key, feed_id)).content
+
+
+def load_feed(feed_id=None):
+    """ Retrieves and parses a feed.
+
+    This does not record any metrics, so that it can run in a worker
+    process; the returned statistics are recorded with record_stats.
+
+    Arguments
+    ---------
+    feed_id: int
+        Feed ID of feed (that of the dataset by default)
+
+    Returns
+    -------
+    tuple[FeedColumns, dict[str -> float]]
+        Columns of feed (see decode_feed), and map of statistic -> value of
+        fetch_seconds, payload_bytes, parse_seconds, timestamp and
+        fallback (1 if the full protobuf parser was used, otherwise 0)
+    """
+    if feed_id is None:
+        feed_id = dataset.feed_id
+    start = time.time()
+    raw_gtfs = (transport or fetch_feed)(feed_id)
+    fetched = time.time()
+    if recorder is not None:
+        recorder.record(feed_id, raw_gtfs)
+
+    columns, fallback = decode_feed(raw_gtfs)
+
+    return columns, {
+        "fetch_seconds": fetched - start,
+        "payload_bytes": len(raw_gtfs),
+        "parse_seconds": time.time() - fetched,
+        "timestamp": columns.timestamp,
+        "fallback": int(fallback)
+    }
+
+
+def record_stats(feed_id, stats):
+    timestamp = stats["timestamp"]
+    FETCH_SECONDS.labels(feed_id).observe(stats["fetch_seconds"])
+    PAYLOAD_BYTES.labels(feed_id).observe(stats["payload_bytes"])
+    PARSE_SECONDS.labels(feed_id).observe(stats["parse_seconds"])
+    FEED_AGE.labels(feed_id).set_function(lambda: time.time() - timestamp)
+    DECODE_FALLBACKS.labels(feed_id).inc(stats.get("fallback", 0))
+
+
+def get_feed(feed_id=None):
+    if feed_id is None:
+        feed_id = dataset.feed_id
     print "Retrieving feed..."
-    raw_gtfs = requests.get(MTA_ENDPOINT)
-    new_feed = gtfs.FeedMessage()
-    new_feed.ParseFromString(raw_gtfs.content)
+    new_feed, stats = load_feed(feed_id)
+    record_stats(feed_id, stats)
     print "Retrieved feed."
     return new_feed
 
+
+def get_station_id(stop_id):
+    # e.g. platform stop IDs of the subway are the stop ID of the parent
+    # station suffixed by the direction of the platform (N or S).
+    return dataset.get_station_id(stop_id)
+
+
+def get_timezone():
+    # Time zone of the schedule, in which service days begin
+    return dataset.get_timezone()
+
+
+def get_direction(stop_id):
+    # e.g. N or S for platform stop IDs of the subway
+    return dataset.get_direction(stop_id)
+
+
+def get_path(graph, prev_stop, stop, shapes):
+    # Path between the stations of two stop IDs (see static.StopGraph.
+    # get_path), recording whether it was cached.
+    start = get_station_id(prev_stop)
+    end = get_station_id(stop)
+    metrics.record_cache("stop_graph_paths",
+                         graph.has_cached_path(start, end))
+    return graph.get_path(start, end, shapes)
+
+
+def get_vehicles(columns, graph, prev_stops, shapes):
+    """ Returns the subway cars to render for a feed.
+
+    Each subway car is rendered along the path from its previous stop to
+    its next stop; subway cars for which no path can be found (e.g. at the
+    beginning of their trip, or on stops missing from the static data) are
+    skipped.
+
+    Arguments
+    ---------
+    columns: FeedColumns
+        Columns of feed (see decode_feed)
+    graph: static.StopGraph
+        StopGraph object
+    prev_stops: static.PrevStops
+        PrevStops object
+    shapes: dict
+        Contents of shapes.json
+
+    Returns
+    -------
+    list[dict]
+        List of subway cars of the form {
+            trip_id: trip ID,
+            route: route ID,
+            prev_stop: stop ID of previous stop,
+            stop: stop ID of next stop,
+            path: [[lon, lat], ...] from previous stop to next stop,
+            progress: fraction of path already traveled,
+            remaining_time: seconds until arrival at next stop
+        }
+    """
+    timestamp = columns.timestamp
+    arrival_times = columns.get_next_arrival_times()
+    upcoming_stops = columns.get_upcoming_stops()
+    vehicles = []
+
+    for vehicle in columns.get_vehicles():
+        try:
+            prev_stop = prev_stops.get_prev_stop(
+                vehicle, upcoming_stops.get(vehicle.trip.trip_id))
+            if prev_stop is None:
+                continue
+            path = get_path(graph, prev_stop, vehicle.stop_id, shapes)
+        except KeyError:
+            continue
+
+        arrival_time = arrival_times.get(vehicle.trip.trip_id, timestamp)
+        vehicles.append({
+            "trip_id": vehicle.trip.trip_id,
+            "route": vehicle.trip.route_id,
+            "prev_stop": prev_stop,
+            "stop": vehicle.stop_id,
+            "path": path,
+            "progress": 0,
+            "remaining_time": max(arrival_time - timestamp, 0)
+        })
+
+    return vehicles
+
 # testing API usage
 # for entity in feed.entity:
 #     if (entity.trip_update.trip.HasExtension(nyct.nyct_trip_descriptor)):
@@ -0,0 +1,132 @@
+from array import array
+
+from feed import get_direction, get_station_id
+
+# Number of most recent headways kept per route, direction and station
+RING_SIZE = 10
+# A train is bunched if it left a station less than this fraction of the
+# median headway after the previous train of its route and direction
+BUNCHING_RATIO = 0.25
+# Number of earlier headways required before trains are flagged as bunched
+MIN_BUNCHING_SAMPLES = 3
+
+
+class _Headways:
+    """ Departures from a station of a route and direction. """
+    def __init__(self, ring_size):
+        self.last_departure = None
+        self.last_trip_id = None
+        self.headways = array("f")
+        self.index = 0
+        self.ring_size = ring_size
+
+    def add(self, seconds):
+        if len(self.headways) < self.ring_size:
+            self.headways.append(seconds)
+        else:
+            self.headways[self.index] = seconds
+        self.index = (self.index + 1) % self.ring_size
+
+
+class HeadwayTracker:
+    """ HeadwayTracker class.
+
+    Used primarily to follow the headways of each route at each station as
+    trains leave it. Each route, direction and station keeps the time of
+    its last departure and its most recent headways in a ring buffer, so
+    that memory is bounded by the number of stations served, and each tick
+    only updates the stations that trains left since the previous tick.
+    """
+    def __init__(self, ring_size=RING_SIZE, bunching_ratio=BUNCHING_RATIO):
+        """ Constructor.
+
+        Arguments
+        ---------
+        ring_size: int
+            Number of headways kept per route, direction and station
+        bunching_ratio: float
+            Fraction of the median headway below which a train is bunched
+        """
+        self.ring_size = ring_size
+        self.bunching_ratio = bunching_ratio
+        self._headways = {}
+
+    def add_departures(self, departures):
+        """ Adds departures of trains from stations.
+
+        Arguments
+        ---------
+        departures: list[tuple[str, str, str, int]]
+            List of (trip ID, route ID, stop ID of platform, time) of each
+            departure, in order of time (see
+            travel_times.TravelTimeModel.update)
+
+        Returns
+        -------
+        list[dict]
+            Headways of each route, direction and station departed from
+            (see get_entry)
+        """
+        updated = {}
+        for trip_id, route, stop_id, timestamp in departures:
+            key = (route, stop_id)
+            headways = self._headways.get(key)
+            if headways is None:
+                headways = self._headways[key] = _Headways(self.ring_size)
+
+            bunched = False
+            if headways.last_departure is not None:
+                headway = timestamp - headways.last_departure
+                if len(headways.headways) >= MIN_BUNCHING_SAMPLES:
+                    bunched = headway < self.bunching_ratio * \
+                        self._median(headways.headways)
+                headways.add(headway)
+            headways.last_departure = timestamp
+            headways.last_trip_id = trip_id
+
+            updated[key] = self.get_entry(route, stop_id, headways, bunched)
+
+        return updated.values()
+
+    @staticmethod
+    def _median(values):
+        return sorted(values)[len(values) // 2]
+
+    def get_entry(self, route, stop_id, headways, bunched):
+        """ Returns the headways of a route at a platform.
+
+        Returns
+        -------
+        dict
+            Headways of the form {
+                route: route ID,
+                direction: direction of platform (N or S for the subway),
+                station: station ID,
+                last_departure: time of last departure,
+                last_trip_id: trip ID of last departure,
+                headway: seconds between the last two departures,
+                median_headway: median of recent headways,
+                mean_headway: mean of recent headways,
+                samples: number of recent headways,
+                bunched: whether the last train left less than the
+                    bunching ratio of the median headway after the one
+                    before it
+            }
+        """
+        samples = headways.headways
+        last_headway = None
+        if samples:
+            last_headway = samples[(headways.index - 1) % len(samples)]
+
+        return {
+            "route": route,
+            "direction": get_direction(stop_id),
+            "station": get_station_id(stop_id),
+            "last_departure": headways.last_departure,
+            "last_trip_id": headways.last_trip_id,
+            "headway": last_headway,
+            "median_headway": self._median(samples) if samples else None,
+            "mean_headway": sum(samples) / len(samples) if samples else None,
+            "samples": len(samples),
+            "bunched": bunched
+        }
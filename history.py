@@ -0,0 +1,284 @@
+import json
+import os
+import struct
+import time
+
+from array import array
+from bisect import bisect_left
+
+# History is stored in a directory of hourly partitions (in UTC), each an
+# append-only data file of chunks and an index file of the timestamp and
+# offset of every chunk. A chunk holds the subway cars of one tick: a
+# CHUNK_HEADER (tick timestamp, number of rows and length of metadata),
+# JSON metadata, and the columns of COLUMNS one after another.
+#
+# Strings are dictionary-encoded per chunk: string columns hold indices into
+# the chunk's list of strings. Rows are sorted by route, and the metadata
+# maps each route to its range of rows, so that the rows of a route are
+# read without reading the rest of the chunk. Columns are in native byte
+# order, so history is only readable on machines of the same endianness.
+DATA_SUFFIX = ".dat"
+INDEX_SUFFIX = ".idx"
+PARTITION_FORMAT = "%Y%m%d%H"
+PARTITION_SECONDS = 3600
+CHUNK_HEADER = struct.Struct("<qII")
+INDEX_RECORD = struct.Struct("<qQ")
+# Name and array typecode of each column; every typecode is 4 bytes, so
+# that the offset of a column is its position times the number of rows.
+COLUMNS = (
+    ("trip_id", "I"),
+    ("route", "I"),
+    ("prev_stop", "I"),
+    ("stop", "I"),
+    ("progress", "f"),
+    ("remaining_time", "i")
+)
+STRING_COLUMNS = ("trip_id", "route", "prev_stop", "stop")
+ITEM_SIZE = 4
+
+
+def get_partition(timestamp):
+    """ Returns the name of the hourly partition of a timestamp. """
+    return time.strftime(PARTITION_FORMAT, time.gmtime(timestamp))
+
+
+class HistoryWriter:
+    """ HistoryWriter class.
+
+    Used primarily to record the subway cars of every tick, so that past
+    positions can be queried and played back.
+    """
+    def __init__(self, directory):
+        """ Constructor.
+
+        Arguments
+        ---------
+        directory: str
+            Directory of history; created if it does not exist, and
+            appended to otherwise
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self._partition = None
+        self._data_f = None
+        self._index_f = None
+        self._last_timestamp = None
+
+    def _open(self, partition):
+        self.close()
+        path = os.path.join(self.directory, partition)
+        self._data_f = open(path + DATA_SUFFIX, "ab")
+        self._index_f = open(path + INDEX_SUFFIX, "ab")
+        self._partition = partition
+
+        # Appending to an existing partition continues after its last tick;
+        # an incomplete trailing record (e.g. if the writer was killed
+        # mid-write) is cut off.
+        size = os.path.getsize(path + INDEX_SUFFIX)
+        size -= size % INDEX_RECORD.size
+        self._index_f.truncate(size)
+        if size > 0:
+            with open(path + INDEX_SUFFIX, "rb") as index_f:
+                index_f.seek(size - INDEX_RECORD.size)
+                last_timestamp, _ = INDEX_RECORD.unpack(
+                    index_f.read(INDEX_RECORD.size))
+            if self._last_timestamp is None or \
+                    last_timestamp > self._last_timestamp:
+                self._last_timestamp = last_timestamp
+
+    def append(self, tick):
+        """ Appends the subway cars of a tick to the history.
+
+        Ticks no newer than the last tick appended are skipped (e.g. if the
+        feed has not been updated since it was last retrieved), so that the
+        history is in order of timestamp.
+
+        Arguments
+        ---------
+        tick: dict
+            Tick of subway cars (see app.process_feed)
+
+        Returns
+        -------
+        bool
+            Whether the tick was appended
+        """
+        timestamp = tick["timestamp"]
+        partition = get_partition(timestamp)
+        if partition != self._partition:
+            self._open(partition)
+        if self._last_timestamp is not None and \
+                timestamp <= self._last_timestamp:
+            return False
+
+        vehicles = sorted(tick["vehicles"], key=lambda vehicle:
+                          vehicle["route"])
+        strings = {}
+        routes = {}
+        columns = {name: array(typecode) for name, typecode in COLUMNS}
+
+        for i, vehicle in enumerate(vehicles):
+            for name in STRING_COLUMNS:
+                columns[name].append(strings.setdefault(vehicle[name],
+                                                        len(strings)))
+            columns["progress"].append(vehicle["progress"])
+            columns["remaining_time"].append(int(vehicle["remaining_time"]))
+            routes.setdefault(vehicle["route"], [i, i])[1] = i + 1
+
+        metadata = json.dumps({
+            "strings": sorted(strings, key=strings.get),
+            "routes": routes
+        })
+        chunk = CHUNK_HEADER.pack(timestamp, len(vehicles), len(metadata)) + \
+            metadata + "".join(columns[name].tostring()
+                               for name, _ in COLUMNS)
+
+        # The chunk is written before it is indexed, so that readers only
+        # see complete chunks.
+        self._data_f.seek(0, os.SEEK_END)
+        offset = self._data_f.tell()
+        self._data_f.write(chunk)
+        self._data_f.flush()
+        self._index_f.write(INDEX_RECORD.pack(timestamp, offset))
+        self._index_f.flush()
+        self._last_timestamp = timestamp
+
+        return True
+
+    def close(self):
+        """ Closes the files of the current partition. """
+        if self._data_f is not None:
+            self._data_f.close()
+            self._index_f.close()
+            self._data_f = self._index_f = None
+            self._partition = None
+
+
+class HistoryReader:
+    """ HistoryReader class.
+
+    Used primarily to query the subway cars recorded by a HistoryWriter
+    over a window of time. Only the index of each hourly partition in the
+    window is loaded; chunks are read one at a time, and only the rows of
+    the requested routes.
+    """
+    def __init__(self, directory):
+        """ Constructor.
+
+        Arguments
+        ---------
+        directory: str
+            Directory of history
+        """
+        self.directory = directory
+
+    def _read_index(self, partition):
+        """ Returns the timestamps and offsets of the chunks of a
+        partition.
+        """
+        try:
+            with open(os.path.join(self.directory, partition) +
+                      INDEX_SUFFIX, "rb") as index_f:
+                data = index_f.read()
+        except IOError:
+            return [], []
+
+        # An incomplete trailing record is ignored
+        records = [INDEX_RECORD.unpack_from(data, i) for i in
+                   xrange(0, len(data) - INDEX_RECORD.size + 1,
+                          INDEX_RECORD.size)]
+        return [timestamp for timestamp, _ in records], \
+            [offset for _, offset in records]
+
+    @staticmethod
+    def _read_chunk(data_f, offset, routes):
+        """ Returns the timestamp and rows of the chunk at an offset, only
+        including rows of some routes if given.
+        """
+        data_f.seek(offset)
+        timestamp, num_rows, metadata_length = CHUNK_HEADER.unpack(
+            data_f.read(CHUNK_HEADER.size))
+        metadata = json.loads(data_f.read(metadata_length))
+        start = offset + CHUNK_HEADER.size + metadata_length
+
+        if routes is None:
+            ranges = [(0, num_rows)]
+        else:
+            ranges = sorted(tuple(metadata["routes"][route])
+                            for route in routes
+                            if route in metadata["routes"])
+
+        strings = metadata["strings"]
+        columns = {}
+        for i, (name, typecode) in enumerate(COLUMNS):
+            column = columns[name] = array(typecode)
+            for first, last in ranges:
+                data_f.seek(start + (i * num_rows + first) * ITEM_SIZE)
+                column.fromstring(data_f.read((last - first) * ITEM_SIZE))
+
+        rows = []
+        for i in xrange(len(columns["route"])):
+            row = {name: strings[columns[name][i]]
+                   for name in STRING_COLUMNS}
+            row["progress"] = columns["progress"][i]
+            row["remaining_time"] = columns["remaining_time"][i]
+            rows.append(row)
+
+        return timestamp, rows
+
+    def get_ticks(self, start, end, routes=None):
+        """ Yields the recorded ticks within a window of time.
+
+        Arguments
+        ---------
+        start: int
+            Start of window (inclusive), in seconds since the epoch
+        end: int
+            End of window (exclusive), in seconds since the epoch
+        routes: iterable[str]
+            If given, only include subway cars of these routes
+
+        Returns
+        -------
+        generator[tuple[int, list[dict]]]
+            Generator of (timestamp, subway cars) in order of timestamp,
+            where subway cars are of the form {
+                trip_id: trip ID,
+                route: route ID,
+                prev_stop: stop ID of previous stop,
+                stop: stop ID of next stop,
+                progress: fraction of path already traveled,
+                remaining_time: seconds until arrival at next stop
+            }
+        """
+        partition_start = start - start % PARTITION_SECONDS
+        for hour in xrange(partition_start, end, PARTITION_SECONDS):
+            partition = get_partition(hour)
+            timestamps, offsets = self._read_index(partition)
+            first = bisect_left(timestamps, start)
+            last = bisect_left(timestamps, end)
+            if first == last:
+                continue
+
+            with open(os.path.join(self.directory, partition) +
+                      DATA_SUFFIX, "rb") as data_f:
+                for offset in offsets[first:last]:
+                    yield self._read_chunk(data_f, offset, routes)
+
+    def get_range(self):
+        """ Returns the timestamps of the first and last recorded ticks, or
+        None if nothing has been recorded.
+        """
+        partitions = sorted(name[:-len(INDEX_SUFFIX)]
+                            for name in os.listdir(self.directory)
+                            if name.endswith(INDEX_SUFFIX))
+        first = last = None
+        for partition in partitions:
+            timestamps, _ = self._read_index(partition)
+            if timestamps:
+                first = timestamps[0] if first is None else first
+                last = timestamps[-1]
+
+        return None if first is None else (first, last)
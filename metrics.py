@@ -0,0 +1,243 @@
+from bisect import bisect_left
+
+# Default buckets of histograms, in seconds
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+_metrics = []
+
+
+class Metric:
+    """ Metric class.
+
+    Base class of metrics, which are families of series keyed by label
+    values. Metrics register themselves on construction, and are rendered
+    in the Prometheus text exposition format by render().
+    """
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        """ Constructor.
+
+        Arguments
+        ---------
+        name: str
+            Name of metric
+        documentation: str
+            Description of metric
+        label_names: list[str]
+            Names of labels of the metric
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._series = {}
+
+        if not self.label_names:
+            self._series[()] = self._new_series()
+
+        _metrics.append(self)
+
+    def _new_series(self):
+        """ Returns a new series of the metric. """
+        raise NotImplementedError
+
+    def labels(self, *label_values):
+        """ Returns the series of the metric with the given label values.
+
+        Arguments
+        ---------
+        label_values: list[str]
+            Values of the labels, in the order of the label names
+
+        Returns
+        -------
+        object
+            Series of metric
+        """
+        key = tuple(str(value) for value in label_values)
+        series = self._series.get(key)
+        if series is None:
+            if len(key) != len(self.label_names):
+                raise ValueError("{} expects labels {}".format(
+                    self.name, self.label_names))
+            series = self._series[key] = self._new_series()
+
+        return series
+
+    def _format_labels(self, key, extra=()):
+        """ Returns label set of a series in the exposition format. """
+        pairs = zip(self.label_names, key) + list(extra)
+        if not pairs:
+            return ""
+
+        return "{" + ",".join(
+            '{}="{}"'.format(name, value.replace("\\", "\\\\")
+                             .replace("\n", "\\n").replace('"', '\\"'))
+            for name, value in pairs
+        ) + "}"
+
+    def _render_series(self, key, series):
+        """ Returns the lines of a series in the exposition format. """
+        raise NotImplementedError
+
+    def render(self):
+        """ Returns the metric in the exposition format. """
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.metric_type)
+        ]
+        for key in sorted(self._series):
+            lines.extend(self._render_series(key, self._series[key]))
+
+        return "\n".join(lines)
+
+
+class _Value:
+    """ Series holding a single value, or a function returning one. """
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Counter(Metric):
+    """ Counter class.
+
+    Metric of monotonically increasing values.
+    """
+    metric_type = "counter"
+
+    def _new_series(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        """ Increments the unlabeled series of the counter. """
+        self._series[()].inc(amount)
+
+    def _render_series(self, key, series):
+        return ["{}{} {!r}".format(self.name, self._format_labels(key),
+                                   float(series.get()))]
+
+
+class Gauge(Counter):
+    """ Gauge class.
+
+    Metric of values that can go up or down, or be computed when rendered.
+    """
+    metric_type = "gauge"
+
+    def dec(self, amount=1):
+        """ Decrements the unlabeled series of the gauge. """
+        self._series[()].dec(amount)
+
+    def set(self, value):
+        """ Sets the unlabeled series of the gauge. """
+        self._series[()].set(value)
+
+    def set_function(self, function):
+        """ Sets a function computing the unlabeled series of the gauge. """
+        self._series[()].set_function(function)
+
+
+class _Buckets:
+    """ Series of counts of observations in histogram buckets. """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    """ Histogram class.
+
+    Metric of distributions of observed values, counted into buckets.
+    """
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        """ Constructor.
+
+        Arguments
+        ---------
+        name: str
+            Name of metric
+        documentation: str
+            Description of metric
+        label_names: list[str]
+            Names of labels of the metric
+        buckets: list[float]
+            Sorted upper bounds of the buckets of the histogram
+        """
+        self.buckets = tuple(buckets)
+        Metric.__init__(self, name, documentation, label_names)
+
+    def _new_series(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        """ Observes a value in the unlabeled series of the histogram. """
+        self._series[()].observe(value)
+
+    def _render_series(self, key, series):
+        lines = []
+        count = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),),
+                                       series.counts):
+            count += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append("{}_bucket{} {}".format(
+                self.name, self._format_labels(key, [("le", le)]), count))
+
+        labels = self._format_labels(key)
+        lines.append("{}_sum{} {!r}".format(self.name, labels, series.sum))
+        lines.append("{}_count{} {}".format(self.name, labels, count))
+
+        return lines
+
+
+def render():
+    """ Returns all registered metrics in the Prometheus text exposition
+    format.
+    """
+    return "\n".join(metric.render() for metric in _metrics) + "\n"
+
+
+# Shared by every cache, labeled by the name of the cache and whether the
+# request was a hit or a miss, so that hit rates can be compared across them.
+CACHE_REQUESTS = Counter(
+    "livesubway_cache_requests_total",
+    "Cache lookups by cache and result (hit or miss)",
+    ["cache", "result"]
+)
+
+
+def record_cache(cache, hit):
+    """ Records a cache lookup.
+
+    Arguments
+    ---------
+    cache: str
+        Name of cache
+    hit: bool
+        Whether the lookup was a hit
+    """
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
@@ -0,0 +1,112 @@
+import os
+import sys
+
+from collections import Counter
+
+from eventlet import patcher
+
+# The profiler samples from a real OS thread, so that it keeps sampling while
+# the eventlet hub (and whichever green thread it is running) is busy; we
+# need the unpatched modules since app.py monkey patches the standard ones.
+real_thread = patcher.original("thread")
+real_threading = patcher.original("threading")
+real_time = patcher.original("time")
+
+DEFAULT_INTERVAL = 0.005
+# Shorter intervals would have the sampler contend for the GIL with the
+# server it is profiling
+MIN_INTERVAL = 0.001
+# Longer intervals would give too few samples to be useful
+MAX_INTERVAL = 0.1
+# Longest the sampling thread sleeps at a time, and so the longest that
+# stop (which runs on the hub) waits for it
+SLEEP_SLICE = 0.002
+MAX_DURATION = 60
+
+
+class SamplingProfiler:
+    """ SamplingProfiler class.
+
+    Used primarily to find hot paths in a running server without
+    restarting it. Every interval, a background thread records the stack
+    of the frame currently executing on the profiled thread. With eventlet,
+    all green threads (the feed timer, broadcasts, request handlers) run on
+    the same OS thread as the hub, so the samples cover whichever green
+    thread is running at the time; idle time shows up as stacks in the hub.
+
+    Samples are reported as collapsed stacks (one line per distinct stack
+    of the form "outer;...;inner count"), which can be rendered directly by
+    flamegraph tools.
+    """
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        """ Constructor.
+
+        Arguments
+        ---------
+        interval: float
+            Seconds between samples, between MIN_INTERVAL and MAX_INTERVAL
+        """
+        self.interval = min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+        self.samples = Counter()
+        self._thread_id = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """ Starts sampling the calling OS thread. """
+        self._thread_id = real_thread.get_ident()
+        self._running = True
+        self._thread = real_threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops sampling. """
+        self._running = False
+        self._thread.join(SLEEP_SLICE * 2)
+
+    def _sample(self):
+        """ Records samples until stopped. """
+        while self._running:
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self.samples[SamplingProfiler._get_stack(frame)] += 1
+
+            # The interval is slept in slices, so that the thread notices
+            # soon after it is stopped
+            wake_time = real_time.time() + self.interval
+            while self._running:
+                remaining = wake_time - real_time.time()
+                if remaining <= 0:
+                    break
+                real_time.sleep(min(remaining, SLEEP_SLICE))
+
+    @staticmethod
+    def _get_stack(frame):
+        """ Returns the collapsed stack of a frame.
+
+        Arguments
+        ---------
+        frame: frame
+            Innermost frame of stack
+
+        Returns
+        -------
+        str
+            Semicolon separated functions of stack, from outermost to
+            innermost, of the form "function (file:line)"
+        """
+        functions = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append("{} ({}:{})".format(
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno).replace(";", ":"))
+            frame = frame.f_back
+
+        return ";".join(reversed(functions))
+
+    def collapsed(self):
+        """ Returns the samples as collapsed stacks, most frequent first. """
+        return "".join("{} {}\n".format(stack, count)
+                       for stack, count in self.samples.most_common())
@@ -0,0 +1,426 @@
+import calendar
+
+from datetime import datetime, timedelta
+
+from feed import get_timezone
+from static import get_service_code
+
+# Journeys are planned with RAPTOR (Delling et al., "Round-Based Public
+# Transit Routing"): round k finds the earliest arrival at every stop with k
+# trips, by scanning once along each pattern serving a stop improved in the
+# previous round, and then following the transfers from every stop improved
+# in this round. Patterns and transfers are the columns of a
+# static.Timetable.
+
+# Most transfers between trips of a journey
+MAX_TRANSFERS = 4
+# Delays of the live feed larger than this (in either direction) are assumed
+# to match the wrong service day, and are ignored
+MAX_DELAY_SECONDS = 3600
+INFINITY = float("inf")
+
+
+def get_service_days(timestamp):
+    """ Returns the service days running at a time: today, and yesterday
+    for trips running past midnight.
+
+    Arguments
+    ---------
+    timestamp: int
+        Time, in seconds since the epoch
+
+    Returns
+    -------
+    list[tuple[str, int]]
+        List of (service code, midnight in seconds since the epoch) of each
+        service day, in the time zone of the schedule
+    """
+    timezone = get_timezone()
+    today = datetime.fromtimestamp(timestamp, timezone).date()
+
+    return [(get_service_code(day), _get_midnight(day, timezone))
+            for day in (today, today - timedelta(days=1))]
+
+
+def _get_midnight(day, timezone):
+    """ Returns the start of a service day in seconds since the epoch, from
+    which the times of its trips are measured: noon minus 12 hours, which is
+    midnight except on days the clocks change.
+    """
+    noon = timezone.localize(datetime(day.year, day.month, day.day, 12))
+    return calendar.timegm(noon.utctimetuple()) - 12 * 3600
+
+
+def get_delays(timetable, trips, timestamp):
+    """ Returns the delays of the trips in a feed, as the difference between
+    the predicted and scheduled arrival of each trip at the first stop it
+    has a prediction for.
+
+    Arguments
+    ---------
+    timetable: static.Timetable
+        Timetable
+    trips: dict[str -> list]
+        Map of trip ID -> [route, [stop ID, ...], [arrival time, ...]]
+        for every trip in the feed (see feed.FeedColumns.get_trips)
+    timestamp: int
+        Time of feed, in seconds since the epoch
+
+    Returns
+    -------
+    dict[int -> int]
+        Map of trip index (in timetable.trip_ids) -> seconds of delay
+    """
+    delays = {}
+    service_days = get_service_days(timestamp)
+
+    for trip_id, (_, stop_ids, arrival_times) in trips.iteritems():
+        # Arrival times of 0 are missing predictions
+        predictions = [(stop_id, arrival_time) for stop_id, arrival_time
+                       in zip(stop_ids, arrival_times) if arrival_time > 0]
+        if not predictions:
+            continue
+        stop_id, arrival_time = predictions[0]
+
+        best = None
+        for service_code, midnight in service_days:
+            columns = timetable.timetables.get(service_code)
+            trip_row = timetable.trip_rows.get(service_code, {}).get(trip_id)
+            if trip_row is None:
+                continue
+            pattern, row = trip_row
+            stop_offset = columns["pattern_stop_offsets"][pattern]
+            stops = columns["pattern_stops"][
+                stop_offset:columns["pattern_stop_offsets"][pattern + 1]]
+            try:
+                position = stops.index(timetable.stop_indices[stop_id])
+            except (KeyError, ValueError):
+                continue
+
+            scheduled = columns["arrivals"][
+                columns["pattern_time_offsets"][pattern] +
+                row * len(stops) + position]
+            delay = int(arrival_time - midnight - scheduled)
+            if abs(delay) <= MAX_DELAY_SECONDS and \
+                    (best is None or abs(delay) < abs(best[1])):
+                best = (columns["trips"][
+                    columns["pattern_trip_offsets"][pattern] + row], delay)
+
+        if best is not None:
+            delays[best[0]] = best[1]
+
+    return delays
+
+
+def _find_trip(columns, pattern, position, seconds, delays, min_delay,
+               max_delay):
+    """ Returns the position in a pattern of the trip departing a stop the
+    earliest at or after a time, or None if there is none.
+
+    Trips of a pattern are in order of scheduled departure, so the first
+    trip that may depart in time is found by bisection; with delays, the
+    trips after it are scanned until no later trip could depart earlier.
+    """
+    num_stops = columns["pattern_stop_offsets"][pattern + 1] - \
+        columns["pattern_stop_offsets"][pattern]
+    time_offset = columns["pattern_time_offsets"][pattern] + position
+    trip_offset = columns["pattern_trip_offsets"][pattern]
+    num_trips = columns["pattern_trip_offsets"][pattern + 1] - trip_offset
+    departures = columns["departures"]
+
+    low, high = 0, num_trips
+    while low < high:
+        middle = (low + high) // 2
+        if departures[time_offset + middle * num_stops] < seconds - max_delay:
+            low = middle + 1
+        else:
+            high = middle
+
+    if not delays:
+        return low if low < num_trips else None
+
+    trips = columns["trips"]
+    best = None
+    best_departure = INFINITY
+    for row in xrange(low, num_trips):
+        scheduled = departures[time_offset + row * num_stops]
+        if scheduled + min_delay >= best_departure:
+            break
+        departure = scheduled + delays.get(trips[trip_offset + row], 0)
+        if seconds <= departure < best_departure:
+            best, best_departure = row, departure
+
+    return best
+
+
+def _add_transfers(transfers, stops, labels, best, target_arrival,
+                   transfer_parents, marked):
+    """ Follows the transfers from stops reached in a round of RAPTOR (see
+    _scan).
+
+    Transfers are only taken from the origin or from arrivals by trip, so
+    that journeys never chain transfers.
+    """
+    transfer_offsets = transfers["transfer_offsets"]
+    transfer_stops = transfers["transfer_stops"]
+    transfer_times = transfers["transfer_times"]
+
+    for stop, departure in [(stop, labels[stop]) for stop in stops]:
+        for i in xrange(transfer_offsets[stop], transfer_offsets[stop + 1]):
+            to_stop = transfer_stops[i]
+            arrival = departure + transfer_times[i]
+            if arrival < best[to_stop] and arrival < target_arrival:
+                labels[to_stop] = best[to_stop] = arrival
+                transfer_parents[to_stop] = (stop, departure)
+                marked.add(to_stop)
+
+
+def _scan(timetable, columns, sources, targets, seconds, delays,
+          max_transfers):
+    """ Runs the rounds of RAPTOR from a set of stops at a time.
+
+    Returns
+    -------
+    list[tuple[list[float], dict, dict]]
+        List of (earliest arrival at each stop, map of stop index -> (
+        pattern, position of trip, position of boarding stop, position of
+        stop) of the trip that reached it, map of stop index -> (stop index
+        of origin, time of departure) of the transfer that reached it) of
+        each round, where round k takes k trips
+    """
+    pattern_stop_offsets = columns["pattern_stop_offsets"]
+    pattern_stops = columns["pattern_stops"]
+    pattern_trip_offsets = columns["pattern_trip_offsets"]
+    pattern_time_offsets = columns["pattern_time_offsets"]
+    trips = columns["trips"]
+    arrivals = columns["arrivals"]
+    departures = columns["departures"]
+    stop_pattern_offsets = columns["stop_pattern_offsets"]
+    stop_patterns = columns["stop_patterns"]
+    stop_pattern_positions = columns["stop_pattern_positions"]
+
+    delays = delays or {}
+    min_delay = min(min(delays.itervalues()), 0) if delays else 0
+    max_delay = max(max(delays.itervalues()), 0) if delays else 0
+
+    labels = [INFINITY] * len(timetable.stop_ids)
+    for stop in sources:
+        labels[stop] = seconds
+    best = list(labels)
+    marked = set(sources)
+    # Round 0 only follows the transfers from the origin
+    transfer_parents = {}
+    _add_transfers(timetable.transfers, sources, labels, best, INFINITY,
+                   transfer_parents, marked)
+    rounds = [(labels, {}, transfer_parents)]
+
+    for _ in xrange(max_transfers + 1):
+        # Each pattern is scanned once, from the first stop improved in the
+        # previous round
+        queue = {}
+        for stop in marked:
+            for i in xrange(stop_pattern_offsets[stop],
+                            stop_pattern_offsets[stop + 1]):
+                pattern = stop_patterns[i]
+                position = stop_pattern_positions[i]
+                if position < queue.get(pattern, INFINITY):
+                    queue[pattern] = position
+
+        prev_labels = labels
+        labels = list(prev_labels)
+        trip_parents = {}
+        transfer_parents = {}
+        marked = set()
+        target_arrival = min(best[stop] for stop in targets)
+
+        for pattern, start in queue.iteritems():
+            stop_offset = pattern_stop_offsets[pattern]
+            num_stops = pattern_stop_offsets[pattern + 1] - stop_offset
+            time_offset = pattern_time_offsets[pattern]
+            trip_offset = pattern_trip_offsets[pattern]
+            row = boarding = None
+            delay = 0
+
+            for position in xrange(start, num_stops):
+                stop = pattern_stops[stop_offset + position]
+                if row is not None:
+                    arrival = arrivals[time_offset + row * num_stops +
+                                       position] + delay
+                    if arrival < best[stop] and arrival < target_arrival:
+                        labels[stop] = best[stop] = arrival
+                        trip_parents[stop] = (pattern, row, boarding,
+                                              position)
+                        marked.add(stop)
+                        if stop in targets:
+                            target_arrival = arrival
+
+                # An earlier trip may be caught if the stop was reached
+                # before the current trip departs it
+                if prev_labels[stop] < INFINITY and (
+                        row is None or prev_labels[stop] <
+                        departures[time_offset + row * num_stops +
+                                   position] + delay):
+                    new_row = _find_trip(columns, pattern, position,
+                                         prev_labels[stop], delays,
+                                         min_delay, max_delay)
+                    if new_row is not None and new_row != row:
+                        row = new_row
+                        boarding = position
+                        delay = delays.get(trips[trip_offset + row], 0)
+
+        _add_transfers(timetable.transfers, list(marked), labels, best,
+                       target_arrival, transfer_parents, marked)
+        rounds.append((labels, trip_parents, transfer_parents))
+        if not marked:
+            break
+
+    return rounds
+
+
+def _get_journey(timetable, columns, rounds, num_round, stop, midnight,
+                 delays):
+    """ Returns the journey to a stop found in a round of RAPTOR (see
+    plan).
+    """
+    legs = []
+    transferred = False
+    while num_round >= 0:
+        labels, trip_parents, transfer_parents = rounds[num_round]
+        # A stop reached by a transfer was reached the earliest by it, but
+        # the origin of a transfer was reached by a trip
+        if not transferred and stop in transfer_parents:
+            from_stop, departure = transfer_parents[stop]
+            legs.append({
+                "type": "transfer",
+                "from_stop": timetable.stop_ids[from_stop],
+                "to_stop": timetable.stop_ids[stop],
+                "departure": int(midnight + departure),
+                "arrival": int(midnight + labels[stop])
+            })
+            stop = from_stop
+            transferred = True
+            continue
+
+        parent = trip_parents.get(stop)
+        if parent is None:
+            # The stop was not improved in this round
+            num_round -= 1
+            continue
+
+        pattern, row, boarding, position = parent
+        stop_offset = columns["pattern_stop_offsets"][pattern]
+        num_stops = columns["pattern_stop_offsets"][pattern + 1] - \
+            stop_offset
+        time_offset = columns["pattern_time_offsets"][pattern] + \
+            row * num_stops
+        trip_index = columns["trips"][
+            columns["pattern_trip_offsets"][pattern] + row]
+        delay = delays.get(trip_index, 0)
+        from_stop = columns["pattern_stops"][stop_offset + boarding]
+        legs.append({
+            "type": "trip",
+            "trip_id": timetable.trip_ids[trip_index],
+            "route": timetable.routes[trip_index],
+            "from_stop": timetable.stop_ids[from_stop],
+            "to_stop": timetable.stop_ids[stop],
+            "departure": int(midnight + columns["departures"][
+                time_offset + boarding] + delay),
+            "arrival": int(midnight + columns["arrivals"][
+                time_offset + position] + delay),
+            "stops": position - boarding,
+            "delay": delay
+        })
+        stop = from_stop
+        transferred = False
+        num_round -= 1
+
+    legs.reverse()
+    return {
+        "departure": legs[0]["departure"],
+        "arrival": legs[-1]["arrival"],
+        "transfers": max(sum(leg["type"] == "trip" for leg in legs) - 1,
+                         0),
+        "legs": legs
+    }
+
+
+def plan(timetable, origin, destination, departure, delays=None,
+         max_transfers=MAX_TRANSFERS):
+    """ Returns the journeys from a station to another leaving at or after
+    a time.
+
+    Journeys are Pareto-optimal in arrival time and number of transfers:
+    the first journey arrives the earliest, and every following journey
+    arrives later with fewer transfers.
+
+    Arguments
+    ---------
+    timetable: static.Timetable
+        Timetable
+    origin: str
+        Station ID of origin (a key of stops.json)
+    destination: str
+        Station ID of destination (a key of stops.json)
+    departure: int
+        Time of departure, in seconds since the epoch
+    delays: dict[int -> int]
+        If given, map of trip index -> seconds of delay (see get_delays)
+    max_transfers: int
+        Most transfers between trips of a journey
+
+    Returns
+    -------
+    list[dict]
+        List of journeys, of the form {
+            departure: time of departure from origin,
+            arrival: time of arrival at destination,
+            transfers: number of transfers,
+            legs: [{
+                type: "trip",
+                trip_id: trip ID (as in the live feed),
+                route: route ID,
+                from_stop: stop ID of platform boarded at,
+                to_stop: stop ID of platform alighted at,
+                departure: time of departure,
+                arrival: time of arrival,
+                stops: number of stops traveled,
+                delay: seconds of delay included in times
+            } or {
+                type: "transfer",
+                from_stop: stop ID of platform,
+                to_stop: stop ID of platform,
+                departure: time of arrival at from_stop,
+                arrival: earliest time of departure from to_stop
+            },...,]
+        }, with times in seconds since the epoch
+    """
+    sources = timetable.station_stops.get(origin)
+    targets = set(timetable.station_stops.get(destination, ()))
+    if not sources or not targets or origin == destination:
+        return []
+    delays = delays or {}
+
+    journeys = []
+    for service_code, midnight in get_service_days(departure):
+        columns = timetable.timetables.get(service_code)
+        seconds = int(departure - midnight)
+        if columns is None or seconds > timetable.end_times[service_code]:
+            continue
+
+        rounds = _scan(timetable, columns, sources, targets, seconds, delays,
+                       max_transfers)
+        for num_round, (labels, _, _) in enumerate(rounds):
+            stop = min(targets, key=labels.__getitem__)
+            if labels[stop] < INFINITY:
+                journeys.append(_get_journey(timetable, columns, rounds,
+                                             num_round, stop, midnight,
+                                             delays))
+
+    # Only journeys with fewer transfers than every earlier journey are kept
+    pareto = []
+    for journey in sorted(journeys, key=lambda journey:
+                          (journey["arrival"], journey["transfers"])):
+        if not pareto or journey["transfers"] < pareto[-1]["transfers"]:
+            pareto.append(journey)
+
+    return pareto
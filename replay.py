@@ -0,0 +1,367 @@
+import os
+import struct
+import time
+import zlib
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from argparse import ArgumentParser
+from bisect import bisect_right
+from urlparse import parse_qs, urlparse
+
+import datasets
+import feed
+
+# Archives are append-only files starting with ARCHIVE_MAGIC, followed by
+# records of a RECORD_HEADER (recording time, feed ID and payload length)
+# and a payload of the raw FeedMessage bytes compressed with zlib.
+ARCHIVE_MAGIC = "LSFEED1\n"
+RECORD_HEADER = struct.Struct("<dII")
+
+
+class FeedRecorder:
+    """ FeedRecorder class.
+
+    Used primarily to record the raw feeds retrieved from the MTA into an
+    archive, so that they can be replayed later on without a network.
+    """
+    def __init__(self, path):
+        """ Constructor.
+
+        Arguments
+        ---------
+        path: str
+            Path of archive; appended to if it already exists
+        """
+        self._archive_f = open(path, "ab")
+        if self._archive_f.tell() == 0:
+            self._archive_f.write(ARCHIVE_MAGIC)
+
+    def record(self, feed_id, raw_feed, timestamp=None):
+        """ Appends a raw feed to the archive.
+
+        Arguments
+        ---------
+        feed_id: int
+            Feed ID of feed
+        raw_feed: str
+            Raw FeedMessage bytes
+        timestamp: float
+            Time the feed was retrieved; defaults to the current time
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        # Records are written with a single write, so that several
+        # processes can append to the same archive.
+        payload = zlib.compress(raw_feed)
+        self._archive_f.write(RECORD_HEADER.pack(timestamp, feed_id,
+                                                 len(payload)) + payload)
+        self._archive_f.flush()
+
+    def close(self):
+        """ Closes the archive. """
+        self._archive_f.close()
+
+
+def read_index(path):
+    """ Returns index of the records in an archive.
+
+    A trailing record that is incomplete (e.g. if the recorder was killed
+    mid-write) is ignored.
+
+    Arguments
+    ---------
+    path: str
+        Path of archive
+
+    Returns
+    -------
+    list[tuple[float, int, int, int]]
+        List of (timestamp, feed ID, offset, length) of each record's
+        payload, in order of recording
+    """
+    index = []
+    size = os.path.getsize(path)
+
+    with open(path, "rb") as archive_f:
+        if archive_f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ValueError("{} is not a feed archive".format(path))
+
+        while True:
+            header = archive_f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+
+            timestamp, feed_id, length = RECORD_HEADER.unpack(header)
+            offset = archive_f.tell()
+            if offset + length > size:
+                break
+
+            index.append((timestamp, feed_id, offset, length))
+            archive_f.seek(length, os.SEEK_CUR)
+
+    return index
+
+
+def read_archive(path, feed_id=None):
+    """ Yields the records of an archive.
+
+    Arguments
+    ---------
+    path: str
+        Path of archive
+    feed_id: int
+        If given, only yield records of this feed ID
+
+    Returns
+    -------
+    generator[tuple[float, int, str]]
+        Generator of (timestamp, feed ID, raw FeedMessage bytes)
+    """
+    with open(path, "rb") as archive_f:
+        for timestamp, record_feed_id, offset, length in read_index(path):
+            if feed_id is None or feed_id == record_feed_id:
+                archive_f.seek(offset)
+                yield timestamp, record_feed_id, \
+                    zlib.decompress(archive_f.read(length))
+
+
+class FeedReplay:
+    """ FeedReplay class.
+
+    Used primarily to replay an archive of feeds in place of the MTA.
+    Replay follows a virtual clock running at a multiple of real time that
+    starts at the time of the first record; like the MTA, each request for
+    a feed returns the latest feed recorded at or before the current time.
+
+    FeedReplay objects can be used directly as the transport of the feed
+    module.
+    """
+    def __init__(self, path, speed=1.0, loop=False):
+        """ Constructor.
+
+        Arguments
+        ---------
+        path: str
+            Path of archive
+        speed: float
+            Speed of replay relative to real time
+        loop: bool
+            Whether to restart from the beginning at the end of the archive
+        """
+        self._path = path
+        self._speed = speed
+        self._loop = loop
+        self._records = {}
+
+        for timestamp, feed_id, offset, length in read_index(path):
+            if feed_id not in self._records:
+                self._records[feed_id] = ([], [])
+            self._records[feed_id][0].append(timestamp)
+            self._records[feed_id][1].append((offset, length))
+
+        if not self._records:
+            raise ValueError("{} has no records".format(path))
+
+        self._start_time = min(timestamps[0] for timestamps, _
+                               in self._records.itervalues())
+        self._end_time = max(timestamps[-1] for timestamps, _
+                             in self._records.itervalues())
+        self.restart()
+
+    def restart(self):
+        """ Restarts replay from the beginning of the archive. """
+        self._started = time.time()
+
+    def get_time(self):
+        """ Returns current time of the virtual clock. """
+        elapsed = (time.time() - self._started) * self._speed
+        duration = self._end_time - self._start_time
+        if self._loop and duration > 0:
+            elapsed %= duration
+
+        return self._start_time + elapsed
+
+    def __call__(self, feed_id):
+        """ Returns the raw feed current at the time of the virtual clock.
+
+        Arguments
+        ---------
+        feed_id: int
+            Feed ID of feed
+
+        Returns
+        -------
+        str
+            Raw FeedMessage bytes
+        """
+        timestamps, locations = self._records[feed_id]
+        index = max(bisect_right(timestamps, self.get_time()) - 1, 0)
+        offset, length = locations[index]
+
+        with open(self._path, "rb") as archive_f:
+            archive_f.seek(offset)
+            return zlib.decompress(archive_f.read(length))
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    """ ReplayServer class.
+
+    Used primarily as a local stand-in for the MTA's feed endpoint, serving
+    feeds from a FeedReplay at /mta_esi.php?feed_id=<feed ID>.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, replay):
+        """ Constructor.
+
+        Arguments
+        ---------
+        address: tuple[str, int]
+            Host and port to listen on
+        replay: FeedReplay
+            FeedReplay object
+        """
+        HTTPServer.__init__(self, address, ReplayRequestHandler)
+        self.replay = replay
+
+
+class ReplayRequestHandler(BaseHTTPRequestHandler):
+    """ ReplayRequestHandler class.
+
+    Handles requests for feeds to a ReplayServer.
+    """
+    def do_GET(self):
+        """ Responds with the current feed of the requested feed ID. """
+        url = urlparse(self.path)
+        feed_id = parse_qs(url.query).get(
+            "feed_id", [feed.dataset.feed_id])[0]
+
+        try:
+            raw_feed = self.server.replay(int(feed_id))
+        except (KeyError, ValueError):
+            self.send_error(404, "No records for feed {}".format(feed_id))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(raw_feed)))
+        self.end_headers()
+        self.wfile.write(raw_feed)
+
+
+def record(args):
+    """ Records feeds from the MTA into an archive. """
+    recorder = FeedRecorder(args.archive)
+    count = 0
+
+    try:
+        while args.count is None or count < args.count:
+            for feed_id in args.feed_id:
+                recorder.record(feed_id, feed.fetch_feed(feed_id))
+            count += 1
+            print "Recorded {} feed(s).".format(count)
+            time.sleep(args.interval)
+    finally:
+        recorder.close()
+
+
+def serve(args):
+    """ Serves feeds from an archive in place of the MTA. """
+    replay = FeedReplay(args.archive, args.speed, args.loop)
+    server = ReplayServer((args.host, args.port), replay)
+    print "Replaying {} at http://{}:{}/mta_esi.php?feed_id=...".format(
+        args.archive, args.host, args.port)
+    server.serve_forever()
+
+
+def info(args):
+    """ Prints a summary of the records in an archive. """
+    records = {}
+    for timestamp, feed_id, offset, length in read_index(args.archive):
+        records.setdefault(feed_id, []).append((timestamp, length))
+
+    for feed_id, feed_records in sorted(records.iteritems()):
+        print "Feed {}: {} records, {:.0f}s, {} bytes compressed".format(
+            feed_id, len(feed_records),
+            feed_records[-1][0] - feed_records[0][0],
+            sum(length for _, length in feed_records))
+
+
+def get_parser():
+    """ Returns argument parser. """
+    parser = ArgumentParser(
+        description="A script to record and replay archives of feeds."
+    )
+    subparsers = parser.add_subparsers()
+
+    record_parser = subparsers.add_parser(
+        "record",
+        help="Record feeds from the MTA"
+    )
+    record_parser.add_argument("archive", help="Path of archive")
+    record_parser.add_argument(
+        "--dataset",
+        choices=sorted(datasets.DATASETS),
+        default=datasets.DEFAULT_DATASET,
+        help="Dataset whose realtime feed to record"
+    )
+    record_parser.add_argument(
+        "--feed-id",
+        type=int,
+        action="append",
+        help="Feed ID to record (may be repeated)"
+    )
+    record_parser.add_argument(
+        "--interval",
+        type=float,
+        default=feed.POLL_INTERVAL,
+        help="Seconds between recordings"
+    )
+    record_parser.add_argument(
+        "--count",
+        type=int,
+        default=None,
+        help="Number of recordings to make"
+    )
+    record_parser.set_defaults(function=record)
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Serve recorded feeds over HTTP in place of the MTA"
+    )
+    serve_parser.add_argument("archive", help="Path of archive")
+    serve_parser.add_argument("--host", default="localhost")
+    serve_parser.add_argument("--port", type=int, default=8001)
+    serve_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Speed of replay relative to real time"
+    )
+    serve_parser.add_argument(
+        "--loop",
+        action="store_true",
+        default=False,
+        help="Flag to restart from the beginning at the end of the archive"
+    )
+    serve_parser.set_defaults(function=serve)
+
+    info_parser = subparsers.add_parser(
+        "info",
+        help="Summarize the records in an archive"
+    )
+    info_parser.add_argument("archive", help="Path of archive")
+    info_parser.set_defaults(function=info)
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if getattr(args, "dataset", None) is not None:
+        feed.dataset = datasets.get_dataset(args.dataset)
+    if getattr(args, "feed_id", False) is None:
+        args.feed_id = [feed.dataset.feed_id]
+    args.function(args)
@@ -0,0 +1,168 @@
+import socket
+
+import eventlet
+
+# Largest request head (request line and headers) read before routing
+MAX_HEAD_BYTES = 65536
+BUFFER_SIZE = 65536
+BAD_GATEWAY = "HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n" + \
+    "Connection: close\r\n\r\n"
+BAD_REQUEST = "HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n" + \
+    "Connection: close\r\n\r\n"
+
+
+def parse_shard(shard):
+    """ Returns the dataset and address of a shard given as
+    "dataset=host:port".
+    """
+    name, address = shard.split("=", 1)
+    host, port = address.rsplit(":", 1)
+    return name, (host, int(port))
+
+
+def _pipe(source, destination):
+    """ Copies bytes from one socket to another until either is closed. """
+    try:
+        while True:
+            data = source.recv(BUFFER_SIZE)
+            if not data:
+                break
+            destination.sendall(data)
+    except socket.error:
+        pass
+
+
+class Router:
+    """ Router class.
+
+    Used primarily to serve several datasets from one address, each from its
+    own shard (an app.py process, or a load balancer in front of several,
+    serving the dataset), so that datasets are processed on as many cores
+    as there are shards. Requests are routed by the first segment of their
+    path: "/lirr/stops_json" is forwarded to the shard of the lirr dataset
+    as "/stops_json", and requests for no dataset (e.g. static files) to the
+    first shard. Socket.IO connections are routed in the same way by their
+    path (e.g. "/lirr/socket.io/"), so that clients join the rooms of the
+    shard of their dataset.
+
+    Each connection carries a single request, as shards are asked to close
+    it after responding, so that every request is routed by its own path;
+    upgraded connections (i.e. WebSockets) are relayed until either side
+    closes them.
+    """
+    def __init__(self, shards):
+        """ Constructor.
+
+        Arguments
+        ---------
+        shards: list[tuple[str, tuple[str, int]]]
+            List of (dataset, (host, port)) of each shard (see parse_shard)
+        """
+        self.shards = dict(shards)
+        self.default_shard = shards[0][1]
+
+    def route(self, target):
+        """ Returns the address of the shard of a request target, and the
+        target to forward to it.
+        """
+        name = target[1:].split("/", 1)[0].split("?", 1)[0]
+        if name not in self.shards:
+            return self.default_shard, target
+
+        target = target[len(name) + 1:]
+        if not target.startswith("/"):
+            target = "/" + target
+        return self.shards[name], target
+
+    def _read_head(self, client):
+        """ Returns the head of a request and the bytes received after it,
+        or None if the connection is closed first or the head is too long.
+        """
+        data = ""
+        while "\r\n\r\n" not in data:
+            if len(data) > MAX_HEAD_BYTES:
+                return None
+            chunk = client.recv(BUFFER_SIZE)
+            if not chunk:
+                return None
+            data += chunk
+
+        return data.split("\r\n\r\n", 1)
+
+    def _rewrite_head(self, head):
+        """ Returns the address of the shard of a request, and its head as
+        forwarded to the shard.
+        """
+        lines = head.split("\r\n")
+        method, target, version = lines[0].split(" ", 2)
+        address, target = self.route(target)
+
+        headers = []
+        upgrade = False
+        for line in lines[1:]:
+            name = line.split(":", 1)[0].strip().lower()
+            if name == "upgrade":
+                upgrade = True
+            headers.append((name, line))
+
+        if not upgrade:
+            headers = [header for header in headers
+                       if header[0] not in ("connection", "keep-alive")]
+            headers.append(("connection", "Connection: close"))
+
+        return address, "\r\n".join(
+            ["{} {} {}".format(method, target, version)] +
+            [line for _, line in headers]) + "\r\n\r\n"
+
+    def handle(self, client):
+        """ Forwards a client connection to its shard.
+
+        Arguments
+        ---------
+        client: socket.socket
+            Socket of client
+        """
+        upstream = None
+        try:
+            request = self._read_head(client)
+            if request is None:
+                return
+            try:
+                address, head = self._rewrite_head(request[0])
+            except ValueError:
+                client.sendall(BAD_REQUEST)
+                return
+
+            try:
+                upstream = eventlet.connect(address)
+            except socket.error:
+                client.sendall(BAD_GATEWAY)
+                return
+
+            upstream.sendall(head + request[1])
+            eventlet.spawn(_pipe, client, upstream)
+            _pipe(upstream, client)
+        except socket.error:
+            pass
+        finally:
+            if upstream is not None:
+                upstream.close()
+            client.close()
+
+    def serve(self, host, port):
+        """ Routes connections to an address until interrupted.
+
+        Arguments
+        ---------
+        host: str
+            Host to listen on
+        port: int
+            Port to listen on
+        """
+        print "Routing {} on {}:{}...".format(
+            ", ".join(sorted(self.shards)), host, port)
+        try:
+            eventlet.serve(eventlet.listen((host, port)),
+                           lambda client, _: self.handle(client))
+        except KeyboardInterrupt:
+            pass
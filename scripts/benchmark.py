@@ -0,0 +1,350 @@
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+import simplejson as json
+import transitfeed
+
+import datasets
+import feed
+import raptor
+import replay
+from scripts.synthetic_gtfs import SyntheticDataset
+import static
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Synthetic feeds start at 8 AM on a weekday of the synthetic schedule
+FEED_START = datetime(2016, 11, 7, 8)
+
+
+def time_function(function, repeat, number=1):
+    """ Times a function.
+
+    Arguments
+    ---------
+    function: function
+        Function taking no arguments
+    repeat: int
+        Number of timings to take
+    number: int
+        Number of calls made by the function, so that timings are per call
+
+    Returns
+    -------
+    dict[str -> float]
+        Map of statistic -> seconds per call
+    """
+    timings = []
+    for _ in xrange(repeat):
+        start = time.time()
+        function()
+        timings.append((time.time() - start) / max(number, 1))
+
+    timings.sort()
+    return {
+        "repeat": repeat,
+        "number": number,
+        "min": timings[0],
+        "median": timings[len(timings) // 2],
+        "mean": sum(timings) / len(timings),
+        "max": timings[-1]
+    }
+
+
+def get_commit():
+    """ Returns the current commit of the repository, if any. """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            stderr=open(os.devnull, "w")
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_raw_feeds(args, dataset):
+    """ Returns list of raw feeds to benchmark with, either recorded in an
+    archive or generated from the synthetic dataset.
+    """
+    if args.archive:
+        return [raw_feed for _, _, raw_feed
+                in replay.read_archive(
+                    args.archive, feed.dataset.feed_id)][:args.ticks]
+    else:
+        return [dataset.get_feed(FEED_START + timedelta(
+            seconds=i * feed.POLL_INTERVAL)).SerializeToString()
+            for i in xrange(args.ticks)]
+
+
+def run_benchmarks(args):
+    """ Runs all benchmarks in a temporary working directory.
+
+    Arguments
+    ---------
+    args: argparse.Namespace
+        Arguments
+
+    Returns
+    -------
+    dict[str -> dict[str -> float]]
+        Map of benchmark name -> statistics
+    """
+    results = {}
+    repeat = args.repeat
+
+    def record(name, stats):
+        results[name] = stats
+        print >> sys.stderr, "{:<32} {:>12.6f}s".format(name, stats["median"])
+
+    # Files of the static data are written as those of the subway
+    subway = datasets.get_dataset(datasets.DEFAULT_DATASET)
+    dataset = None
+    if args.gtfs:
+        gtfs_dir = args.gtfs
+    else:
+        gtfs_dir = os.path.join(args.work_dir,
+                                subway.static_transit_dir)
+        dataset = SyntheticDataset(args.stops, args.routes, args.trips,
+                                   args.shapes, seed=args.seed)
+        dataset.write(gtfs_dir)
+
+    # static.py writes its files relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(args.work_dir)
+    try:
+        for directory in [subway.json_dir, subway.pickle_dir]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        schedules = []
+        record("static.load", time_function(
+            lambda: schedules.append(transitfeed.Loader(gtfs_dir).Load()),
+            min(repeat, 3)))
+        schedule = schedules[-1]
+
+        graphs = []
+        record("static.StopGraph", time_function(
+            lambda: graphs.append(static.StopGraph(schedule, subway)), repeat))
+        prev_stops_list = []
+        record("static.PrevStops", time_function(
+            lambda: prev_stops_list.append(static.PrevStops(schedule, subway)),
+            repeat))
+        record("static.parse_shapes", time_function(
+            lambda: static.parse_shapes(schedule, subway), repeat))
+        record("static.parse_stops", time_function(
+            lambda: static.parse_stops(schedule, subway), repeat))
+        # Files loaded by app.py (see app.startup)
+        for parse_function in [static.parse_graph, static.parse_prev_stops,
+                               static.parse_trip_sequences,
+                               static.parse_schedule, static.parse_search,
+                               static.parse_timetable]:
+            parse_function(schedule, subway)
+
+        graph = graphs[-1]
+        prev_stops = prev_stops_list[-1]
+        with open(subway.json_dir + "shapes.json") as shapes_f:
+            shapes = json.load(shapes_f)
+        with open(subway.json_dir + "stops.json") as stops_f:
+            stops = json.load(stops_f)
+
+        record("json.shapes", time_function(
+            lambda: json.dumps(shapes), repeat))
+        record("json.stops", time_function(
+            lambda: json.dumps(stops), repeat))
+
+        segments = list(graph._edges)
+        record("graph.get_path", time_function(
+            lambda: [graph.get_path(segment.start, segment.end, shapes)
+                     for segment in segments],
+            repeat, len(segments)))
+
+        # Pairs of stations two stops apart, without the cached paths
+        next_stations = {}
+        for segment in segments:
+            next_stations.setdefault(segment.start, []).append(segment.end)
+        two_stop_pairs = [(segment.start, end) for segment in segments
+                          for end in next_stations.get(segment.end, ())
+                          if end != segment.start]
+
+        def get_two_stop_paths():
+            graph._paths.clear()
+            for start, end in two_stop_pairs:
+                try:
+                    graph.get_path(start, end, shapes)
+                except KeyError:
+                    pass
+
+        record("graph.get_path.uncached", time_function(
+            get_two_stop_paths, repeat, len(two_stop_pairs)))
+
+        # Prefixes of every station name, as typed by a user
+        search = static.StopSearch(stops)
+        queries = [stop["name"][:length] for stop in stops.itervalues()
+                   for length in (1, 4, len(stop["name"]))]
+        record("search.search", time_function(
+            lambda: [search.search(query, 10) for query in queries],
+            repeat, len(queries)))
+
+        timetables = []
+        record("static.Timetable", time_function(
+            lambda: timetables.append(static.Timetable(schedule, subway)),
+            repeat))
+        timetable = timetables[-1]
+
+        # Journeys between stations at opposite ends of the list of
+        # stations, at the start of the synthetic feeds
+        stations = sorted(timetable.station_stops)
+        journeys = zip(stations, reversed(stations))[:100]
+        departure = time.mktime(FEED_START.timetuple())
+        record("raptor.plan", time_function(
+            lambda: [raptor.plan(timetable, origin, destination, departure)
+                     for origin, destination in journeys],
+            repeat, len(journeys)))
+
+        raw_feeds = get_raw_feeds(args, dataset)
+
+        def parse_feeds():
+            for raw_feed in raw_feeds:
+                feed.gtfs.FeedMessage().ParseFromString(raw_feed)
+
+        record("feed.parse", time_function(parse_feeds, repeat,
+                                           len(raw_feeds)))
+
+        feed_columns = []
+        record("feed.decode", time_function(
+            lambda: feed_columns.append([feed.decode_feed(raw_feed)[0]
+                                         for raw_feed in raw_feeds]),
+            repeat, len(raw_feeds)))
+        feed_columns = feed_columns[-1]
+
+        vehicle_positions = [vehicle for columns in feed_columns
+                             for vehicle in columns.get_vehicles()]
+
+        def get_prev_stops():
+            for vehicle in vehicle_positions:
+                try:
+                    prev_stops.get_prev_stop(vehicle)
+                except KeyError:
+                    pass
+
+        record("prev_stops.get_prev_stop", time_function(
+            get_prev_stops, repeat, len(vehicle_positions)))
+
+        ticks = []
+        record("feed.get_vehicles", time_function(
+            lambda: ticks.extend(
+                feed.get_vehicles(columns, graph, prev_stops, shapes)
+                for columns in feed_columns),
+            repeat, len(feed_columns)))
+        record("broadcast.serialize", time_function(
+            lambda: [json.dumps(vehicles) for vehicles in ticks],
+            repeat, len(ticks)))
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [REPO_DIR] + filter(None, [env.get("PYTHONPATH")]))
+        record("app.startup", time_function(
+            lambda: subprocess.check_call([sys.executable, "-c",
+                                           "import app; " +
+                                           "app.load_static_data()"],
+                                          env=env),
+            min(repeat, 3)))
+    finally:
+        os.chdir(cwd)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Prints comparison of results with a baseline, and returns whether
+    any benchmark regressed by more than the threshold.
+    """
+    regressed = False
+    for name, stats in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        ratio = stats["median"] / max(baseline[name]["median"], 1e-12)
+        flag = ""
+        if ratio > threshold:
+            flag = "REGRESSION"
+            regressed = True
+        print >> sys.stderr, "{:<32} {:>8.2f}x {}".format(name, ratio, flag)
+
+    return regressed
+
+
+def get_parser():
+    """ Returns argument parser. """
+    parser = ArgumentParser(
+        description="A script to benchmark the static build, lookups and " +
+        "broadcast building. Run from the root of the repository with " +
+        "python -m scripts.benchmark."
+    )
+    parser.add_argument("--stops", type=int, default=400,
+                        help="Number of parent stations of synthetic data")
+    parser.add_argument("--routes", type=int, default=24,
+                        help="Number of routes of synthetic data")
+    parser.add_argument("--trips", type=int, default=20000,
+                        help="Number of trips of synthetic data")
+    parser.add_argument("--shapes", type=int, default=6,
+                        help="Number of shapes per route of synthetic data")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of synthetic data")
+    parser.add_argument("--gtfs",
+                        help="GTFS directory to use instead of synthetic data")
+    parser.add_argument("--archive",
+                        help="Feed archive to use instead of synthetic feeds")
+    parser.add_argument("--ticks", type=int, default=20,
+                        help="Number of feeds to benchmark with")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of timings per benchmark")
+    parser.add_argument("--output",
+                        help="File to write results to as JSON")
+    parser.add_argument("--compare",
+                        help="File of results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="Slowdown relative to --compare considered a " +
+                        "regression")
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    args.work_dir = tempfile.mkdtemp(prefix="livesubway-benchmark-")
+
+    try:
+        results = {
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "time": time.time(),
+            "params": {
+                key: getattr(args, key)
+                for key in ["stops", "routes", "trips", "shapes", "seed",
+                            "gtfs", "archive", "ticks", "repeat"]
+            },
+            "results": run_benchmarks(args)
+        }
+    finally:
+        shutil.rmtree(args.work_dir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_f:
+            output_f.write(output)
+    else:
+        print output
+
+    if args.compare:
+        with open(args.compare) as baseline_f:
+            baseline = json.load(baseline_f)["results"]
+        sys.exit(1 if compare(results["results"], baseline,
+                              args.threshold) else 0)
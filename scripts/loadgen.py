@@ -0,0 +1,558 @@
+import eventlet
+eventlet.monkey_patch()
+
+import json  # noqa: E402
+import os  # noqa: E402
+import random  # noqa: E402
+import re  # noqa: E402
+import shutil  # noqa: E402
+import signal  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+import time  # noqa: E402
+
+from argparse import ArgumentParser  # noqa: E402
+from datetime import datetime, timedelta  # noqa: E402
+from eventlet.semaphore import Semaphore  # noqa: E402
+from httplib import HTTPConnection  # noqa: E402
+
+import feed  # noqa: E402
+import replay  # noqa: E402
+from scripts.synthetic_gtfs import SyntheticDataset  # noqa: E402
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Synthetic feeds start at 8 AM on a weekday of the synthetic schedule
+FEED_START = datetime(2016, 11, 7, 8)
+# Viewports of viewport clients are random boxes of this size, in degrees,
+# around the center of the map
+VIEWPORT_SIZE = 0.05
+MAP_CENTER = (-73.983393, 40.788552)
+
+SOCKETIO_PATH = "/socket.io/?EIO=3&transport=polling&b64=1"
+# Socket.IO event packets of the 'feed' event, with an optional ack ID
+FEED_EVENT = re.compile(r'42(\d*)\["feed",')
+
+
+def decode_payload(payload):
+    """ Returns the packets of an Engine.IO (protocol 3) text payload, which
+    is a sequence of packets of the form "<length>:<packet>".
+    """
+    packets = []
+    i = 0
+    while i < len(payload):
+        separator = payload.index(":", i)
+        length = int(payload[i:separator])
+        packets.append(payload[separator + 1:separator + 1 + length])
+        i = separator + 1 + length
+
+    return packets
+
+
+def encode_payload(packet):
+    """ Returns an Engine.IO (protocol 3) text payload of a packet. """
+    return "{}:{}".format(len(packet), packet)
+
+
+class Stats:
+    """ Stats class.
+
+    Collects what the simulated clients observe: when each client received
+    each frame, the frames every client has seen, and the latency of HTTP
+    requests.
+    """
+    def __init__(self):
+        self.frame_receipts = []
+        self.client_frames = {}
+        self.request_seconds = []
+        self.not_modified = 0
+        self.errors = 0
+        self._frames = {}
+
+    def receive_frame(self, client_id, frame_hash):
+        """ Records the receipt of a frame by a client.
+
+        Arguments
+        ---------
+        client_id: int
+            ID of client
+        frame_hash: int
+            Hash of contents of frame
+        """
+        # Replayed feeds loop, so the same contents may be sent again as a
+        # later frame: a client receiving contents it has already received
+        # starts a new frame.
+        frames = self._frames.setdefault(frame_hash, [])
+        client_frames = self.client_frames.setdefault(client_id, set())
+        if not frames or frames[-1] in client_frames:
+            frames.append(len(self.frame_receipts))
+            self.frame_receipts.append([])
+
+        self.frame_receipts[frames[-1]].append(time.time())
+        client_frames.add(frames[-1])
+
+
+class SocketClient:
+    """ SocketClient class.
+
+    Simulates a map viewer: a Socket.IO client over Engine.IO long polling
+    that asks for the feed and acknowledges every frame. Slow clients wait
+    before acknowledging each frame and polling again, as a phone on a bad
+    connection would.
+    """
+    def __init__(self, client_id, host, port, delay=0):
+        """ Constructor.
+
+        Arguments
+        ---------
+        client_id: int
+            ID of client
+        host: str
+            Host of server
+        port: int
+            Port of server
+        delay: float
+            Seconds to wait after receiving a frame
+        """
+        self.client_id = client_id
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self._poll_conn = HTTPConnection(host, port, timeout=120)
+        self._send_conn = HTTPConnection(host, port, timeout=30)
+        # Pings and acknowledgements share a connection
+        self._send_lock = Semaphore()
+        self._url = None
+
+    def _get(self):
+        self._poll_conn.request("GET", self._url or SOCKETIO_PATH)
+        return self._poll_conn.getresponse().read()
+
+    def send(self, packet):
+        """ Sends an Engine.IO packet to the server. """
+        with self._send_lock:
+            self._send_conn.request(
+                "POST", self._url, encode_payload(packet),
+                {"Content-Type": "text/plain;charset=UTF-8"})
+            self._send_conn.getresponse().read()
+
+    def _ping(self, interval):
+        """ Keeps the session alive. """
+        while True:
+            eventlet.sleep(interval)
+            self.send("2")
+
+    def run(self, stats, until):
+        """ Receives frames until a time.
+
+        Arguments
+        ---------
+        stats: Stats
+            Stats to record frames to
+        until: float
+            Time to disconnect at, in seconds since the epoch
+        """
+        handshake = json.loads(decode_payload(self._get())[0][1:])
+        self._url = SOCKETIO_PATH + "&sid=" + handshake["sid"]
+        pinger = eventlet.spawn(self._ping,
+                                handshake["pingInterval"] / 1000.0)
+        try:
+            self.send('42["get_feed"]')
+            while time.time() < until:
+                for packet in decode_payload(self._get()):
+                    match = FEED_EVENT.match(packet)
+                    if match is None:
+                        continue
+
+                    # Frames are identified by their contents, which are the
+                    # same for every client
+                    stats.receive_frame(self.client_id,
+                                        hash(packet[match.end():]))
+                    if self.delay:
+                        eventlet.sleep(self.delay)
+                    if match.group(1):
+                        self.send("43{}[]".format(match.group(1)))
+            self.send("1")
+        finally:
+            pinger.kill()
+            self._poll_conn.close()
+            self._send_conn.close()
+
+
+class ViewportClient:
+    """ ViewportClient class.
+
+    Simulates a consumer of the REST snapshot of a viewport: polls the
+    subway cars within a bounding box, revalidating with the ETag of the
+    previous response.
+    """
+    def __init__(self, client_id, host, port, interval):
+        """ Constructor.
+
+        Arguments
+        ---------
+        client_id: int
+            ID of client
+        host: str
+            Host of server
+        port: int
+            Port of server
+        interval: float
+            Seconds between requests
+        """
+        self.client_id = client_id
+        self.interval = interval
+        self._conn = HTTPConnection(host, port, timeout=30)
+        lon = MAP_CENTER[0] + random.uniform(-0.1, 0.1)
+        lat = MAP_CENTER[1] + random.uniform(-0.1, 0.1)
+        self._path = "/vehicles?bbox={},{},{},{}".format(
+            lon, lat, lon + VIEWPORT_SIZE, lat + VIEWPORT_SIZE)
+
+    def run(self, stats, until):
+        """ Polls the viewport until a time (see SocketClient.run). """
+        etag = None
+        try:
+            while time.time() < until:
+                start = time.time()
+                self._conn.request(
+                    "GET", self._path,
+                    headers={"If-None-Match": etag} if etag else {})
+                response = self._conn.getresponse()
+                response.read()
+                stats.request_seconds.append(time.time() - start)
+                if response.status == 304:
+                    stats.not_modified += 1
+                etag = response.getheader("ETag", etag)
+                eventlet.sleep(self.interval)
+        finally:
+            self._conn.close()
+
+
+def run_client(client, stats, until):
+    try:
+        client.run(stats, until)
+    except Exception as e:
+        stats.errors += 1
+        print >> sys.stderr, "Client {} failed: {}".format(
+            client.client_id, e)
+
+
+def get_process_tree(pid):
+    """ Returns the process IDs of a process and all of its descendants. """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as stat_f:
+                # The command name is parenthesized and may contain spaces
+                fields = stat_f.read().rsplit(")", 1)[1].split()
+        except IOError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+
+    pids = [pid]
+    for parent in pids:
+        pids.extend(children.get(parent, []))
+
+    return pids
+
+
+def get_usage(pid):
+    """ Returns the CPU seconds used and resident memory (in bytes) of a
+    process and all of its descendants.
+    """
+    cpu_seconds = 0.0
+    rss = 0
+    for tree_pid in get_process_tree(pid):
+        try:
+            with open("/proc/{}/stat".format(tree_pid)) as stat_f:
+                fields = stat_f.read().rsplit(")", 1)[1].split()
+        except IOError:
+            continue
+        # utime and stime are fields 14 and 15, and rss is field 24 of stat,
+        # counting the PID and command name
+        cpu_seconds += (int(fields[11]) + int(fields[12])) / \
+            float(os.sysconf("SC_CLK_TCK"))
+        rss += int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+
+    return cpu_seconds, rss
+
+
+def monitor(pid, samples, interval=1.0):
+    """ Samples the CPU and memory usage of the server every interval. """
+    last_time = time.time()
+    last_cpu, _ = get_usage(pid)
+    while True:
+        eventlet.sleep(interval)
+        now = time.time()
+        cpu, rss = get_usage(pid)
+        samples.append(((cpu - last_cpu) / (now - last_time), rss))
+        last_time, last_cpu = now, cpu
+
+
+def prepare_synthetic(args, work_dir):
+    """ Writes the static data of a synthetic dataset to a working
+    directory, and returns the path of an archive of synthetic feeds.
+    """
+    dataset = SyntheticDataset(args.stops, args.routes, args.trips,
+                               args.shapes, seed=args.seed)
+    dataset.write(os.path.join(work_dir, feed.dataset.static_transit_dir))
+
+    archive = os.path.join(work_dir, "feeds.lsf")
+    recorder = replay.FeedRecorder(archive)
+    for i in xrange(args.ticks):
+        now = FEED_START + timedelta(seconds=i * feed.POLL_INTERVAL)
+        raw_feed = dataset.get_feed(now).SerializeToString()
+        recorder.record(feed.dataset.feed_id, raw_feed,
+                        (now - datetime(1970, 1, 1)).total_seconds())
+    recorder.close()
+
+    return archive
+
+
+def start_server(args, work_dir, archive):
+    """ Starts app.py replaying an archive, and waits until it is ready.
+
+    Returns
+    -------
+    subprocess.Popen
+        Server process
+    """
+    if args.gtfs:
+        os.symlink(os.path.abspath(args.gtfs),
+                   os.path.join(work_dir,
+                                feed.dataset.static_transit_dir.rstrip("/")))
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [REPO_DIR] + filter(None, [env.get("PYTHONPATH")]))
+    devnull = open(os.devnull, "w")
+
+    print >> sys.stderr, "Writing static data..."
+    subprocess.check_call([sys.executable, os.path.join(REPO_DIR, "static.py"),
+                           "-goaptser"], cwd=work_dir, env=env, stdout=devnull,
+                          stderr=devnull)
+
+    command = [sys.executable, os.path.join(REPO_DIR, "app.py"),
+               "--port", str(args.port), "--replay", archive,
+               "--speed", str(args.speed), "--schedule", "off"]
+    if args.workers:
+        command += ["--workers", str(args.workers)]
+    # The server runs in its own process group, so that its reloader and
+    # workers are stopped along with it (by SIGINT, as the server does not
+    # exit on SIGTERM).
+    server = subprocess.Popen(command, cwd=work_dir, env=env, stdout=devnull,
+                              stderr=devnull, preexec_fn=os.setsid)
+
+    print >> sys.stderr, "Waiting for server..."
+    for _ in xrange(120):
+        try:
+            conn = HTTPConnection(args.host, args.port, timeout=5)
+            conn.request("GET", "/metrics")
+            if conn.getresponse().status == 200:
+                return server
+        except Exception:
+            pass
+        eventlet.sleep(1)
+
+    stop_server(server)
+    raise RuntimeError("Server did not start")
+
+
+def stop_server(server, timeout=10):
+    """ Stops a server started by start_server. """
+    # The server waits for open connections to close before exiting, so it
+    # is killed if it does not exit in time.
+    os.killpg(server.pid, signal.SIGINT)
+    for _ in xrange(timeout * 10):
+        if server.poll() is not None:
+            return
+        eventlet.sleep(.1)
+
+    os.killpg(server.pid, signal.SIGKILL)
+    server.wait()
+
+
+def get_server_counter(host, port, name):
+    """ Returns the value of a counter of the server's metrics, or None. """
+    conn = HTTPConnection(host, port, timeout=10)
+    conn.request("GET", "/metrics")
+    for line in conn.getresponse().read().splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[1])
+
+    return None
+
+
+def percentiles(values):
+    """ Returns map of percentile -> value of a list of values. """
+    values = sorted(values)
+    if not values:
+        return {}
+
+    return {
+        name: values[min(int(len(values) * fraction), len(values) - 1)]
+        for name, fraction in [("p50", .5), ("p90", .9), ("p99", .99),
+                               ("max", 1.0)]
+    }
+
+
+def report(args, stats, samples, dropped_by_server):
+    """ Returns the results of a run. """
+    # Delivery latency of a frame to a client is measured from the first
+    # client to receive that frame, i.e. it is the fan-out delay.
+    latencies = []
+    for receipts in stats.frame_receipts:
+        first = min(receipts)
+        latencies.extend(receipt - first for receipt in receipts)
+
+    socket_clients = args.clients - args.viewport_clients
+    frames = len(stats.frame_receipts)
+    missed = sum(frames - len(stats.client_frames.get(client_id, ()))
+                 for client_id in xrange(socket_clients))
+
+    return {
+        "clients": args.clients,
+        "slow_clients": args.slow_clients,
+        "viewport_clients": args.viewport_clients,
+        "frames": frames,
+        "deliveries": len(latencies),
+        "delivery_seconds": percentiles(latencies),
+        "frames_missed_by_clients": missed,
+        "frames_dropped_by_server": dropped_by_server,
+        "viewport_requests": len(stats.request_seconds),
+        "viewport_not_modified": stats.not_modified,
+        "viewport_seconds": percentiles(stats.request_seconds),
+        "client_errors": stats.errors,
+        "server_cpu": percentiles([cpu for cpu, _ in samples]),
+        "server_rss_bytes": percentiles([rss for _, rss in samples])
+    }
+
+
+def run(args, work_dir):
+    """ Runs the load test, and returns its results. """
+    archive = args.archive
+    if archive is None and not args.url:
+        print >> sys.stderr, "Generating synthetic dataset..."
+        archive = prepare_synthetic(args, work_dir)
+
+    server = None
+    if not args.url:
+        server = start_server(args, work_dir, archive)
+        pid = server.pid
+    else:
+        args.host, args.port = args.url.rsplit(":", 1)
+        args.port = int(args.port)
+        pid = args.pid
+
+    try:
+        stats = Stats()
+        samples = []
+        if pid is not None:
+            monitor_thread = eventlet.spawn(monitor, pid, samples)
+
+        until = time.time() + args.ramp + args.duration
+        interval = feed.POLL_INTERVAL / args.speed
+        clients = []
+        for client_id in xrange(args.clients):
+            if client_id >= args.clients - args.viewport_clients:
+                client = ViewportClient(client_id, args.host, args.port,
+                                        interval)
+            else:
+                client = SocketClient(
+                    client_id, args.host, args.port,
+                    args.slow_delay if client_id < args.slow_clients else 0)
+            clients.append(eventlet.spawn(run_client, client, stats, until))
+            eventlet.sleep(float(args.ramp) / args.clients)
+
+        print >> sys.stderr, "All {} clients started.".format(args.clients)
+        for client in clients:
+            client.wait()
+
+        dropped = get_server_counter(args.host, args.port,
+                                     "livesubway_frames_dropped_total")
+        if pid is not None:
+            monitor_thread.kill()
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    return report(args, stats, samples, dropped)
+
+
+def get_parser():
+    """ Returns argument parser. """
+    parser = ArgumentParser(
+        description="A script to load test the server with simulated map " +
+        "viewers. Starts app.py replaying synthetic or recorded feeds (or " +
+        "targets a running server with --url), and reports delivery " +
+        "latency, dropped frames and server CPU and memory. Run from the " +
+        "root of the repository with python -m scripts.loadgen."
+    )
+    parser.add_argument("--clients", type=int, default=500,
+                        help="Number of simulated clients")
+    parser.add_argument("--slow-clients", type=int, default=50,
+                        help="Number of clients that read slowly")
+    parser.add_argument("--slow-delay", type=float, default=10,
+                        help="Seconds slow clients wait after each frame")
+    parser.add_argument("--viewport-clients", type=int, default=50,
+                        help="Number of clients polling the vehicles of a " +
+                        "viewport over HTTP instead of Socket.IO")
+    parser.add_argument("--duration", type=float, default=60,
+                        help="Seconds to run once all clients are started")
+    parser.add_argument("--ramp", type=float, default=10,
+                        help="Seconds over which to start the clients")
+    parser.add_argument("--speed", type=float, default=10,
+                        help="Speed of replay relative to real time")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Number of worker processes of the server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--url",
+                        help="host:port of a running server to target " +
+                        "instead of starting one")
+    parser.add_argument("--pid", type=int,
+                        help="Process ID of the running server, to report " +
+                        "its CPU and memory")
+    parser.add_argument("--archive",
+                        help="Feed archive to replay instead of synthetic " +
+                        "feeds (requires --gtfs)")
+    parser.add_argument("--gtfs",
+                        help="GTFS directory to use instead of synthetic data")
+    parser.add_argument("--stops", type=int, default=400,
+                        help="Number of parent stations of synthetic data")
+    parser.add_argument("--routes", type=int, default=24,
+                        help="Number of routes of synthetic data")
+    parser.add_argument("--trips", type=int, default=20000,
+                        help="Number of trips of synthetic data")
+    parser.add_argument("--shapes", type=int, default=6,
+                        help="Number of shapes per route of synthetic data")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of synthetic data")
+    parser.add_argument("--ticks", type=int, default=20,
+                        help="Number of synthetic feeds to replay")
+    parser.add_argument("--output",
+                        help="File to write results to as JSON")
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.archive and not args.gtfs and not args.url:
+        get_parser().error("--archive requires --gtfs")
+    work_dir = tempfile.mkdtemp(prefix="livesubway-loadgen-")
+
+    try:
+        results = run(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_f:
+            output_f.write(output)
+    else:
+        print output
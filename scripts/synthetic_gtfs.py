@@ -0,0 +1,371 @@
+import csv
+import os
+import random
+
+from argparse import ArgumentParser
+from datetime import date, datetime, time, timedelta
+
+# Synthetic datasets mirror the conventions of the MTA's static subway data,
+# since static.py parses these directly out of the IDs: trip IDs are of the
+# form "<service ID>_<origin time>_<trip path>", service IDs end in the
+# service code, trip paths are of the form "<route>..<direction><pattern>"
+# and platform stop IDs are the parent station ID suffixed by the direction.
+SERVICE_CODES = ["WKD", "SAT", "SUN"]
+DIRECTIONS = ["N", "S"]
+ROUTE_NAMES = "1234567ABCDEFGJLMNQRWZ"
+ROUTE_COLORS = ["EE352E", "00933C", "B933AD", "0039A6", "FF6319", "6CBE45",
+                "996633", "A7A9AC", "FCCC0A", "808183"]
+
+# Start date of the synthetic schedule (a Sunday, as with the MTA's data).
+START_DATE = date(2016, 11, 6)
+
+SECONDS_PER_HOP = 90
+DWELL_SECONDS = 30
+
+
+class SyntheticDataset:
+    """ SyntheticDataset class.
+
+    Used primarily to generate a reproducible GTFS dataset of configurable
+    size in the format of the MTA's static subway data, along with matching
+    GTFS-realtime feeds, so that the static build and the live pipeline can be
+    exercised without the real data.
+
+    Routes are laid out along a handful of corridors shared between routes,
+    so that (as in the real data) the shapes of different routes and route
+    patterns overlap heavily.
+    """
+    def __init__(self, stops=100, routes=10, trips=2000, shapes=4,
+                 points_between=4, seed=0):
+        """ Constructor.
+
+        Arguments
+        ---------
+        stops: int
+            Number of parent stations
+        routes: int
+            Number of routes
+        trips: int
+            Total number of trips over all service codes
+        shapes: int
+            Number of shapes (trip paths) per route
+        points_between: int
+            Number of shape points between adjacent stations
+        seed: int
+            Seed for the random number generator
+        """
+        self._random = random.Random(seed)
+        self.routes = [ROUTE_NAMES[i % len(ROUTE_NAMES)] * (i // len(
+            ROUTE_NAMES) + 1) for i in xrange(routes)]
+        self.corridors = self._get_corridors(stops, max(1, routes // 3),
+                                             points_between)
+        self.trip_paths = self._get_trip_paths(shapes)
+        self.trips = self._get_trips(trips)
+
+    def _get_corridors(self, num_stops, num_corridors, points_between):
+        """ Returns list of corridors, each a pair of the list of station IDs
+        along the corridor and the list of points along the corridor, with
+        the indices of the stations in the list of points.
+        """
+        corridors = []
+        stop_id = 100
+
+        for i in xrange(num_corridors):
+            count = num_stops // num_corridors + \
+                (1 if i < num_stops % num_corridors else 0)
+            lon = -74.0 + 0.02 * i
+            lat = 40.6
+            stations = []
+            points = []
+
+            for j in xrange(count):
+                stop_id += 1
+                stations.append((str(stop_id), len(points),
+                                 "Station {} St".format(stop_id)))
+                points.append((round(lon, 6), round(lat, 6)))
+                if j == count - 1:
+                    break
+
+                d_lon = self._random.uniform(-0.004, 0.004)
+                d_lat = self._random.uniform(0.004, 0.01)
+                for k in xrange(1, points_between + 1):
+                    fraction = float(k) / (points_between + 1)
+                    jitter = self._random.uniform(-0.0005, 0.0005)
+                    points.append((round(lon + fraction * d_lon + jitter, 6),
+                                   round(lat + fraction * d_lat, 6)))
+                lon += d_lon
+                lat += d_lat
+
+            corridors.append((stations, points))
+
+        return corridors
+
+    def _get_trip_paths(self, shapes):
+        """ Returns list of trip paths, each a tuple of the trip path ID,
+        route, list of points along the shape, and list of indices of the
+        stations (along the corridor) that the trip path stops at.
+        """
+        trip_paths = []
+
+        for i, route in enumerate(self.routes):
+            stations, points = self.corridors[i % len(self.corridors)]
+            for j in xrange(shapes):
+                direction = DIRECTIONS[j % 2]
+                variant = j // 2
+                # Variants alternate between short turns, which skip the
+                # ends of the corridor, and expresses, which skip every
+                # other station in between.
+                first, last = 0, len(stations) - 1
+                if variant % 2 == 1:
+                    first = min(variant, last // 4)
+                    last = max(last - variant, first + 1)
+                stop_indices = range(first, last + 1)
+                if variant and variant % 2 == 0:
+                    stop_indices = stop_indices[::2] + \
+                        ([last] if (last - first) % 2 else [])
+
+                start_point = stations[first][1]
+                end_point = stations[last][1]
+                shape = points[start_point:end_point + 1]
+                if direction == "S":
+                    shape = shape[::-1]
+                    stop_indices = stop_indices[::-1]
+
+                trip_path = "{}..{}{:02d}R".format(route, direction, variant)
+                trip_paths.append((trip_path, route, shape, stations,
+                                   stop_indices))
+
+        return trip_paths
+
+    def _get_trips(self, num_trips):
+        """ Returns list of trips, each a tuple of the trip ID, service code,
+        origin time in seconds since midnight and index of the trip path.
+        """
+        trips = []
+        per_path = max(1, num_trips // (len(self.trip_paths) *
+                                        len(SERVICE_CODES)))
+
+        for service_code in SERVICE_CODES:
+            service_id = "A{}{}".format(START_DATE.strftime("%Y%m%d"),
+                                        service_code)
+            for i, trip_path in enumerate(self.trip_paths):
+                for j in xrange(per_path):
+                    # Spread trips from 5 AM to 1 AM the next day
+                    origin = 5 * 3600 + j * 20 * 3600 // per_path + \
+                        self._random.randint(0, 59)
+                    # NYCT origin times are in hundredths of a minute
+                    origin_time = "{:06d}".format(origin * 100 // 60)
+                    trip_id = "{}_{}_{}".format(service_id, origin_time,
+                                                trip_path[0])
+                    trips.append((trip_id, service_id, origin, i))
+
+        return trips
+
+    @staticmethod
+    def _format_time(seconds):
+        """ Returns GTFS time string of seconds since midnight. """
+        return "{:02d}:{:02d}:{:02d}".format(seconds // 3600,
+                                             seconds // 60 % 60,
+                                             seconds % 60)
+
+    def get_stop_times(self, trip):
+        """ Returns list of (stop ID, arrival, departure) tuples of a trip,
+        with times in seconds since midnight.
+        """
+        trip_id, service_id, origin, index = trip
+        trip_path, route, shape, stations, stop_indices = \
+            self.trip_paths[index]
+        direction = trip_path.split("..")[1][0]
+        stop_times = []
+        arrival = origin
+
+        for k, station_index in enumerate(stop_indices):
+            if k:
+                hops = abs(station_index - stop_indices[k - 1])
+                arrival += hops * SECONDS_PER_HOP
+            stop_id = stations[station_index][0] + direction
+            stop_times.append((stop_id, arrival, arrival + DWELL_SECONDS))
+            arrival += DWELL_SECONDS
+
+        return stop_times
+
+    def write(self, directory):
+        """ Writes the dataset as GTFS .txt files.
+
+        Arguments
+        ---------
+        directory: str
+            Directory to write the dataset to
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        def writer(name, header):
+            f = open(os.path.join(directory, name), "wb")
+            csv_writer = csv.writer(f)
+            csv_writer.writerow(header)
+            return f, csv_writer
+
+        f, w = writer("agency.txt", ["agency_id", "agency_name",
+                                     "agency_url", "agency_timezone"])
+        w.writerow(["MTA NYCT", "MTA New York City Transit",
+                    "http://www.mta.info", "America/New_York"])
+        f.close()
+
+        f, w = writer("stops.txt", ["stop_id", "stop_name", "stop_lat",
+                                    "stop_lon", "location_type",
+                                    "parent_station"])
+        for stations, points in self.corridors:
+            for stop_id, point_index, name in stations:
+                lon, lat = points[point_index]
+                w.writerow([stop_id, name, lat, lon, 1, ""])
+                for direction in DIRECTIONS:
+                    w.writerow([stop_id + direction, name, lat, lon, "",
+                                stop_id])
+        f.close()
+
+        f, w = writer("routes.txt", ["route_id", "agency_id",
+                                     "route_short_name", "route_long_name",
+                                     "route_type", "route_color"])
+        for i, route in enumerate(self.routes):
+            w.writerow([route, "MTA NYCT", route, "Route " + route, 1,
+                        ROUTE_COLORS[i % len(ROUTE_COLORS)]])
+        f.close()
+
+        f, w = writer("calendar.txt", ["service_id", "monday", "tuesday",
+                                       "wednesday", "thursday", "friday",
+                                       "saturday", "sunday", "start_date",
+                                       "end_date"])
+        end_date = START_DATE + timedelta(days=365)
+        for service_code, days in zip(SERVICE_CODES, [[1] * 5 + [0, 0],
+                                                      [0] * 5 + [1, 0],
+                                                      [0] * 6 + [1]]):
+            service_id = "A{}{}".format(START_DATE.strftime("%Y%m%d"),
+                                        service_code)
+            w.writerow([service_id] + days +
+                       [START_DATE.strftime("%Y%m%d"),
+                        end_date.strftime("%Y%m%d")])
+        f.close()
+
+        f, w = writer("shapes.txt", ["shape_id", "shape_pt_lat",
+                                     "shape_pt_lon", "shape_pt_sequence",
+                                     "shape_dist_traveled"])
+        for trip_path, route, shape, stations, stop_indices in \
+                self.trip_paths:
+            for i, (lon, lat) in enumerate(shape):
+                w.writerow([trip_path, lat, lon, i, ""])
+        f.close()
+
+        f, w = writer("trips.txt", ["route_id", "service_id", "trip_id",
+                                    "trip_headsign", "direction_id",
+                                    "shape_id"])
+        for trip in self.trips:
+            trip_id, service_id, origin, index = trip
+            trip_path, route = self.trip_paths[index][:2]
+            direction_id = DIRECTIONS.index(trip_path.split("..")[1][0])
+            w.writerow([route, service_id, trip_id, trip_path, direction_id,
+                        trip_path])
+        f.close()
+
+        f, w = writer("stop_times.txt", ["trip_id", "arrival_time",
+                                         "departure_time", "stop_id",
+                                         "stop_sequence"])
+        for trip in self.trips:
+            for i, (stop_id, arrival, departure) in \
+                    enumerate(self.get_stop_times(trip)):
+                w.writerow([trip[0], SyntheticDataset._format_time(arrival),
+                            SyntheticDataset._format_time(departure),
+                            stop_id, i + 1])
+        f.close()
+
+    def get_feed(self, now):
+        """ Returns a GTFS-realtime feed of all trips running at a given
+        time, in the format of the MTA's subway feed.
+
+        Arguments
+        ---------
+        now: datetime.datetime
+            Time of the feed
+
+        Returns
+        -------
+        transit_realtime.FeedMessage
+            GTFS realtime FeedMessage object (protobuf)
+        """
+        import gtfs_realtime_pb2 as gtfs
+
+        weekday = now.isoweekday()
+        service_code = SERVICE_CODES[0 if weekday <= 5 else weekday - 5]
+        seconds = now.hour * 3600 + now.minute * 60 + now.second
+        midnight = datetime.combine(now.date(), time())
+        epoch = datetime(1970, 1, 1)
+        midnight_timestamp = int((midnight - epoch).total_seconds())
+
+        feed = gtfs.FeedMessage()
+        feed.header.gtfs_realtime_version = "1.0"
+        feed.header.timestamp = midnight_timestamp + seconds
+
+        for trip in self.trips:
+            trip_id, service_id, origin, index = trip
+            if not service_id.endswith(service_code) or origin > seconds:
+                continue
+
+            stop_times = self.get_stop_times(trip)
+            if stop_times[-1][1] < seconds:
+                continue
+
+            # The next stop of the train is the first stop it has not yet
+            # departed from
+            next_stop = next(i for i, stop_time in enumerate(stop_times)
+                             if stop_time[2] >= seconds)
+            live_trip_id = trip_id.split("_", 1)[1]
+            route = self.trip_paths[index][1]
+
+            entity = feed.entity.add()
+            entity.id = str(len(feed.entity))
+            trip_update = entity.trip_update
+            trip_update.trip.trip_id = live_trip_id
+            trip_update.trip.start_date = now.strftime("%Y%m%d")
+            trip_update.trip.route_id = route
+            for stop_id, arrival, departure in stop_times[next_stop:]:
+                stop_time_update = trip_update.stop_time_update.add()
+                stop_time_update.stop_id = stop_id
+                stop_time_update.arrival.time = midnight_timestamp + arrival
+                stop_time_update.departure.time = \
+                    midnight_timestamp + departure
+
+            entity = feed.entity.add()
+            entity.id = str(len(feed.entity))
+            vehicle = entity.vehicle
+            vehicle.trip.CopyFrom(trip_update.trip)
+            vehicle.current_stop_sequence = next_stop + 1
+            vehicle.stop_id = stop_times[next_stop][0]
+            vehicle.timestamp = feed.header.timestamp
+
+        return feed
+
+
+def get_parser():
+    """ Returns argument parser. """
+    parser = ArgumentParser(
+        description="A script to generate a synthetic GTFS dataset."
+    )
+    parser.add_argument("directory", help="Directory to write dataset to")
+    parser.add_argument("--stops", type=int, default=100,
+                        help="Number of parent stations")
+    parser.add_argument("--routes", type=int, default=10,
+                        help="Number of routes")
+    parser.add_argument("--trips", type=int, default=2000,
+                        help="Total number of trips")
+    parser.add_argument("--shapes", type=int, default=4,
+                        help="Number of shapes per route")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the random number generator")
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    SyntheticDataset(args.stops, args.routes, args.trips, args.shapes,
+                     seed=args.seed).write(args.directory)
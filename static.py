@@ -1,29 +1,55 @@
 import cPickle as pickle
+import copy_reg
+import heapq
+import math
 import os
+import re
+import zlib
 
 from argparse import ArgumentParser
+from array import array
 from bisect import bisect_left
-from collections import namedtuple
-from datetime import date
+from collections import OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 
 import simplejson as json
 import transitfeed
 
-# TODO: Move this to a database, or make it more efficient in general
+from datasets import (DATASETS, DEFAULT_DATASET, SAT_SERVICE_CODE,
+                      STATIONS_FILE, SUN_SERVICE_CODE, TIMEZONE_FILE,
+                      WEEKDAY_SERVICE_CODE, get_dataset)
 
-JSON_DIR = "static/json/"
-PICKLE_DIR = ".cache/"
-STATIC_TRANSIT_DIR = "static_transit/"
+# TODO: Move this to a database, or make it more efficient in general
 
-if not os.path.isdir(JSON_DIR):
-    os.makedirs(JSON_DIR)
-if not os.path.isdir(PICKLE_DIR):
-    os.makedirs(PICKLE_DIR)
+# Base and modulus of the polynomial fingerprints of sequences of stops
+FINGERPRINT_BASE = 1000003
+FINGERPRINT_MODULUS = (1 << 61) - 1
+# Most paths between pairs of stations cached by a StopGraph; every edge is
+# a pair, so this should be well above the number of edges
+MAX_CACHED_PATHS = 4096
+# Seconds per time bucket of the schedule index
+SCHEDULE_BUCKET_SECONDS = 300
+# Files are written to the pickle directory of their dataset
+TRIP_SEQUENCES_FILE = "trip_sequences.pkl"
+# Marks stop sequences with no stop in the trip sequences table
+NO_STOP = 0xFFFF
+# Written after all other files, so that app.py can pick up a new version
+VERSION_FILE = "version"
+# Seconds to change trains within a station, or between stations linked in
+# transfers.txt, if no minimum transfer time is given
+DEFAULT_TRANSFER_SECONDS = 180
+# Minimum fraction of the trigrams of a search in a stop name for the stop
+# to match a search that matches no words of stop names (e.g. a typo)
+MIN_TRIGRAM_MATCH = 0.5
 
 Segment = namedtuple('Segment', ['start', 'end'])
-Edge = namedtuple('Edge', ['shape_id', 'start_index', 'end_index'])
+Edge = namedtuple('Edge', ['shape_id', 'tracks'])
 StopID = namedtuple('StopID',
                     ['route', 'stop_id'])
+ScheduledPosition = namedtuple('ScheduledPosition',
+                               ['trip_id', 'route', 'prev_stop', 'stop',
+                                'progress', 'remaining_time'])
 
 
 class Coordinates(namedtuple('Coordinates', ['lon', 'lat'])):
@@ -33,65 +59,64 @@ class Coordinates(namedtuple('Coordinates', ['lon', 'lat'])):
     def array(self):
         return [self.lon, self.lat]
 
-WEEKDAY_SERVICE_CODE = "WKD"
-SAT_SERVICE_CODE = "SAT"
-SUN_SERVICE_CODE = "SUN"
-
-# We group routes by their "color" designation into sets; the reason for this
-# is that routes in a particular route group have overlap and cover overlapping
-# stops, at least in Manhattan. Thus, often times for maintenace or other
-# purposes, a train on one of these routes may be routed to another route in
-# the same group, such as a 3 train running local, which would mean it would
-# run a similar set of stops as a normal 1 train. However, this type of
-# situation is currently not covered in the static data, so we group these
-# routes up when looking at the live feed and determining what the previous
-# stop of a subway car may be from the static data.
-ROUTE_GROUPS = [
-    set(["1", "2", "3"]),
-    set(["4", "5", "6"]),
-    set(["A", "C", "E"]),
-    set(["B", "D", "F", "M"]),
-    set(["J", "Z"]),
-    set(["N", "Q", "R", "W"])
-]
-ROUTE_GROUP_MAPPING = {
-    route: route_group
-    for route_group in ROUTE_GROUPS
-    for route in route_group
-}
 
-# Currently the new South Ferry station is closed due to the effects of
-# Hurricane Sandy, forcing the old South Ferry station to be recommissioned
-# repairs are done. However, while this is accurate in shapes.txt, the new stop
-# is still being used in stops.txt, and so we replace occurrences of the new
-# South Ferry stop with the old one until the static information is updated.
-OLD_SOUTH_FERRY = Coordinates(-74.013664, 40.702068)
-NEW_SOUTH_FERRY = Coordinates(-74.013205, 40.701411)
-
-# shapes.txt currently has a hole containing the York St. stop for some reason,
-# so currently while we still refer to the York St. stop as a real stop,
-# currently for purposes of convenience, we store the corresponding edge as
-# the closest point to the York St. stop, and simply use this as the other
-# endpoint. Moreover, since the York St. stop is not in shapes.txt, we also
-# provide relevant information for the stop ID/shape for creating the edges.
-#
-# We may be able to have two approximate points depending on the
-# direction of the segment, but not entirely sure if this is necessary.
-# Hopefully this gets fixed in a future iteration of the static transit
-# information.
-YORK_STREET = Coordinates(-73.986751, 40.701397)
-YORK_STREET_APPROX = Coordinates(-73.986885, 40.699743)
-YORK_STREET_ID = "F18"
-YORK_STREET_SHAPE = "F..N68R"
-
-# The script currently skips paths that go along the Second Avenue Subway Line,
-# as these are part of the new N/Q (and soon to be T) lines that open up in
-# January 2017. While this data is provided as part of stops/stop_times, the
-# shapes are not provided in shapes.txt, so we skip these paths until the
-# static information is eventually updated (hopefully the next iteration once
-# the lines begin operation).
-SECOND_AVE_PATHS = set(["N..N63R", "N..N67R", "N..S16R", "Q..N16R", "Q..N19R",
-                        "Q..S16R", "Q..S19R"])
+def get_service_code(day):
+    """ Returns the service code (i.e. WKD, SAT or SUN) of a day.
+
+    Arguments
+    ---------
+    day: datetime.date
+        Date of service day
+
+    Returns
+    -------
+    str
+        service code of day
+    """
+    day_of_week = day.isoweekday()
+
+    if day_of_week <= 5:
+        return WEEKDAY_SERVICE_CODE
+    elif day_of_week == 6:
+        return SAT_SERVICE_CODE
+    else:
+        return SUN_SERVICE_CODE
+
+
+def get_fingerprint(stop_ids):
+    """ Returns the fingerprint of a sequence of stops.
+
+    Fingerprints are polynomial hashes computed from the last stop to the
+    first, so that the fingerprints of every suffix of a sequence of stops
+    can be computed in a single pass from its end.
+
+    Arguments
+    ---------
+    stop_ids: list[str]
+        List of stop IDs
+
+    Returns
+    -------
+    int
+        Fingerprint of stop IDs
+    """
+    fingerprint = 0
+    for stop_id in reversed(stop_ids):
+        fingerprint = add_fingerprint(fingerprint, stop_id)
+
+    return fingerprint
+
+
+def add_fingerprint(fingerprint, stop_id):
+    """ Returns the fingerprint of a sequence of stops prefixed by a stop,
+    given the fingerprint of the sequence (see get_fingerprint).
+    """
+    # Stop IDs of the schedule and the feed may be unicode, which crc32
+    # only takes if it is ASCII
+    if isinstance(stop_id, unicode):
+        stop_id = stop_id.encode("utf-8")
+    return (fingerprint * FINGERPRINT_BASE +
+            (zlib.crc32(stop_id) & 0xffffffff) + 1) % FINGERPRINT_MODULUS
 
 
 class Stop:
@@ -113,7 +138,7 @@ class Stop:
         Arguments
         ---------
         stop_sequence: int
-            Stop sequence of stop along a trip path
+            Position of stop along a trip path, counting from 1
         prev_stop: str
             Stop ID of preceding stop along a trip path
         trip_path: str
@@ -139,20 +164,27 @@ class PrevStops:
     This information is needed in order to render the duration of the path
     of the subway car.
     """
-    def __init__(self, schedule):
+    def __init__(self, schedule, dataset):
         """ Constructor.
 
         Arguments
         ---------
         schedule: transitfeed.Schedule
             Schedule object
+        dataset: datasets.Dataset
+            Dataset of schedule
         """
-        self._all_prev_stops = PrevStops._get_all_prev_stops(schedule)
+        self._dataset = dataset
+        self._all_prev_stops = PrevStops._get_all_prev_stops(schedule,
+                                                             dataset)
         self._ambiguous_trips = \
             PrevStops._get_ambiguous_trip_paths(self._all_prev_stops)
         self._ambiguous_stop_sequences = \
             PrevStops._get_ambiguous_stop_sequences(self._ambiguous_trips,
-                                                    schedule)
+                                                    schedule, dataset)
+        self._prev_stops_by_suffix = \
+            PrevStops._get_prev_stops_by_suffix(self._all_prev_stops,
+                                                schedule, dataset)
 
     @staticmethod
     def _get_service_code(trip):
@@ -171,19 +203,11 @@ class PrevStops:
         start_date = trip.start_date
         year, month, day = int(start_date[:4]), int(start_date[4:6]), \
             int(start_date[6:])
-        day_of_week = date(year, month, day).isoweekday()
-
-        if day_of_week <= 5:
-            service_code = WEEKDAY_SERVICE_CODE
-        elif day_of_week == 6:
-            service_code = SAT_SERVICE_CODE
-        else:
-            service_code = SUN_SERVICE_CODE
 
-        return service_code
+        return get_service_code(date(year, month, day))
 
     @staticmethod
-    def _get_all_prev_stops(schedule):
+    def _get_all_prev_stops(schedule, dataset):
         """ Returns map of StopID -> Stop object for every possible
         StopID in the static transit data.
 
@@ -191,6 +215,8 @@ class PrevStops:
         ---------
         schedule: transitfeed.Schedule
             Schedule object
+        dataset: datasets.Dataset
+            Dataset of schedule
 
         Returns
         -------
@@ -201,16 +227,19 @@ class PrevStops:
         trip_paths = set()
 
         for trip_object in schedule.GetTripList():
-            trip_path = trip_object.trip_id.rsplit("_", 1)[1]
+            trip_path = dataset.get_trip_path(trip_object)
             route = trip_object.route_id
 
             # No need to duplicate work over trip paths already seen,
             # since a trip path uniquely defines a sequence of stops
             if trip_path not in trip_paths:
                 stop_times = trip_object.GetStopTimes()
-                for stop_time in stop_times:
+                # Stop sequences are taken as the position of each stop along
+                # the trip, since those of stop_times.txt need only increase
+                # (see datasets.Dataset.get_stop_sequence)
+                for i, stop_time in enumerate(stop_times):
                     stop_id = stop_time.stop.stop_id
-                    stop_sequence = stop_time.stop_sequence
+                    stop_sequence = i + 1
                     stop_id = StopID(route, stop_id)
 
                     if stop_id not in all_prev_stops:
@@ -220,10 +249,8 @@ class PrevStops:
 
                     # We ignore the case where the stop is at the beginning,
                     # since clearly there is no previous stop
-                    if stop_sequence > 1:
-                        # Subtract 2 because we need to access previous stop,
-                        # and stop_sequence is 1-indexed, rather than 0-indexed
-                        prev_stop = stop_times[stop_sequence - 2].stop.stop_id
+                    if i > 0:
+                        prev_stop = stop_times[i - 1].stop.stop_id
                         stop.add_prev_stop(stop_sequence, prev_stop, trip_path)
 
                 trip_paths.add(trip_path)
@@ -283,7 +310,8 @@ class PrevStops:
         return ambiguous_trip_paths
 
     @staticmethod
-    def _get_ambiguous_stop_sequences(ambiguous_trip_paths, schedule):
+    def _get_ambiguous_stop_sequences(ambiguous_trip_paths, schedule,
+                                      dataset):
         """ Returns map of StopID -> map of possible previous
         stops for that particular StopID over all trips containing the
         info of the StopID, keyed by service code and sorted by origin time
@@ -309,6 +337,8 @@ class PrevStops:
             on the trip path
         schedule: transitfeed.Schedule
             Schedule object
+        dataset: datasets.Dataset
+            Dataset of schedule
 
         Returns
         -------
@@ -321,10 +351,19 @@ class PrevStops:
         # Populate pairs of origin times + corresponding previous stops for
         # each possible trip path for a given StopID + service code
         for trip_object in schedule.GetTripList():
-            service_code = trip_object.service_id[-3:]
-            origin_time, trip_path = trip_object.trip_id.split("_")[1:]
+            trip_path = dataset.get_trip_path(trip_object)
+            if trip_path not in ambiguous_trip_paths:
+                continue
+
+            # Trips are told apart by origin time, so that trips of
+            # datasets whose trip IDs do not carry it are skipped
+            origin_time = dataset.get_origin_time(
+                dataset.get_live_trip_id(trip_object))
+            if origin_time is None:
+                continue
 
-            if trip_path in ambiguous_trip_paths:
+            for service_code in dataset.get_service_codes(trip_object,
+                                                          schedule):
                 for stop_id, prev_stop in ambiguous_trip_paths[trip_path]:
                     if stop_id not in ambiguous_stop_sequences:
                         ambiguous_stop_sequences[stop_id] = {}
@@ -356,14 +395,78 @@ class PrevStops:
 
         return ambiguous_stop_sequences
 
-    def get_prev_stop(self, vehicle):
+    @staticmethod
+    def _get_prev_stops_by_suffix(all_prev_stops, schedule, dataset):
+        """ Returns map of (route, fingerprint of stops) -> previous stop,
+        for the remainder of every trip path from each stop with more than
+        one possible previous stop.
+
+        The live feed lists the stops a trip has yet to make, starting with
+        the stop the subway car is headed to; for the stops that are
+        ambiguous, this sequence of stops is usually enough to tell apart
+        the trip paths through the stop, and thus the previous stop. Stop
+        sequences are fingerprinted (see get_fingerprint) so that only a
+        number is stored for each suffix of a trip path.
+
+        Suffixes shared by trip paths with different previous stops are
+        mapped to None, since they are still ambiguous.
+
+        Arguments
+        ---------
+        all_prev_stops: dict[StopID -> Stop]
+            Map of StopID -> Stop object
+        schedule: transitfeed.Schedule
+            Schedule object
+        dataset: datasets.Dataset
+            Dataset of schedule
+
+        Returns
+        -------
+        dict[tuple[str, int] -> str]
+            Map of (route, fingerprint of stop IDs of remaining stops) ->
+            stop ID of previous stop, or None if ambiguous
+        """
+        prev_stops_by_suffix = {}
+        trip_paths = set()
+
+        for trip_object in schedule.GetTripList():
+            trip_path = dataset.get_trip_path(trip_object)
+            if trip_path in trip_paths:
+                continue
+            trip_paths.add(trip_path)
+
+            route = trip_object.route_id
+            stop_ids = [stop_time.stop.stop_id
+                        for stop_time in trip_object.GetStopTimes()]
+            fingerprint = 0
+            for i in xrange(len(stop_ids) - 1, 0, -1):
+                fingerprint = add_fingerprint(fingerprint, stop_ids[i])
+                stop = all_prev_stops[StopID(route, stop_ids[i])]
+                if len(stop.prev_stops) <= 1:
+                    continue
+
+                key = (route, fingerprint)
+                if key not in prev_stops_by_suffix:
+                    prev_stops_by_suffix[key] = stop_ids[i - 1]
+                elif prev_stops_by_suffix[key] != stop_ids[i - 1]:
+                    prev_stops_by_suffix[key] = None
+
+        return prev_stops_by_suffix
+
+    def get_prev_stop(self, vehicle, upcoming_stops=None):
         """ Returns a possible previous stop for a given trip
         and stop.
 
+        Raises a KeyError if the stop is not on any known route.
+
         Arguments
         ---------
         vehicle: transit_realtime.VehiclePosition
             GTFS realtime VehiclePosition object (protobuf)
+        upcoming_stops: list[str]
+            Stop IDs of the stops the trip has yet to make, starting with
+            the stop of the vehicle (i.e. the stop time updates of the trip),
+            if known; used to tell apart trip paths through the stop
 
         Returns
         -------
@@ -371,18 +474,18 @@ class PrevStops:
             stop ID of possible previous stop
         """
         trip = vehicle.trip
-        route = trip.trip_id.split("_")[1].split(".")[0]
+        route = self._dataset.get_route(trip)
         stop_id = StopID(
             route,
             vehicle.stop_id
         )
-        stop_sequence = vehicle.current_stop_sequence
+        stop_sequence = self._dataset.get_stop_sequence(vehicle)
 
         if stop_id in self._all_prev_stops:
             stop = self._all_prev_stops[stop_id]
         # If the stop ID is not present, perhaps the car has switched
-        # to another route; see the comments for the ROUTE_GROUPS constant
-        # at the top. Unfortunately this isn't a perfect method, since it
+        # to another route; see the comments for the datasets.ROUTE_GROUPS
+        # constant. Unfortunately this isn't a perfect method, since it
         # does not necessarily correctly determine what the actual route it
         # switched to, but this information is not necessarily known just
         # from the vehicle itself (one needs to look either at live trip
@@ -390,7 +493,7 @@ class PrevStops:
         # find the first match and break.
         else:
             alternative_found = False
-            for route in ROUTE_GROUP_MAPPING[route]:
+            for route in self._dataset.get_route_group(route):
                 stop_id = StopID(route, vehicle.stop_id)
                 if stop_id in self._all_prev_stops:
                     stop = self._all_prev_stops[stop_id]
@@ -403,12 +506,18 @@ class PrevStops:
             # above, this is not a perfect method, since we simply find the
             # first match and break.
             if not alternative_found:
-                for route_group in ROUTE_GROUPS:
+                for route_group in self._dataset.route_groups:
                     for route in route_group:
                         stop_id = StopID(route, vehicle.stop_id)
                         if stop_id in self._all_prev_stops:
                             stop = self._all_prev_stops[stop_id]
+                            alternative_found = True
                             break
+                    if alternative_found:
+                        break
+
+            if not alternative_found:
+                raise KeyError(vehicle.stop_id)
 
         # If vehicle is at the beginning of its trip, there is
         # obviously no previous stop
@@ -426,6 +535,15 @@ class PrevStops:
                 if len(prev_stops) == 1:
                     return next(iter(prev_stops))
 
+            # Otherwise, if the upcoming stops of the trip match the
+            # remainder of trip paths with a unique previous stop, return
+            # that previous stop
+            if upcoming_stops and upcoming_stops[0] == stop_id.stop_id:
+                prev_stop = self._prev_stops_by_suffix.get(
+                    (stop_id.route, get_fingerprint(upcoming_stops)))
+                if prev_stop is not None:
+                    return prev_stop
+
             # Otherwise, if the stop sequence number with the StopID
             # does not guarantee a unique previous stop, or the stop
             # sequence number does not match with a known number,
@@ -456,14 +574,10 @@ class PrevStops:
         this is all of the information that is guaranteed by
         a particular Vehicle in the feed.
 
-        One can use future stops to match with possible trips
-        or partial string matching in case an actual trip path ID
-        is given at a certain point, but not entirely sure if the
-        effort is worth it; out of the few observations of the live
-        feed so far, this case isn't encountered.
-
-        TODO: Do testing/observations to see if this edge case
-        ever occurs
+        Where the live feed lists the upcoming stops of the trip,
+        get_prev_stop first tries to match them with the remainder of
+        the trip paths through the stop, so this is only used when the
+        upcoming stops are unknown or do not settle the trip path.
 
         Arguments
         ---------
@@ -480,7 +594,7 @@ class PrevStops:
         service_code = PrevStops._get_service_code(trip)
         sorted_prev_stop_pairs = \
             self._ambiguous_stop_sequences[stop_id][service_code]
-        origin_time = trip.trip_id.split("_")[0]
+        origin_time = self._dataset.get_origin_time(trip.trip_id)
         sorted_origin_times = sorted_prev_stop_pairs["origin_times"]
 
         # We do this in case the origin time of the vehicle is later or
@@ -506,206 +620,342 @@ class PrevStops:
         return sorted_prev_stop_pairs["prev_stops"][closest_index]
 
 
-class StopGraph:
-    """ StopGraph class.
+class TrackNetwork:
+    """ TrackNetwork class.
 
-    Used primarily to store static information concerning stops
-    in order to retrieve the sequence of points between adjacent stops
-    on a particular trip. This information is needed in order to render the
-    frames of the path of the subway car.
+    Used primarily to store the shapes of the subway lines without
+    redundancy. Many shapes (e.g. the variants of each route pattern) overlap
+    almost entirely, so rather than storing every shape in full, each shape
+    is split at the stations it passes through into tracks, and every unique
+    track between a pair of stations is stored only once. Tracks between the
+    same pair of stations are only shared if they have identical points, so
+    that shapes taking different routes between two stations keep their own
+    geometry. Each shape is then expressed as a sequence of references to
+    tracks.
+
+    A track reference is the index of a track in the list of tracks if the
+    track is traversed in its stored direction, or the bitwise complement of
+    that index (i.e. ~index) if the track is traversed in reverse.
     """
-    def __init__(self, schedule):
+    def __init__(self, schedule, dataset):
         """ Constructor.
 
         Arguments
         ---------
         schedule: transitfeed.Schedule
             Schedule object
+        dataset: datasets.Dataset
+            Dataset of schedule
         """
-        shape_indices = StopGraph._get_shape_indices(schedule)
-        stop_shapes = StopGraph._get_stop_shapes(schedule)
-        self._edges = StopGraph._get_edges(schedule, stop_shapes,
-                                           shape_indices)
+        station_coords = \
+            set(TrackNetwork.get_station_coords(schedule, dataset).values())
+        # Map of segment between two stations -> references to the distinct
+        # tracks between them, oriented from the start to the end of the
+        # segment
+        track_refs = defaultdict(list)
+
+        self.tracks = []
+        self.shape_tracks = {}
+        self.shape_stations = {}
+
+        # Shapes are processed in order of shape ID, so that the choice of
+        # track between any pair of stations (and thus the network as a whole)
+        # is deterministic.
+        for shape_object in sorted(schedule.GetShapeList(),
+                                   key=lambda shape: shape.shape_id):
+            shape_id = shape_object.shape_id
+            # We reverse the coordinates, as GTFS stores coordinates as
+            # (lat, lon) while Mapbox stores coordinates as (lon, lat).
+            points = [Coordinates(point[1], point[0])
+                      for point in shape_object.points]
+
+            # Tracks are bounded by stations along the shape, as well as by
+            # the endpoints of the shape in case they are not stations.
+            boundaries = [0] + [
+                i for i in xrange(1, len(points) - 1)
+                if points[i] in station_coords
+            ] + [len(points) - 1]
+
+            tracks = self.shape_tracks[shape_id] = []
+            self.shape_stations[shape_id] = [points[i] for i in boundaries]
+
+            for start, end in zip(boundaries, boundaries[1:]):
+                segment = Segment(points[start], points[end])
+                track = [coordinates.array() for coordinates
+                         in points[start:end + 1]]
+
+                # If a track with these points (up to orientation) has not
+                # been seen before, add it to the network.
+                for track_ref in track_refs[segment]:
+                    if TrackNetwork.get_points([track_ref], self.tracks) == \
+                            track:
+                        break
+                else:
+                    track_ref = len(self.tracks)
+                    track_refs[Segment(segment.end, segment.start)].append(
+                        ~track_ref)
+                    track_refs[segment].append(track_ref)
+                    self.tracks.append(track)
+
+                tracks.append(track_ref)
 
     @staticmethod
-    def _get_stop_coords(stop_object):
+    def get_stop_coords(stop_object, dataset):
         """ Return coordinates of a transitfeed.Stop object.
 
         Arguments
         ---------
         stop_object: transitfeed.Stop
             transitfeed.Stop object
+        dataset: datasets.Dataset
+            Dataset of stop
 
         Returns
         -------
         Coordinates
             Coordinates of transitfeed.Stop object
         """
-        coordinates = Coordinates(stop_object.stop_lon,
-                                  stop_object.stop_lat)
-        # See top of script for an explanation of why the
-        # South Ferry stop is handled differently.
-        if coordinates == NEW_SOUTH_FERRY:
-            return OLD_SOUTH_FERRY
-        else:
-            return coordinates
+        return Coordinates(*dataset.get_stop_coordinates(stop_object))
 
     @staticmethod
-    def _get_shape_indices(schedule):
-        """ Return map of point indices for each shape.
-
-        This is used for forming the edges between stops,
-        so that each edge can find the corresponding indices
-        of two stops along a shape and store these indices as the
-        boundary indices of the edge (then when sending the GPS
-        coordinates to the client code, we can simply use an array
-        slice on these indices from the shape's point sequence).
+    def get_station_coords(schedule, dataset):
+        """ Return map of station ID -> coordinates of each station along
+        the shapes containing it.
 
         Arguments
         ---------
         schedule: transitfeed.Schedule
             Schedule object
+        dataset: datasets.Dataset
+            Dataset of schedule
 
         Returns
         -------
-        dict[str -> dict[Coordinates -> int]]
-            Map of shape ID -> map of point -> index of point
+        dict[str -> Coordinates]
+            Map of station ID -> coordinates of station
         """
-        shape_indices = {}
+        station_coords = {}
 
-        for shape_object in schedule.GetShapeList():
-            shape_id = shape_object.shape_id
-            shape_indices[shape_id] = {}
+        for stop_object in schedule.GetStopList():
+            # Only consider stops that are parent stations to avoid redundancy
+            if stop_object.location_type == 1:
+                station_coords[stop_object.stop_id] = Coordinates(
+                    *dataset.get_station_coordinates(stop_object))
+
+        return station_coords
+
+    def get_tracks(self, shape_id, start, end):
+        """ Returns sequence of track references along a shape between
+        two stations.
+
+        If a station occurs more than once along the shape, the closest
+        pair of occurrences is used.
+
+        Arguments
+        ---------
+        shape_id: str
+            Shape ID of shape containing both stations
+        start: Coordinates
+            Coordinates of start station
+        end: Coordinates
+            Coordinates of end station
+
+        Returns
+        -------
+        list[int]
+            List of track references from start station to end station, or
+            None if the shape does not contain both stations
+        """
+        stations = self.shape_stations[shape_id]
+        tracks = self.shape_tracks[shape_id]
+        start_indices = [i for i, coordinates in enumerate(stations)
+                         if coordinates == start]
+        end_indices = [i for i, coordinates in enumerate(stations)
+                       if coordinates == end]
+
+        if not start_indices or not end_indices:
+            return None
 
-            for i in xrange(len(shape_object.points)):
-                point = shape_object.points[i]
-                # We reverse the coordinates, as GTFS stores coordinates as
-                # (lat, lon) while Mapbox stores coordinates as (lon, lat).
-                coordinates = Coordinates(point[1], point[0])
-                shape_indices[shape_id][coordinates] = i
+        start_index, end_index = min(
+            ((i, j) for i in start_indices for j in end_indices),
+            key=lambda pair: (abs(pair[0] - pair[1]), pair[0])
+        )
 
-        return shape_indices
+        if start_index <= end_index:
+            return tracks[start_index:end_index]
+        else:
+            return [~track_ref for track_ref
+                    in reversed(tracks[end_index:start_index])]
 
     @staticmethod
-    def _get_stop_shapes(schedule):
-        """ Return map of stop ID -> set of shapes containing each stop.
+    def get_points(track_refs, tracks):
+        """ Returns sequence of points along a sequence of tracks.
+
+        Arguments
+        ---------
+        track_refs: list[int]
+            List of track references
+        tracks: list[list[[float, float]]]
+            List of tracks, each a list of coordinates in the form [lon, lat]
+
+        Returns
+        -------
+        list[[float, float]]
+            List of coordinates in the form [lon, lat]
+        """
+        points = []
+
+        for track_ref in track_refs:
+            if track_ref >= 0:
+                track = tracks[track_ref]
+            else:
+                track = tracks[~track_ref][::-1]
+
+            # Adjacent tracks share the station at their boundary, so we
+            # skip the first point of every track but the first.
+            points.extend(track[1:] if points else track)
+
+        return points
+
+
+class StopGraph:
+    """ StopGraph class.
+
+    Used primarily to store static information concerning stops
+    in order to retrieve the sequence of points between adjacent stops
+    on a particular trip. This information is needed in order to render the
+    frames of the path of the subway car.
+
+    Paths are cached by pair of stations, up to MAX_CACHED_PATHS of the most
+    recently requested, along with the adjacency of stations used to find
+    paths between stops that are not adjacent; the caches are built as
+    paths are requested and are not pickled.
+    """
+    def __init__(self, schedule, dataset):
+        """ Constructor.
 
         Arguments
         ---------
         schedule: transitfeed.Schedule
             Schedule object
+        dataset: datasets.Dataset
+            Dataset of schedule
+        """
+        network = TrackNetwork(schedule, dataset)
+        station_coords = TrackNetwork.get_station_coords(schedule, dataset)
+        stop_shapes = StopGraph._get_stop_shapes(network, station_coords)
+        self._edges = StopGraph._get_edges(schedule, dataset, network,
+                                           station_coords, stop_shapes)
+        self._paths = OrderedDict()
+        self._adjacency = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_paths"]
+        del state["_adjacency"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._paths = OrderedDict()
+        self._adjacency = None
+
+    @staticmethod
+    def _get_stop_shapes(network, station_coords):
+        """ Return map of station ID -> set of shapes containing each station.
+
+        Arguments
+        ---------
+        network: TrackNetwork
+            TrackNetwork object
+        station_coords: dict[str -> Coordinates]
+            Map of station ID -> coordinates of station
 
         Returns
         -------
         dict[str -> set[str]]
-            Map of stop ID -> set of shape IDs containing that stop's
+            Map of station ID -> set of shape IDs containing that station's
             coordinates
         """
-        stop_coords = {}
+        coords_stations = {}
         stop_shapes = {}
 
-        for stop_object in schedule.GetStopList():
-            # Only consider stops that are parent stations to avoid redundancy
-            if stop_object.location_type == 1:
-                stop_id = stop_object.stop_id
-                coordinates = StopGraph._get_stop_coords(stop_object)
-                if coordinates in stop_coords:
-                    stop_coords[coordinates].append(stop_id)
-                else:
-                    stop_coords[coordinates] = [stop_id]
-
-        for shape_object in schedule.GetShapeList():
-            shape_id = shape_object.shape_id
-
-            # For each point in the shape, check if it coordinates to at least
-            # one stop. If so, for each matching stop add this particular shape
-            # to the set of shapes containing that stop.
-            for point in shape_object.points:
-                coordinates = Coordinates(point[1], point[0])
-                if coordinates in stop_coords:
-                    stop_ids = stop_coords[coordinates]
-                    for stop_id in stop_ids:
-                        if stop_id not in stop_shapes:
-                            stop_shapes[stop_id] = set([shape_id])
-                        else:
-                            stop_shapes[stop_id].add(shape_id)
+        for stop_id, coordinates in station_coords.iteritems():
+            if coordinates in coords_stations:
+                coords_stations[coordinates].append(stop_id)
+            else:
+                coords_stations[coordinates] = [stop_id]
+
+        # For each station along the shape, add this particular shape to the
+        # set of shapes containing each station at those coordinates.
+        for shape_id, stations in network.shape_stations.iteritems():
+            for coordinates in stations:
+                for stop_id in coords_stations.get(coordinates, []):
+                    if stop_id not in stop_shapes:
+                        stop_shapes[stop_id] = set([shape_id])
+                    else:
+                        stop_shapes[stop_id].add(shape_id)
 
         return stop_shapes
 
     @staticmethod
-    def _get_stop_edge(schedule, segment, stop_shapes, shape_indices):
-        """ Return an edge of points between stops.
+    def _get_stop_edge(network, segment, station_coords, stop_shapes):
+        """ Return an edge of tracks between stations.
 
         The Edge that is constructed contains a shape ID for a shape that
-        contains both the start and end stop, as well as the corresponding
-        indices of those stops in the sequence of points for that shape.
+        contains both the start and end station, as well as the sequence of
+        track references along that shape between the two stations.
+
+        Raises a KeyError if no shape runs between the two stations.
 
         Arguments
         ---------
-        schedule: transitfeed.Schedule
-            Schedule object
+        network: TrackNetwork
+            TrackNetwork object
         segment: Segment
-            Segment of start/end transitfeed.Stop objects
+            Segment of start/end station IDs
+        station_coords: dict[str -> Coordinates]
+            Map of station ID -> coordinates of station
         stop_shapes: dict[str -> set[str]]
-            Map of stop ID -> set of shape IDs containing that stop's
+            Map of station ID -> set of shape IDs containing that station's
             coordinates
-        shape_indices: dict[str -> dict[str -> int]]
-            Map of shape ID -> map of point -> index of point
 
         Returns
         -------
         Edge
-            Edge between the two stops
-        """
-        start = segment.start
-        end = segment.end
-
-        start_coords = StopGraph._get_stop_coords(start)
-        end_coords = StopGraph._get_stop_coords(end)
-
-        start_station = schedule.GetStop(start.stop_id) \
-            .parent_station
-        end_station = schedule.GetStop(end.stop_id).parent_station
-
-        # See comments above declaration of these constants at the top of the
-        # script for an explanation of why York St. cases are handled
-        # differently.
-        if start_station == YORK_STREET_ID:
-            shape_id = YORK_STREET_SHAPE
-            start_index = \
-                shape_indices[shape_id][YORK_STREET_APPROX]
-            end_index = shape_indices[shape_id][end_coords]
-        elif end_station == YORK_STREET_ID:
-            shape_id = YORK_STREET_SHAPE
-            start_index = \
-                shape_indices[shape_id][start_coords]
-            end_index = \
-                shape_indices[shape_id][YORK_STREET_APPROX]
-        else:
-            # We assume that there is a unique path between any two adjacent
-            # stops on the entire map for each trip, or if there isn't, the
-            # paths are very similar in length/shape, which appears to be the
-            # case, so the choice of shape doesn't matter, as long as it
-            # contains both stops.
-            common_shapes = stop_shapes[start_station] \
-                .intersection(stop_shapes[end_station])
-            shape_id = common_shapes.pop()
-            start_index = shape_indices[shape_id][start_coords]
-            end_index = shape_indices[shape_id][end_coords]
-
-        return Edge(shape_id, start_index, end_index)
+            Edge between the two stations
+        """
+        start_coords = station_coords[segment.start]
+        end_coords = station_coords[segment.end]
+        common_shapes = stop_shapes[segment.start] \
+            .intersection(stop_shapes[segment.end])
+
+        # There may be several shapes containing both stations, such as an
+        # express and a local shape. We choose the shape with the fewest
+        # tracks between the stations (i.e. the most direct path), breaking
+        # ties by shape ID, so that the choice of edge is deterministic.
+        edges = []
+        for shape_id in common_shapes:
+            tracks = network.get_tracks(shape_id, start_coords, end_coords)
+            if tracks is not None:
+                edges.append(Edge(shape_id, tracks))
+
+        if not edges:
+            raise KeyError("No shape runs between stations {} and {}".format(
+                segment.start, segment.end))
+
+        return min(edges, key=lambda edge: (len(edge.tracks), edge.shape_id))
 
     @staticmethod
-    def _get_edges(schedule, stop_shapes, shape_indices):
-        """ Returns a map information about the edges of points between
+    def _get_edges(schedule, dataset, network, station_coords, stop_shapes):
+        """ Returns a map information about the edges of tracks between
         adjacent stops along paths of the subway lines.
 
         Edges are mapped by the endpoints, with the following structure:
         {
             Segment(start_station_id, end_station_id): Edge(
                 shape_id: shape ID containing start/end stops,
-                start_index: index of start stop in shape,
-                end_index: index of end stop in shape
+                tracks: track references from start to end stop
             )
         }
 
@@ -713,24 +963,29 @@ class StopGraph:
         ---------
         schedule: transitfeed.Schedule
             Schedule object
+        dataset: datasets.Dataset
+            Dataset of schedule
+        network: TrackNetwork
+            TrackNetwork object
+        station_coords: dict[str -> Coordinates]
+            Map of station ID -> coordinates of station
         stop_shapes: dict[str -> set[str]]
-            Map of stop ID -> set of shape IDs containing that stop's
+            Map of station ID -> set of shape IDs containing that station's
             coordinates
-        shape_indices: dict[str -> dict[str -> int]]
-            Map of shape ID -> map of point -> index of point
 
         Returns
         -------
-        dict[Segment[str, str] -> Edge(str, int, int)]
+        dict[Segment[str, str] -> Edge(str, list[int])]
             Map of Segment of start/stop stations -> Edge representing
-            sequence of points along Segment
+            sequence of tracks along Segment
         """
         edges = {}
+        # Segments already added to edges or skipped, in both orientations
+        seen = set()
         for trip_object in schedule.GetTripList():
-            # For an explanation of why trip paths along 2nd Avenue
-            # are currently skipped, see the top of the script.
-            trip_path = trip_object.trip_id.rsplit("_", 1)[1]
-            if trip_path in SECOND_AVE_PATHS:
+            # Trips off the shapes of the dataset are skipped (see e.g.
+            # datasets.SECOND_AVE_PATHS)
+            if not dataset.has_shape(trip_object):
                 continue
 
             stops = trip_object.GetPattern()
@@ -745,33 +1000,102 @@ class StopGraph:
 
                 # If this edge (up to orientation) has not been seen before,
                 # add to map.
-                if Segment(start_station, end_station) not in edges and \
-                        Segment(end_station, start_station) not in edges:
-                    edges[Segment(start_station, end_station)] = \
-                        StopGraph._get_stop_edge(schedule,
-                                                 Segment(start, end),
-                                                 stop_shapes,
-                                                 shape_indices)
+                segment = Segment(start_station, end_station)
+                if segment in seen:
+                    continue
+                seen.add(segment)
+                seen.add(Segment(end_station, start_station))
+
+                # Segments without a shape are skipped, so that paths across
+                # them are assembled from other edges, if any (see get_path)
+                try:
+                    edges[segment] = StopGraph._get_stop_edge(
+                        network, segment, station_coords, stop_shapes)
+                except KeyError as e:
+                    print "Skipping segment: {}".format(e.args[0])
 
         return edges
 
+    def _get_track_refs(self, start, end):
+        """ Returns the track references from one station to another
+        adjacent station.
+
+        Only one edge for each segment of stop endpoints is stored; thus, if
+        the requested stops are in the opposite orientation of the stored
+        segment, the sequence of tracks of the stored edge is reversed (as is
+        each track along it).
+        """
+        if Segment(start, end) in self._edges:
+            return self._edges[Segment(start, end)].tracks
+        else:
+            return [~track_ref for track_ref
+                    in reversed(self._edges[Segment(end, start)].tracks)]
+
+    @staticmethod
+    def _get_adjacency(edges, tracks):
+        """ Returns map of station ID -> list of (length, adjacent station
+        ID), where length is the length of the tracks between the stations
+        (in degrees, which is enough to compare paths).
+        """
+        track_lengths = [
+            sum(math.hypot(x[0] - y[0], x[1] - y[1])
+                for x, y in zip(track, track[1:]))
+            for track in tracks
+        ]
+
+        adjacency = {}
+        for segment, edge in edges.iteritems():
+            length = sum(track_lengths[track_ref if track_ref >= 0
+                                       else ~track_ref]
+                         for track_ref in edge.tracks)
+            adjacency.setdefault(segment.start, []).append(
+                (length, segment.end))
+            adjacency.setdefault(segment.end, []).append(
+                (length, segment.start))
+
+        return adjacency
+
+    def _get_stations(self, start, end, shapes):
+        """ Returns the shortest sequence of stations from one station to
+        another, or None if there is none.
+        """
+        if self._adjacency is None:
+            self._adjacency = StopGraph._get_adjacency(self._edges,
+                                                       shapes["tracks"])
+
+        prev_stations = {start: None}
+        lengths = {start: 0}
+        heap = [(0, start)]
+        while heap:
+            length, station = heapq.heappop(heap)
+            if station == end:
+                stations = []
+                while station is not None:
+                    stations.append(station)
+                    station = prev_stations[station]
+                return stations[::-1]
+            if length > lengths[station]:
+                continue
+
+            for edge_length, next_station in self._adjacency.get(station, ()):
+                next_length = length + edge_length
+                if next_length < lengths.get(next_station, float("inf")):
+                    lengths[next_station] = next_length
+                    prev_stations[next_station] = station
+                    heapq.heappush(heap, (next_length, next_station))
+
+        return None
+
     def get_path(self, start, end, shapes):
         """ Returns sequence of points between two stops.
 
-        The two stops need to be adjacent stops on any particular
-        trip (local or express).
-
-        Moreover, only one edge for each segment of stop endpoints is stored;
-        thus, in order to return the correct sequence of points, we must keep
-        track of two things. One, the relative orientation of the requested
-        stops with the segment of stops stored, and two, the actual
-        orientation of the stored edge with the shape. In particular, the
-        stored edge may represent a path that goes northbound (since edges are
-        represented as a start/end structure and are thus "directed"), but the
-        shape that is being used for this edge may actually be southbound.
+        If the two stops are not adjacent stops on any particular trip
+        (local or express), e.g. if a train skipped stations or a feed was
+        missed, the path is assembled from the edges along the shortest
+        sequence of stations between them. Paths are cached, so the returned
+        list must not be modified.
 
-        Thus, we store these orientations as +/-1, and simply compose
-        the orientations to see whether or not a reverse slice is needed.
+        Raises a KeyError if there is no path between the stops.
 
         Arguments
         ---------
@@ -779,40 +1103,767 @@ class StopGraph:
             Station ID of start stop (must be a parent station)
         end: str
             Station ID of end stop (must be a parent station)
-        shapes: dict[str -> dict[str -> list[[float, float]]]]
-            Map of the form shape ID -> map of "points" -> list of coordinates
-            in the form [lon, lat]
+        shapes: dict[str -> list]
+            Contents of shapes.json, containing the map of "tracks" -> list of
+            tracks, each a list of coordinates in the form [lon, lat]
 
         Returns
         -------
         list[[float, float]]
             List of coordinates in the form [lon, lat]
         """
-        if Segment(start, end) in self._edges:
-            edge = self._edges[Segment(start, end)]
-            relative_orientation = 1
-        else:
-            edge = self._edges[Segment(end, start)]
-            relative_orientation = -1
-
-        shape_id = edge.shape_id
-        start_index, end_index = sorted((edge.start_index,
-                                        edge.end_index))
-        shape_orientation = 1 if start_index == edge.start_index else -1
-        points = shapes[shape_id]["points"]
-
-        # Regular slice suffices
-        if relative_orientation * shape_orientation == 1:
-            return points[start_index:end_index + 1]
-        # Reverse slice is needed
+        segment = Segment(start, end)
+        if segment in self._paths:
+            # Reinserted below as the most recently requested
+            path = self._paths.pop(segment)
         else:
-            if start_index == 0:
-                return points[end_index::-1]
+            if segment in self._edges or Segment(end, start) in self._edges:
+                track_refs = self._get_track_refs(start, end)
             else:
-                return points[end_index:start_index - 1:-1]
+                stations = self._get_stations(start, end, shapes)
+                if stations is None or len(stations) < 2:
+                    track_refs = None
+                else:
+                    track_refs = []
+                    for i in xrange(len(stations) - 1):
+                        track_refs.extend(self._get_track_refs(
+                            stations[i], stations[i + 1]))
+
+            path = None if track_refs is None else \
+                TrackNetwork.get_points(track_refs, shapes["tracks"])
+            if len(self._paths) >= MAX_CACHED_PATHS:
+                self._paths.popitem(last=False)
+        self._paths[segment] = path
+
+        if path is None:
+            raise KeyError(segment)
+
+        return path
+
+    def has_cached_path(self, start, end):
+        """ Returns whether the path (or lack of one) between two stations is
+        cached (see get_path).
+        """
+        return Segment(start, end) in self._paths
+
+
+class ScheduleIndex:
+    """ ScheduleIndex class.
+
+    Used primarily to render the scheduled positions of subway cars when the
+    live feed is unavailable. Every trip is split into intervals, one for
+    each pair of consecutive stops, from the departure from the previous
+    stop to the departure from the next stop (so that a subway car waiting
+    at a stop stays at the end of its interval). Intervals are stored by
+    column in arrays for each service code, along with an index of the
+    intervals active during each time bucket of the service day, so that
+    the positions at any time are found in a single pass over one bucket.
+
+    Times are in seconds since midnight of the service day, and may exceed
+    24 hours for trips running past midnight.
+    """
+    def __init__(self, schedule, dataset,
+                 bucket_seconds=SCHEDULE_BUCKET_SECONDS):
+        """ Constructor.
+
+        Arguments
+        ---------
+        schedule: transitfeed.Schedule
+            Schedule object
+        dataset: datasets.Dataset
+            Dataset of schedule
+        bucket_seconds: int
+            Seconds per time bucket
+        """
+        self.bucket_seconds = bucket_seconds
+        self._trip_ids = []
+        self._routes = []
+        self._stop_ids = []
+        self._intervals = {}
+
+        stop_indices = {}
+        intervals_by_service_code = {}
+
+        for trip_object in schedule.GetTripList():
+            trip_index = len(self._trip_ids)
+            self._trip_ids.append(dataset.get_live_trip_id(trip_object))
+            self._routes.append(trip_object.route_id)
+
+            stops = []
+            for stop_time in trip_object.GetStopTimes():
+                if stop_time.departure_secs is None:
+                    continue
+                stop_id = stop_time.stop.stop_id
+                if stop_id not in stop_indices:
+                    stop_indices[stop_id] = len(self._stop_ids)
+                    self._stop_ids.append(stop_id)
+                stops.append((stop_indices[stop_id], stop_time.arrival_secs,
+                              stop_time.departure_secs))
+
+            for service_code in dataset.get_service_codes(trip_object,
+                                                          schedule):
+                intervals = intervals_by_service_code.setdefault(
+                    service_code, [])
+                for (prev_stop, _, start), (stop, arrival, end) in \
+                        zip(stops, stops[1:]):
+                    intervals.append((start, end, arrival, trip_index,
+                                      prev_stop, stop))
+
+        for service_code, intervals in intervals_by_service_code.iteritems():
+            self._intervals[service_code] = \
+                ScheduleIndex._get_columns(intervals, bucket_seconds)
+
+    @staticmethod
+    def _get_columns(intervals, bucket_seconds):
+        """ Returns the columns of the intervals of a service code, along
+        with the index of intervals by time bucket.
+
+        The intervals active during bucket i are the intervals at positions
+        bucket_offsets[i] to bucket_offsets[i + 1] of bucket_intervals.
+
+        Arguments
+        ---------
+        intervals: list[tuple]
+            List of (start, end, arrival, trip, previous stop, stop) tuples
+        bucket_seconds: int
+            Seconds per time bucket
 
+        Returns
+        -------
+        dict[str -> array]
+            Map of column name -> array
+        """
+        intervals.sort()
+        columns = {
+            name: array("i", column) for name, column in zip(
+                ["starts", "ends", "arrivals", "trips", "prev_stops",
+                 "stops"], zip(*intervals) or [()] * 6)
+        }
 
-def parse_shapes(schedule):
+        buckets = [[] for _ in xrange(max([interval[1] for interval
+                                           in intervals] or [0]) //
+                                      bucket_seconds + 1)]
+        for i, interval in enumerate(intervals):
+            for bucket in xrange(interval[0] // bucket_seconds,
+                                 interval[1] // bucket_seconds + 1):
+                buckets[bucket].append(i)
+
+        columns["bucket_offsets"] = array("i", [0])
+        columns["bucket_intervals"] = array("i")
+        for bucket in buckets:
+            columns["bucket_intervals"].extend(bucket)
+            columns["bucket_offsets"].append(
+                len(columns["bucket_intervals"]))
+
+        return columns
+
+    def get_positions(self, service_code, seconds):
+        """ Returns the scheduled positions of all subway cars at a time of
+        a service day.
+
+        Arguments
+        ---------
+        service_code: str
+            Service code of service day (i.e. WKD, SAT or SUN)
+        seconds: int
+            Seconds since midnight of service day
+
+        Returns
+        -------
+        list[ScheduledPosition]
+            List of positions, each with the trip ID (as in the live feed),
+            route, stop IDs of the previous and next stop, fraction of the
+            path between them already traveled, and seconds until arrival
+            at the next stop
+        """
+        columns = self._intervals.get(service_code)
+        bucket = seconds // self.bucket_seconds
+        if columns is None or \
+                not 0 <= bucket < len(columns["bucket_offsets"]) - 1:
+            return []
+
+        starts = columns["starts"]
+        ends = columns["ends"]
+        arrivals = columns["arrivals"]
+        trips = columns["trips"]
+        prev_stops = columns["prev_stops"]
+        stops = columns["stops"]
+        offsets = columns["bucket_offsets"]
+
+        positions = []
+        for i in columns["bucket_intervals"][offsets[bucket]:
+                                             offsets[bucket + 1]]:
+            start = starts[i]
+            if not start <= seconds < ends[i]:
+                continue
+            travel_time = arrivals[i] - start
+            progress = float(seconds - start) / travel_time \
+                if travel_time > 0 else 1.0
+            positions.append(ScheduledPosition(
+                self._trip_ids[trips[i]],
+                self._routes[trips[i]],
+                self._stop_ids[prev_stops[i]],
+                self._stop_ids[stops[i]],
+                min(progress, 1.0),
+                max(arrivals[i] - seconds, 0)
+            ))
+
+        return positions
+
+    def get_positions_at(self, now):
+        """ Returns the scheduled positions of all subway cars at a time,
+        including trips of the previous service day running past midnight.
+
+        Arguments
+        ---------
+        now: datetime.datetime
+            Time, in the time zone of the schedule
+
+        Returns
+        -------
+        list[ScheduledPosition]
+            List of positions (see get_positions)
+        """
+        today = now.date()
+        seconds = now.hour * 3600 + now.minute * 60 + now.second
+        yesterday = today - timedelta(days=1)
+
+        return self.get_positions(get_service_code(today), seconds) + \
+            self.get_positions(get_service_code(yesterday), seconds + 86400)
+
+
+class Timetable:
+    """ Timetable class.
+
+    Used primarily to plan journeys between stations with RAPTOR (see
+    raptor.py). Trips are grouped into patterns of trips that stop at the
+    same sequence of platforms without overtaking one another, so that the
+    trips of a pattern are in order of departure at every stop. A pattern
+    is made of the trips of a trip path on a service code (the sequence of
+    stops of each trip path is only read once, as in PrevStops), split
+    wherever a trip would overtake an earlier one.
+
+    Patterns are stored by column in arrays for each service code:
+
+    - the stops of pattern p are pattern_stops[pattern_stop_offsets[p]:
+      pattern_stop_offsets[p + 1]], in order of travel
+    - the trips of pattern p are trips[pattern_trip_offsets[p]:
+      pattern_trip_offsets[p + 1]], in order of departure, as indices into
+      the trip IDs of the timetable
+    - the times of trip r of pattern p at its i-th stop are arrivals[j] and
+      departures[j], where j = pattern_time_offsets[p] + r * (number of
+      stops of p) + i
+    - the patterns serving stop s, and the position of s in each, are
+      stop_patterns[k] and stop_pattern_positions[k] for k in
+      stop_pattern_offsets[s] to stop_pattern_offsets[s + 1]
+
+    along with the transfers between the platforms of each station and of
+    stations linked in transfers.txt: the platforms reachable from stop s,
+    and the seconds to reach them, are transfer_stops[k] and
+    transfer_times[k] for k in transfer_offsets[s] to transfer_offsets[s + 1].
+
+    Times are in seconds since midnight of the service day, and may exceed
+    24 hours for trips running past midnight.
+    """
+    def __init__(self, schedule, dataset):
+        """ Constructor.
+
+        Arguments
+        ---------
+        schedule: transitfeed.Schedule
+            Schedule object
+        dataset: datasets.Dataset
+            Dataset of schedule
+        """
+        self.stop_ids = []
+        self.stop_indices = {}
+        self.trip_ids = []
+        self.routes = []
+        self.timetables = {}
+        # Map of station ID -> stop indices of its platforms
+        self.station_stops = {}
+        # Map of service code -> map of trip ID (as in the live feed) ->
+        # (pattern, position of trip in pattern)
+        self.trip_rows = {}
+        # Map of service code -> last departure of any trip
+        self.end_times = {}
+
+        stop_indices = self.stop_indices
+        trip_indices = {}
+        trip_path_stops = {}
+        patterns_by_service_code = {}
+
+        for trip_object in schedule.GetTripList():
+            stop_times = [stop_time for stop_time
+                          in trip_object.GetStopTimes()
+                          if stop_time.departure_secs is not None]
+            if len(stop_times) < 2:
+                continue
+
+            # No need to duplicate work over trip paths already seen, since
+            # a trip path uniquely defines a sequence of stops
+            trip_path = dataset.get_trip_path(trip_object)
+            stops = trip_path_stops.get(trip_path)
+            if stops is None or len(stops) != len(stop_times):
+                stops = []
+                for stop_time in stop_times:
+                    stop_id = stop_time.stop.stop_id
+                    if stop_id not in stop_indices:
+                        stop_indices[stop_id] = len(self.stop_ids)
+                        self.stop_ids.append(stop_id)
+                        station_id = stop_time.stop.parent_station or \
+                            stop_id
+                        self.station_stops.setdefault(
+                            station_id, []).append(stop_indices[stop_id])
+                    stops.append(stop_indices[stop_id])
+                stops = tuple(stops)
+                trip_path_stops.setdefault(trip_path, stops)
+
+            trip_id = dataset.get_live_trip_id(trip_object)
+            trip_index = len(self.trip_ids)
+            self.trip_ids.append(trip_id)
+            self.routes.append(trip_object.route_id)
+            arrivals = [stop_time.arrival_secs for stop_time in stop_times]
+            departures = [stop_time.departure_secs
+                          for stop_time in stop_times]
+
+            for service_code in dataset.get_service_codes(trip_object,
+                                                          schedule):
+                trip_indices.setdefault(service_code, {})[trip_id] = \
+                    trip_index
+                patterns_by_service_code.setdefault(
+                    service_code, {}).setdefault(stops, []).append(
+                        (arrivals, departures, trip_index))
+
+        for service_code, patterns in patterns_by_service_code.iteritems():
+            columns, rows = Timetable._get_columns(patterns,
+                                                   len(self.stop_ids))
+            self.timetables[service_code] = columns
+            self.trip_rows[service_code] = {
+                trip_id: rows[trip_index] for trip_id, trip_index
+                in trip_indices[service_code].iteritems()
+            }
+            self.end_times[service_code] = max(columns["departures"])
+
+        self.transfers = self._get_transfers(schedule)
+
+    @staticmethod
+    def _split_pattern(trips):
+        """ Returns the trips of a sequence of stops split into lists of
+        trips in order of departure at every stop.
+        """
+        patterns = []
+        for trip in sorted(trips):
+            arrivals, departures, _ = trip
+            for pattern in patterns:
+                last_arrivals, last_departures, _ = pattern[-1]
+                if all(last <= time for last, time
+                       in zip(last_arrivals, arrivals)) and \
+                        all(last <= time for last, time
+                            in zip(last_departures, departures)):
+                    pattern.append(trip)
+                    break
+            else:
+                patterns.append([trip])
+
+        return patterns
+
+    @staticmethod
+    def _get_columns(patterns, num_stops):
+        """ Returns the columns of the patterns of a service code.
+
+        Arguments
+        ---------
+        patterns: dict[tuple[int] -> list[tuple]]
+            Map of sequence of stop indices -> list of (arrivals,
+            departures, trip index) tuples of its trips
+        num_stops: int
+            Number of stops of the timetable
+
+        Returns
+        -------
+        tuple[dict[str -> array], dict[int -> tuple[int, int]]]
+            Map of column name -> array, and map of trip index ->
+            (pattern, position of trip in pattern)
+        """
+        rows = {}
+        columns = {
+            name: array("i", [0]) for name in ["pattern_stop_offsets",
+                                               "pattern_trip_offsets",
+                                               "pattern_time_offsets"]
+        }
+        for name in ["pattern_stops", "trips", "arrivals", "departures"]:
+            columns[name] = array("i")
+        stop_patterns = [[] for _ in xrange(num_stops)]
+
+        for stops, trips in sorted(patterns.iteritems()):
+            for pattern in Timetable._split_pattern(trips):
+                index = len(columns["pattern_stop_offsets"]) - 1
+                for position, stop in enumerate(stops):
+                    stop_patterns[stop].append((index, position))
+                columns["pattern_stops"].extend(stops)
+                for row, (arrivals, departures, trip_index) in \
+                        enumerate(pattern):
+                    rows[trip_index] = (index, row)
+                    columns["trips"].append(trip_index)
+                    columns["arrivals"].extend(arrivals)
+                    columns["departures"].extend(departures)
+                for name, column in [("pattern_stop_offsets",
+                                      "pattern_stops"),
+                                     ("pattern_trip_offsets", "trips"),
+                                     ("pattern_time_offsets", "arrivals")]:
+                    columns[name].append(len(columns[column]))
+
+        columns["stop_pattern_offsets"] = array("i", [0])
+        columns["stop_patterns"] = array("i")
+        columns["stop_pattern_positions"] = array("i")
+        for patterns_of_stop in stop_patterns:
+            for index, position in patterns_of_stop:
+                columns["stop_patterns"].append(index)
+                columns["stop_pattern_positions"].append(position)
+            columns["stop_pattern_offsets"].append(
+                len(columns["stop_patterns"]))
+
+        return columns, rows
+
+    def _get_transfers(self, schedule):
+        """ Returns the columns of the transfers between platforms.
+
+        Every platform can be reached from the other platforms of its
+        station, and from the platforms of stations linked to its station
+        in transfers.txt, in the minimum transfer time given there or
+        DEFAULT_TRANSFER_SECONDS.
+        """
+        station_transfers = {station_id: {station_id: DEFAULT_TRANSFER_SECONDS}
+                             for station_id in self.station_stops}
+        for transfer in schedule.GetTransferList():
+            # Transfer type 3 marks transfers that are not possible
+            if transfer.transfer_type == 3:
+                continue
+            from_station, to_station = [
+                schedule.stops[stop_id].parent_station or stop_id
+                if stop_id in schedule.stops else stop_id
+                for stop_id in (transfer.from_stop_id, transfer.to_stop_id)]
+            if from_station in station_transfers and \
+                    to_station in station_transfers:
+                station_transfers[from_station][to_station] = \
+                    transfer.min_transfer_time or DEFAULT_TRANSFER_SECONDS
+
+        stations = [None] * len(self.stop_ids)
+        for station_id, stops in self.station_stops.iteritems():
+            for stop in stops:
+                stations[stop] = station_id
+
+        columns = {"transfer_offsets": array("i", [0]),
+                   "transfer_stops": array("i"),
+                   "transfer_times": array("i")}
+        for stop, station_id in enumerate(stations):
+            for to_station, seconds in sorted(
+                    station_transfers[station_id].iteritems()):
+                for to_stop in self.station_stops[to_station]:
+                    if to_stop != stop:
+                        columns["transfer_stops"].append(to_stop)
+                        columns["transfer_times"].append(seconds)
+            columns["transfer_offsets"].append(
+                len(columns["transfer_stops"]))
+
+        return columns
+
+
+# Words of stop names and searches are normalized to a single spelling, so
+# that e.g. "W 4th Street" matches "W 4 St"
+WORD_SPELLINGS = {
+    "street": "st", "saint": "st", "avenue": "av", "ave": "av",
+    "boulevard": "blvd", "road": "rd", "parkway": "pkwy", "place": "pl",
+    "square": "sq", "center": "ctr", "heights": "hts", "junction": "jct",
+    "plaza": "plz", "highway": "hwy", "terrace": "ter", "beach": "bch",
+    "fort": "ft", "mount": "mt", "north": "n", "south": "s", "east": "e",
+    "west": "w", "and": "&", "first": "1", "second": "2", "third": "3",
+    "fourth": "4", "fifth": "5", "sixth": "6", "seventh": "7",
+    "eighth": "8", "ninth": "9", "tenth": "10", "eleventh": "11",
+    "twelfth": "12"
+}
+# Map of normalized word -> spellings of it, so that a search may be a
+# prefix of any spelling (e.g. "squ" for "sq")
+SPELLINGS = {}
+for spelling, word in WORD_SPELLINGS.iteritems():
+    SPELLINGS.setdefault(word, [word]).append(spelling)
+ORDINAL = re.compile(r"^(\d+)(st|nd|rd|th)$")
+WORD = re.compile(r"[a-z0-9&]+")
+
+
+def normalize_words(name):
+    """ Returns the normalized words of a stop name or search, e.g. ["w",
+    "4", "st", "wash", "sq"] for "W 4th St - Washington Sq".
+    """
+    words = []
+    for word in WORD.findall(name.lower()):
+        ordinal = ORDINAL.match(word)
+        if ordinal:
+            word = ordinal.group(1)
+        words.append(WORD_SPELLINGS.get(word, word))
+
+    return words
+
+
+def get_trigrams(words):
+    """ Returns the set of trigrams of normalized words, each padded so that
+    its start and end form trigrams of their own.
+    """
+    return set(padded[i:i + 3] for padded in ("  {} ".format(word)
+                                              for word in words)
+               for i in xrange(len(padded) - 2))
+
+
+class StopSearch:
+    """ StopSearch class.
+
+    Used primarily to find stations by name as a user types. Names are
+    split into normalized words, and both the words and every prefix of
+    every word are indexed, so that each word of a search is looked up in
+    one step and the stations matching all of them are the intersection of
+    a few small sets. The last word of a search may be incomplete, so it
+    matches prefixes of words; the others must match whole words. Searches
+    with typos, which match no stations this way, fall back to an index of
+    the trigrams of names.
+    """
+    def __init__(self, stops):
+        """ Constructor.
+
+        Arguments
+        ---------
+        stops: dict
+            Map of stop ID -> {coordinates: [lon, lat], name: name} of
+            parent stations (see get_stops)
+        """
+        self._stops = []
+        self._words = {}
+        self._prefixes = {}
+        self._trigrams = {}
+
+        for stop_id, stop in sorted(stops.iteritems()):
+            index = len(self._stops)
+            words = normalize_words(stop["name"])
+            self._stops.append((stop_id, stop["name"], stop["coordinates"],
+                                words))
+
+            for word in words:
+                self._words.setdefault(word, set()).add(index)
+                for spelling in SPELLINGS.get(word, [word]):
+                    for i in xrange(1, len(spelling) + 1):
+                        self._prefixes.setdefault(spelling[:i],
+                                                  set()).add(index)
+            for trigram in get_trigrams(words):
+                self._trigrams.setdefault(trigram, []).append(index)
+
+    def _get_word_matches(self, words, prefix):
+        """ Returns map of index -> score of the stations with every word of
+        a search, where the last word may be a prefix if prefix is true.
+        """
+        lookups = [(word, self._words) for word in words]
+        if prefix:
+            lookups[-1] = (words[-1], self._prefixes)
+
+        matches = None
+        for word, index in sorted(lookups, key=lambda lookup:
+                                  len(lookup[1].get(lookup[0], ()))):
+            stops = index.get(word)
+            if not stops:
+                return {}
+            matches = set(stops) if matches is None else matches & stops
+
+        scores = {}
+        for index in matches:
+            stop_words = self._stops[index][3]
+            # Whole words score higher than a prefix, names starting with
+            # the search higher still, and shorter names (which the search
+            # covers more of) break ties.
+            score = sum(1.0 if word in stop_words else 0.5
+                        for word in words)
+            if stop_words[0] == words[0] or \
+                    stop_words[0].startswith(words[0]) and len(words) == 1:
+                score += 1
+            scores[index] = score + 1.0 / (1 + len(stop_words))
+
+        return scores
+
+    def _get_trigram_matches(self, words):
+        """ Returns map of index -> score of the stations whose names contain
+        enough of the trigrams of a search.
+        """
+        trigrams = get_trigrams(words)
+        shared = {}
+        for trigram in trigrams:
+            for index in self._trigrams.get(trigram, ()):
+                shared[index] = shared.get(index, 0) + 1
+
+        scores = {}
+        for index, count in shared.iteritems():
+            match = float(count) / len(trigrams)
+            if match >= MIN_TRIGRAM_MATCH:
+                scores[index] = match + 1.0 / (1 + len(self._stops[index][3]))
+
+        return scores
+
+    def search(self, query, limit):
+        """ Returns the stations best matching a search.
+
+        Arguments
+        ---------
+        query: str
+            Search, e.g. the beginning of a station name
+        limit: int
+            Maximum number of stations to return
+
+        Returns
+        -------
+        list[dict]
+            List of stations, best match first, of the form {
+                stop_id: stop ID of station,
+                name: name,
+                coordinates: [lon, lat]
+            }
+        """
+        words = normalize_words(query)
+        if not words:
+            return []
+
+        # The last word is complete if followed by a space, or if it was
+        # normalized (e.g. "4th" or "street")
+        raw_words = WORD.findall(query.lower())
+        prefix = not query[-1].isspace() and words[-1] == raw_words[-1]
+
+        scores = self._get_word_matches(words, prefix)
+        if not scores:
+            scores = self._get_trigram_matches(words)
+
+        best = heapq.nsmallest(limit, scores.iteritems(),
+                               key=lambda item: (-item[1], item[0]))
+        return [
+            {
+                "stop_id": self._stops[index][0],
+                "name": self._stops[index][1],
+                "coordinates": self._stops[index][2]
+            }
+            for index, _ in best
+        ]
+
+
+def load_array(typecode, data):
+    """ Returns an array pickled by reduce_array. """
+    return array(typecode, data)
+
+
+def reduce_array(values):
+    """ Pickles an array as its machine values rather than as a list of
+    Python ints, so that loading the large arrays of the schedule index and
+    the timetable is a copy rather than millions of allocations (which
+    would stall app.py while it reloads the static data). Pickles of arrays
+    can then only be loaded on machines of the same byte order.
+    """
+    return load_array, (values.typecode, values.tostring())
+
+
+copy_reg.pickle(array, reduce_array)
+
+
+@contextmanager
+def open_atomic(path, mode="w"):
+    """ Opens a file to be written in place of the file at a path, which is
+    only replaced once the new file is complete.
+
+    The file is written to a temporary path and renamed over the path once
+    closed, so that readers (e.g. app.py) see either the old or the new
+    file in full, and never a file cut short by a failed build; if writing
+    fails, the temporary file is removed and the old file is left as is.
+
+    Arguments
+    ---------
+    path: str
+        Path of file
+    mode: str
+        Mode to open file in ("w" or "wb")
+    """
+    temp_path = path + ".tmp"
+    temp_f = open(temp_path, mode)
+    try:
+        yield temp_f
+        temp_f.flush()
+        os.fsync(temp_f.fileno())
+    except BaseException:
+        temp_f.close()
+        os.remove(temp_path)
+        raise
+
+    temp_f.close()
+    os.rename(temp_path, path)
+
+
+def write_json_object(json_f, items):
+    """ Writes a JSON object to a file one member at a time, so that the
+    object is never held in memory, or serialized, as a whole.
+
+    Arguments
+    ---------
+    json_f: file
+        File to write to
+    items: iterable[tuple[str, object]]
+        (key, value) pairs of the members of the object
+    """
+    json_f.write("{")
+    for i, (key, value) in enumerate(items):
+        json_f.write((", " if i else "") + json.dumps(key) + ": " +
+                     json.dumps(value))
+    json_f.write("}")
+
+
+def write_json_array(json_f, items):
+    """ Writes a JSON array to a file one element at a time (see
+    write_json_object).
+
+    Arguments
+    ---------
+    json_f: file
+        File to write to
+    items: iterable[object]
+        Elements of the array
+    """
+    json_f.write("[")
+    for i, value in enumerate(items):
+        json_f.write((", " if i else "") + json.dumps(value))
+    json_f.write("]")
+
+
+def write_version(schedule, dataset):
+    """ Writes the time zone of the agency and a new version of the static
+    data, after all other files, so that servers reload the static data
+    (see app.static_watcher).
+
+    Arguments
+    ---------
+    schedule: transitfeed.Schedule
+        Schedule object
+    dataset: datasets.Dataset
+        Dataset of schedule
+
+    Returns
+    -------
+    str
+        Version written
+    """
+    # Times of the schedule are in the time zone of the agency (see
+    # datasets.Dataset.get_timezone)
+    with open_atomic(dataset.pickle_dir + TIMEZONE_FILE, "w") as timezone_f:
+        timezone_f.write(schedule.GetDefaultAgency().agency_timezone)
+
+    version = datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+    with open_atomic(dataset.pickle_dir + VERSION_FILE, "w") as version_f:
+        version_f.write(version)
+
+    return version
+
+
+def parse_shapes(schedule, dataset):
     """ Writes shapes.json.
 
     This JSON file is sent to the client code in order to render
@@ -820,12 +1871,20 @@ def parse_shapes(schedule):
     sequences of points used to animate the paths of the subway cars
     along the subway lines.
 
+    Shapes are stored as a TrackNetwork; each shape is a sequence of
+    references to tracks, where a non-negative reference is the index of a
+    track, and a negative reference ~index is the track at that index
+    traversed in reverse.
+
     Writes a JSON file of the following format:
     {
-        shape_id: {
-            color: route color for shape,
-            sequence: number of points in shape,
-            points: [[lon, lat], ...]
+        tracks: [[[lon, lat], ...], ...],
+        shapes: {
+            shape_id: {
+                color: route color for shape,
+                sequence: number of points in shape,
+                tracks: [track reference, ...]
+            }
         }
     }
 
@@ -833,39 +1892,53 @@ def parse_shapes(schedule):
     ---------
     schedule: transitfeed.Schedule
         Schedule object
+    dataset: datasets.Dataset
+        Dataset of schedule
     """
-    with open(JSON_DIR + "shapes.json", "w") as shapes_f:
-        shapes = {}
+    network = TrackNetwork(schedule, dataset)
+    shape_colors = dataset.get_shape_colors(schedule)
 
+    def get_shapes():
         for shape_object in schedule.GetShapeList():
             shape_id = shape_object.shape_id
-            shape = shapes[shape_id] = {}
-
-            shape["sequence"] = shape_object.sequence[-1]
-            shape["points"] = []
-
-            color = ''
-            for route in schedule.GetRouteList():
-                if shape_id[0] == route.route_id[0]:
-                    color = "#" + route.route_color
-
-            shape["color"] = color
-
-            for point in shape_object.points:
-                # We reverse the coordinates, as GTFS stores coordinates as
-                # (lat, lon) while Mapbox stores coordinates as (lon, lat).
-                # Moreover, we use an array here as opposed to the Coordinates
-                # class for ease at the cost of readability, as the points in
-                # shapes.json will be passed to Mapbox, which only handles GPS
-                # coordinates in array format.
-                coordinates = [point[1], point[0]]
-                shape["points"].append(coordinates)
-
-        shapes_f.write(json.dumps(shapes))
-        print "shapes.json written."
+            yield shape_id, {
+                "color": shape_colors.get(shape_id, ''),
+                "sequence": shape_object.sequence[-1],
+                "tracks": network.shape_tracks[shape_id]
+            }
+
+    # Shapes are written one at a time, after the tracks they refer to
+    with open_atomic(dataset.json_dir + "shapes.json") as shapes_f:
+        shapes_f.write('{"tracks": ')
+        write_json_array(shapes_f, network.tracks)
+        shapes_f.write(', "shapes": ')
+        write_json_object(shapes_f, get_shapes())
+        shapes_f.write("}")
+    print "shapes.json written."
+
+
+def iter_stops(schedule, dataset):
+    """ Yields (stop ID, stop) of each parent station of a schedule, in the
+    format of stops.json (see parse_stops).
+    """
+    for stop_object in schedule.GetStopList():
+        # Only consider stops that are parent stations to avoid redundancy
+        if stop_object.location_type == 1:
+            coordinates = TrackNetwork.get_stop_coords(stop_object, dataset)
+            yield stop_object.stop_id, {
+                "coordinates": coordinates.array(),
+                "name": stop_object.stop_name
+            }
+
+
+def get_stops(schedule, dataset):
+    """ Returns the parent stations of a schedule, in the format of
+    stops.json (see parse_stops).
+    """
+    return dict(iter_stops(schedule, dataset))
 
 
-def parse_stops(schedule):
+def parse_stops(schedule, dataset):
     """ Writes stops.json.
 
     This JSON file is sent to the client code to render the stops on the map.
@@ -885,29 +1958,46 @@ def parse_stops(schedule):
     ---------
     schedule: transitfeed.Schedule
         Schedule object
+    dataset: datasets.Dataset
+        Dataset of schedule
     """
-    with open(JSON_DIR + "stops.json", "w") as stops_f:
-        stops = {}
+    with open_atomic(dataset.json_dir + "stops.json") as stops_f:
+        write_json_object(stops_f, iter_stops(schedule, dataset))
+    print "stops.json written."
+
+    # Map of stop ID -> station ID of every stop with a parent station, used
+    # to find the station of the stops of the realtime feed (see
+    # datasets.Dataset.get_station_id)
+    with open_atomic(dataset.pickle_dir + STATIONS_FILE, "wb") as \
+            stations_f:
+        pickle.dump({
+            stop_object.stop_id: stop_object.parent_station
+            for stop_object in schedule.GetStopList()
+            if stop_object.parent_station
+        }, stations_f, pickle.HIGHEST_PROTOCOL)
+    print "{} written.".format(STATIONS_FILE)
 
-        for stop_object in schedule.GetStopList():
-            # Only consider stops that are parent stations to avoid redundancy
-            if stop_object.location_type == 1:
-                stop_id = stop_object.stop_id
-                stop = stops[stop_id] = {}
 
-                coordinates = Coordinates(stop_object.stop_lon,
-                                          stop_object.stop_lat)
-                if coordinates == NEW_SOUTH_FERRY:
-                    coordinates = OLD_SOUTH_FERRY
+def parse_search(schedule, dataset):
+    """ Writes search.pkl.
 
-                stop["coordinates"] = coordinates.array()
-                stop["name"] = stop_object.stop_name
+    Serializes a StopSearch object of the parent stations, which app.py uses
+    to find stations by name.
 
-        stops_f.write(json.dumps(stops))
-        print "stops.json written."
+    Arguments
+    ---------
+    schedule: transitfeed.Schedule
+        Schedule object
+    dataset: datasets.Dataset
+        Dataset of schedule
+    """
+    with open_atomic(dataset.pickle_dir + "search.pkl", "wb") as search_f:
+        pickle.dump(StopSearch(get_stops(schedule, dataset)), search_f,
+                    pickle.HIGHEST_PROTOCOL)
+    print "search.pkl written."
 
 
-def parse_graph(schedule):
+def parse_graph(schedule, dataset):
     """ Writes graph.pkl.
 
     Seralizes a StopGraph object. This serialized object is used to retrieve
@@ -918,13 +2008,16 @@ def parse_graph(schedule):
     ---------
     schedule: transitfeed.Schedule
         Schedule object
+    dataset: datasets.Dataset
+        Dataset of schedule
     """
-    with open(PICKLE_DIR + "graph.pkl", "wb") as graph_f:
-        pickle.dump(StopGraph(schedule), graph_f, pickle.HIGHEST_PROTOCOL)
-        print "graph.pkl written."
+    with open_atomic(dataset.pickle_dir + "graph.pkl", "wb") as graph_f:
+        pickle.dump(StopGraph(schedule, dataset), graph_f,
+                    pickle.HIGHEST_PROTOCOL)
+    print "graph.pkl written."
 
 
-def parse_prev_stops(schedule):
+def parse_prev_stops(schedule, dataset):
     """ Writes prev_stops.pkl.
 
     Serializes a PrevStops object. This serialized object is used to retrieve
@@ -935,10 +2028,126 @@ def parse_prev_stops(schedule):
     ---------
     schedule: transitfeed.Schedule
         Schedule object
+    dataset: datasets.Dataset
+        Dataset of schedule
+    """
+    with open_atomic(dataset.pickle_dir + "prev_stops.pkl", "wb") as \
+            prev_stops_f:
+        pickle.dump(PrevStops(schedule, dataset), prev_stops_f,
+                    pickle.HIGHEST_PROTOCOL)
+    print "prev_stops.pkl written."
+
+
+def get_trip_sequences(schedule, dataset):
+    """ Returns the table of stops by stop sequence of each line.
+
+    Lines are keyed as given by the dataset (for the subway, by the
+    characters around the ".." of a trip ID), and the stops of a line are
+    taken from the first trip of the line. Stops are
+    stored once in a list, and each line is an array of indices into that
+    list by stop sequence, i.e. position along the trip counting from 1 (see
+    datasets.Dataset.get_stop_sequence), with NO_STOP at 0, so that the
+    table loads quickly.
+
+    Arguments
+    ---------
+    schedule: transitfeed.Schedule
+        Schedule object
+    dataset: datasets.Dataset
+        Dataset of schedule
+
+    Returns
+    -------
+    dict
+        Table of the form {
+            stops: [(stop ID, stop name), ...],
+            lines: {line: array of stop indices by stop sequence}
+        }
+    """
+    stops = []
+    stop_indices = {}
+    lines = {}
+
+    for trip in schedule.GetTripList():
+        line = dataset.get_line(trip)
+        if line is None:
+            print "Error with tripID"
+            continue
+        if line in lines:
+            continue
+
+        stop_times = trip.GetStopTimes()
+        sequence = array("H", [NO_STOP]) * (len(stop_times) + 1)
+        for stop_sequence, stop_time in enumerate(stop_times, 1):
+            stop = (stop_time.stop.stop_id, stop_time.stop.stop_name)
+            if stop not in stop_indices:
+                stop_indices[stop] = len(stops)
+                stops.append(stop)
+            sequence[stop_sequence] = stop_indices[stop]
+        lines[line] = sequence
+
+    return {"stops": stops, "lines": lines}
+
+
+def parse_trip_sequences(schedule, dataset):
+    """ Writes trip_sequences.pkl.
+
+    Serializes the table of stops by stop sequence of each line (see
+    get_trip_sequences), so that stops can be looked up by stop sequence
+    without loading the static schedule.
+
+    Arguments
+    ---------
+    schedule: transitfeed.Schedule
+        Schedule object
+    dataset: datasets.Dataset
+        Dataset of schedule
+    """
+    with open_atomic(dataset.pickle_dir + TRIP_SEQUENCES_FILE, "wb") as \
+            trip_sequences_f:
+        pickle.dump(get_trip_sequences(schedule, dataset), trip_sequences_f,
+                    pickle.HIGHEST_PROTOCOL)
+    print "trip_sequences.pkl written."
+
+
+def parse_schedule(schedule, dataset):
+    """ Writes schedule.pkl.
+
+    Serializes a ScheduleIndex object. This serialized object is used to
+    render the scheduled positions of subway cars when the live feed is
+    unavailable.
+
+    Arguments
+    ---------
+    schedule: transitfeed.Schedule
+        Schedule object
+    dataset: datasets.Dataset
+        Dataset of schedule
+    """
+    with open_atomic(dataset.pickle_dir + "schedule.pkl", "wb") as schedule_f:
+        pickle.dump(ScheduleIndex(schedule, dataset), schedule_f,
+                    pickle.HIGHEST_PROTOCOL)
+    print "schedule.pkl written."
+
+
+def parse_timetable(schedule, dataset):
+    """ Writes timetable.pkl.
+
+    Serializes a Timetable object. This serialized object is used to plan
+    journeys between stations (see raptor.py).
+
+    Arguments
+    ---------
+    schedule: transitfeed.Schedule
+        Schedule object
+    dataset: datasets.Dataset
+        Dataset of schedule
     """
-    with open(PICKLE_DIR + "prev_stops.pkl", "wb") as prev_stops_f:
-        pickle.dump(PrevStops(schedule), prev_stops_f, pickle.HIGHEST_PROTOCOL)
-        print "prev_stops.pkl written."
+    with open_atomic(dataset.pickle_dir + "timetable.pkl", "wb") as \
+            timetable_f:
+        pickle.dump(Timetable(schedule, dataset), timetable_f,
+                    pickle.HIGHEST_PROTOCOL)
+    print "timetable.pkl written."
 
 
 def get_parser():
@@ -975,6 +2184,43 @@ def get_parser():
         default=False,
         help="Flag to enable creation of prev_stops.pkl"
     )
+    parser.add_argument(
+        "-t",
+        "--trip_sequences",
+        action="store_true",
+        default=False,
+        help="Flag to enable creation of trip_sequences.pkl"
+    )
+    parser.add_argument(
+        "-s",
+        "--schedule",
+        action="store_true",
+        default=False,
+        help="Flag to enable creation of schedule.pkl"
+    )
+    parser.add_argument(
+        "-e",
+        "--search",
+        action="store_true",
+        default=False,
+        help="Flag to enable creation of search.pkl"
+    )
+    parser.add_argument(
+        "-r",
+        "--timetable",
+        action="store_true",
+        default=False,
+        help="Flag to enable creation of timetable.pkl"
+    )
+    parser.add_argument(
+        "-d",
+        "--dataset",
+        action="append",
+        choices=sorted(DATASETS),
+        help="Dataset to write the files of, from the static transit data " +
+        "in its directory (may be repeated; {} by default)".format(
+            DEFAULT_DATASET)
+    )
 
     return parser
 
@@ -995,20 +2241,39 @@ def write_static_files(args):
         "graph": parse_graph,
         "stops": parse_stops,
         "shapes": parse_shapes,
-        "prev_stops": parse_prev_stops
+        "prev_stops": parse_prev_stops,
+        "trip_sequences": parse_trip_sequences,
+        "schedule": parse_schedule,
+        "search": parse_search,
+        "timetable": parse_timetable
     }
 
-    print "Loading static schedule information..."
-    loader = transitfeed.Loader(STATIC_TRANSIT_DIR)
-    schedule = loader.Load()
-    print "Done. Writing to file(s)..."
+    for name in args.dataset or [DEFAULT_DATASET]:
+        dataset = get_dataset(name)
+        for directory in [dataset.json_dir, dataset.pickle_dir]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        print "Loading static schedule information of {}...".format(name)
+        loader = transitfeed.Loader(dataset.static_transit_dir)
+        schedule = loader.Load()
+        print "Done. Writing to file(s)..."
+
+        written = False
+        for file, parse_function in PARSE_FUNCTIONS.iteritems():
+            if not getattr(args, file):
+                print "Skipping {}.".format(file)
+            else:
+                print "Writing {}...".format(file)
+                parse_function(schedule, dataset)
+                written = True
 
-    for file, parse_function in PARSE_FUNCTIONS.iteritems():
-        if not getattr(args, file):
-            print "Skipping {}.".format(file)
-        else:
-            print "Writing {}...".format(file)
-            parse_function(schedule)
+        # A new version makes servers reload the static data, so it is only
+        # written if any file was
+        if not written:
+            continue
+
+        write_version(schedule, dataset)
 
     print "File(s) written."
 
@@ -21,6 +21,10 @@ const LAYER = {
   },
 };
 
+// Path the page is served under, e.g. '/lirr' when app.py --mode router
+// serves the lirr dataset from '/lirr/', and '' otherwise
+const ROOT = window.location.pathname.replace(/\/$/, '');
+
 const ROUTEIDS = [
   'route-1..N03R',
   'route-5..S03R',
@@ -30,6 +34,19 @@ const ROUTEIDS = [
   'route-B..N46R',
 ];
 
+/**
+ * Shapes are sent as references into a network of tracks shared between
+ * shapes; a negative reference ~i denotes track i traversed in reverse.
+ * Adjacent tracks share their boundary point.
+ */
+function getShapePoints(tracks, trackRefs) {
+  return trackRefs.reduce((points, trackRef) => {
+    const track = trackRef >= 0 ? tracks[trackRef] : tracks[~trackRef].slice().reverse();
+
+    return points.concat(points.length ? track.slice(1) : track);
+  }, []);
+}
+
 function renderCars(map, subwayCars) {
   const START = Date.now();
   const lineTuple = subwayCars.map(subwayCar => {
@@ -115,10 +132,12 @@ $(document).ready(() => {
   const map = new mapboxgl.Map(MAPBOX);
 
   map.on('load', () => {
-    const socket = io.connect('localhost:5000');
+    const socket = io.connect(window.location.host, {
+      path: `${ROOT}/socket.io`,
+    });
 
     $.when((
-      $.getJSON('/map_json', mapData => {
+      $.getJSON(`${ROOT}/map_json`, mapData => {
         /**
          * This is used because we have a second loop
          * that only adds layers for the chosen routes:
@@ -127,7 +146,7 @@ $(document).ready(() => {
          */
         const tempColorMap = {};
 
-        Object.entries(mapData).forEach(([mapKey, mapVal]) => {
+        Object.entries(mapData.shapes).forEach(([mapKey, mapVal]) => {
           const routeID = 'route-'.concat(mapKey);
 
           tempColorMap[routeID] = mapVal.color;
@@ -141,13 +160,17 @@ $(document).ready(() => {
               },
               geometry: {
                 type: 'LineString',
-                coordinates: mapVal.points,
+                coordinates: getShapePoints(mapData.tracks, mapVal.tracks),
               },
             },
           });
         });
 
-        ROUTEIDS.forEach((key, index) => {
+        // Datasets other than the subway have none of the chosen routes,
+        // so all of their routes are displayed
+        const routeIDs = ROUTEIDS.filter(key => key in tempColorMap);
+
+        (routeIDs.length ? routeIDs : Object.keys(tempColorMap)).forEach(key => {
           map.addLayer({
             id: key,
             type: 'line',
@@ -163,7 +186,7 @@ $(document).ready(() => {
           });
         });
 
-        $.getJSON('/stops_json', stopData => {
+        $.getJSON(`${ROOT}/stops_json`, stopData => {
           const stopsFeatureData = Object.entries(stopData).map(([_, stopVal]) => {
             const name = stopVal.name;
             const coordinates = stopVal.coordinates.join(', ');
@@ -205,7 +228,13 @@ $(document).ready(() => {
         });
       })
     )).then(() => {
-      socket.on('feed', subwayCars => {
+      socket.on('feed', (data, ack) => {
+        // Acknowledge receipt, so that the server sends the next tick
+        if (ack) {
+          ack();
+        }
+
+        const subwayCars = typeof data === 'string' ? JSON.parse(data) : data;
         console.log(subwayCars);
         renderCars(map, subwayCars);
       });
@@ -0,0 +1,86 @@
+import os
+import sys
+
+import pytest
+
+# Modules live in the root directory of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import transitfeed  # noqa: E402
+
+# Two routes meeting at station C: route X runs A -> B -> C, numbering its
+# stops in steps of 10, and route Y runs C -> D, numbering its stops from 0,
+# so that neither starts at 1 without gaps.
+GTFS = {
+    "agency.txt": [
+        "agency_id,agency_name,agency_url,agency_timezone",
+        "T,Test Transit,http://example.com,America/New_York"
+    ],
+    "calendar.txt": [
+        "service_id,monday,tuesday,wednesday,thursday,friday,saturday," +
+        "sunday,start_date,end_date",
+        "ALL,1,1,1,1,1,1,1,20160101,20171231"
+    ],
+    "routes.txt": [
+        "route_id,agency_id,route_short_name,route_long_name,route_type",
+        "X,T,X,X Line,1",
+        "Y,T,Y,Y Line,1"
+    ],
+    "stops.txt": [
+        "stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station",
+        "A,A St,40.70,-74.00,1,",
+        "B,B St,40.71,-74.00,1,",
+        "C,C St,40.72,-74.00,1,",
+        "D,D St,40.73,-74.00,1,",
+        "A1,A St,40.70,-74.00,0,A",
+        "B1,B St,40.71,-74.00,0,B",
+        "C1,C St,40.72,-74.00,0,C",
+        "C2,C St,40.72,-74.00,0,C",
+        "D1,D St,40.73,-74.00,0,D"
+    ],
+    "trips.txt": [
+        "route_id,service_id,trip_id",
+        "X,ALL,X1",
+        "Y,ALL,Y1",
+        "Y,ALL,Y2"
+    ],
+    "stop_times.txt": [
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence",
+        "X1,08:00:00,08:00:00,A1,10",
+        "X1,08:05:00,08:05:00,B1,20",
+        "X1,08:10:00,08:10:00,C1,30",
+        # Leaves C before a transfer from X1 could make it
+        "Y1,08:12:00,08:12:00,C2,0",
+        "Y1,08:20:00,08:20:00,D1,1",
+        "Y2,08:15:00,08:15:00,C2,0",
+        "Y2,08:25:00,08:25:00,D1,1"
+    ]
+}
+
+
+def load_schedule(directory, gtfs):
+    """ Writes the files of a GTFS schedule, given as a map of file name ->
+    lines, to a directory and loads it.
+    """
+    for name, lines in gtfs.iteritems():
+        directory.join(name).write("\n".join(lines) + "\n")
+
+    loader = transitfeed.Loader(str(directory) + "/",
+                                problems=transitfeed.ProblemReporter(
+                                    transitfeed.ExceptionProblemAccumulator(
+                                        raise_warnings=False)))
+    return loader.Load()
+
+
+@pytest.fixture(scope="module")
+def gtfs_loader(tmpdir_factory):
+    """ Function of a GTFS schedule (see load_schedule) -> Schedule, for
+    tests that need a schedule of their own.
+    """
+    return lambda gtfs: load_schedule(tmpdir_factory.mktemp("gtfs"), gtfs)
+
+
+@pytest.fixture(scope="module")
+def schedule(tmpdir_factory):
+    """ Schedule of the two routes of GTFS. """
+    return load_schedule(tmpdir_factory.mktemp("gtfs"), GTFS)
@@ -0,0 +1,41 @@
+from arrivals import ArrivalIndex
+
+
+def get_times(index, station_id, after=0, limit=10):
+    return [(arrival["time"], arrival["trip_id"])
+            for arrival in index.get_arrivals(station_id, after, limit)]
+
+
+def test_arrivals_are_sorted_across_platforms():
+    index = ArrivalIndex()
+    index.update({
+        "T1": ["1", ["101N", "102N"], [300, 400]],
+        "T2": ["1", ["101S"], [200]],
+        "T3": ["2", ["101N", "102N"], [250, 0]]
+    })
+
+    assert get_times(index, "101") == [(200, "T2"), (250, "T3"), (300, "T1")]
+    assert get_times(index, "101", after=250) == [(250, "T3"), (300, "T1")]
+    assert get_times(index, "101", limit=1) == [(200, "T2")]
+    # Missing predictions (arrival time 0) are left out
+    assert get_times(index, "102") == [(400, "T1")]
+    assert get_times(index, "103") == []
+
+
+def test_arrivals_follow_updates():
+    index = ArrivalIndex()
+    index.update({
+        "T1": ["1", ["101N", "102N"], [300, 400]],
+        "T2": ["1", ["101N"], [350]]
+    })
+    # T1 is delayed past T2, and T2 leaves the feed
+    index.update({
+        "T1": ["1", ["101N", "102N"], [380, 460]],
+        "T3": ["1", ["101N"], [360]]
+    })
+
+    assert get_times(index, "101") == [(360, "T3"), (380, "T1")]
+    assert get_times(index, "102") == [(460, "T1")]
+
+    index.update({})
+    assert get_times(index, "101") == []
@@ -0,0 +1,164 @@
+import pytest
+
+from broadcaster import Broadcaster
+
+
+class FakeSocketIO:
+    """ Records the frames emitted to each client. """
+    def __init__(self):
+        self.emits = []
+
+    def emit(self, event, frame, room=None, callback=None):
+        self.emits.append((room, frame, callback))
+
+    def get_frames(self, sid):
+        return [frame for room, frame, _ in self.emits if room == sid]
+
+    def ack(self, sid):
+        """ Acknowledges the last frame emitted to a client. """
+        [callback for room, _, callback in self.emits if room == sid][-1]()
+
+
+@pytest.fixture
+def socketio():
+    return FakeSocketIO()
+
+
+def test_frames_are_coalesced_until_acknowledged(socketio):
+    broadcaster = Broadcaster(socketio, "feed")
+    broadcaster.add_client("a")
+    broadcaster.add_client("b")
+
+    broadcaster.publish("1")
+    broadcaster.publish("2")
+    broadcaster.publish("3")
+    assert socketio.get_frames("a") == ["1"]
+
+    # Only the latest frame is sent once the client acknowledges
+    socketio.ack("a")
+    assert socketio.get_frames("a") == ["1", "3"]
+    assert broadcaster.get_clients()["a"]["frames_dropped"] == 1
+
+    # Clients are independent, and a frame is only acknowledged once
+    assert socketio.get_frames("b") == ["1"]
+    socketio.ack("a")
+    socketio.ack("a")
+    assert socketio.get_frames("a") == ["1", "3"]
+    assert broadcaster.get_clients()["a"]["pending"] is False
+
+
+def test_outstanding_bytes(socketio):
+    broadcaster = Broadcaster(socketio, "feed")
+    broadcaster.add_client("a")
+    broadcaster.add_client("b")
+
+    broadcaster.publish("1234")
+    assert broadcaster.outstanding_bytes == 8
+    socketio.ack("a")
+    assert broadcaster.outstanding_bytes == 4
+    assert broadcaster.get_clients()["a"]["outstanding_bytes"] == 0
+    broadcaster.remove_client("b")
+    assert broadcaster.outstanding_bytes == 0
+
+
+def test_clients_are_parked_on_ack_timeout(socketio):
+    broadcaster = Broadcaster(socketio, "feed", ack_timeout=0)
+    broadcaster.add_client("a")
+
+    broadcaster.publish("1")
+    broadcaster.publish("2")
+    broadcaster.publish("3")
+    # Nothing more is sent to a client that has timed out, however long it
+    # takes to acknowledge
+    assert socketio.get_frames("a") == ["1"]
+    assert broadcaster.get_clients()["a"]["parked"]
+    assert broadcaster.outstanding_bytes == 1
+
+    socketio.ack("a")
+    assert socketio.get_frames("a") == ["1", "3"]
+    assert not broadcaster.get_clients()["a"]["parked"]
+
+
+def test_outstanding_bytes_are_capped(socketio):
+    broadcaster = Broadcaster(socketio, "feed", max_outstanding_bytes=6)
+    broadcaster.add_client("a")
+    broadcaster.add_client("b")
+
+    broadcaster.publish("1234")
+    assert socketio.get_frames("a") == ["1234"]
+    assert socketio.get_frames("b") == []
+    assert broadcaster.get_clients()["b"]["pending"]
+
+    # The frame waiting for b is sent as soon as a makes room for it
+    socketio.ack("a")
+    assert socketio.get_frames("b") == ["1234"]
+    assert not broadcaster.get_clients()["b"]["pending"]
+    assert broadcaster.outstanding_bytes == 4
+
+
+def test_held_frames_are_sent_as_room_is_made(socketio):
+    broadcaster = Broadcaster(socketio, "feed", max_outstanding_bytes=8)
+    for sid in "abcd":
+        broadcaster.add_client(sid)
+
+    broadcaster.publish("1234")
+    sent = [sid for sid in "abcd" if socketio.get_frames(sid)]
+    held = [sid for sid in "abcd" if not socketio.get_frames(sid)]
+    assert len(sent) == len(held) == 2
+
+    # A newer frame replaces the frame waiting for held clients
+    broadcaster.publish("5678")
+    assert broadcaster.get_clients()[held[0]]["frames_dropped"] == 1
+
+    # The acknowledging client is sent the newer frame, which leaves no
+    # room for the held clients until the other client goes away
+    socketio.ack(sent[0])
+    assert socketio.get_frames(sent[0]) == ["1234", "5678"]
+    assert [socketio.get_frames(sid) for sid in held] == [[], []]
+    broadcaster.remove_client(sent[1])
+    assert sorted(len(socketio.get_frames(sid)) for sid in held) == [0, 1]
+    socketio.ack(sent[0])
+    assert [socketio.get_frames(sid) for sid in held] == \
+        [["5678"], ["5678"]]
+    assert broadcaster.outstanding_bytes == 8
+
+
+def test_held_client_added_again(socketio):
+    broadcaster = Broadcaster(socketio, "feed", max_outstanding_bytes=6)
+    broadcaster.add_client("a")
+    broadcaster.add_client("b")
+    broadcaster.publish("1234")
+    sent, held = sorted("ab", key=lambda sid: not socketio.get_frames(sid))
+
+    # The held client reconnects with the same session ID, and is only
+    # sent frames published from then on
+    broadcaster.add_client(held)
+    assert not broadcaster.get_clients()[held]["pending"]
+    socketio.ack(sent)
+    assert socketio.get_frames(held) == []
+    assert broadcaster.outstanding_bytes == 0
+
+    broadcaster.publish("5678")
+    first = sent if len(socketio.get_frames(sent)) == 2 else held
+    socketio.ack(first)
+    assert socketio.get_frames(held) == ["5678"]
+    assert socketio.get_frames(sent) == ["1234", "5678"]
+
+
+def test_client_added_again_ignores_late_acks(socketio):
+    broadcaster = Broadcaster(socketio, "feed")
+    broadcaster.add_client("a")
+    broadcaster.publish("1234")
+    late_ack = socketio.emits[-1][2]
+
+    broadcaster.add_client("a")
+    assert broadcaster.outstanding_bytes == 0
+    broadcaster.publish("5678")
+    assert broadcaster.outstanding_bytes == 4
+
+    # The acknowledgement of the frame sent before reconnecting is not
+    # taken for that of the frame in flight
+    late_ack()
+    assert broadcaster.outstanding_bytes == 4
+    socketio.ack("a")
+    assert broadcaster.outstanding_bytes == 0
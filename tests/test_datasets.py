@@ -0,0 +1,35 @@
+import cPickle as pickle
+
+from datasets import Dataset, STATIONS_FILE, TIMEZONE_FILE
+
+
+def write_static_files(directory, stations, timezone):
+    """ Writes the station IDs and time zone as static.py does. """
+    with open(str(directory.join(STATIONS_FILE)), "wb") as stations_f:
+        pickle.dump(stations, stations_f, pickle.HIGHEST_PROTOCOL)
+    directory.join(TIMEZONE_FILE).write(timezone + "\n")
+
+
+def test_cache_of_static_files_is_cleared(tmpdir):
+    dataset = Dataset("test")
+    dataset.pickle_dir = str(tmpdir) + "/"
+    write_static_files(tmpdir, {"A1": "A"}, "America/New_York")
+
+    assert dataset.get_station_id("A1") == "A"
+    assert dataset.get_station_id("B1") == "B1"
+    assert dataset.get_timezone().zone == "America/New_York"
+
+    write_static_files(tmpdir, {"A1": "A", "B1": "B"}, "Europe/Paris")
+    assert dataset.get_station_id("B1") == "B1"
+
+    dataset.clear_cache()
+    assert dataset.get_station_id("B1") == "B"
+    assert dataset.get_timezone().zone == "Europe/Paris"
+
+
+def test_defaults_without_static_files(tmpdir):
+    dataset = Dataset("test")
+    dataset.pickle_dir = str(tmpdir) + "/"
+
+    assert dataset.get_station_id("A1") == "A1"
+    assert dataset.get_timezone().zone == "America/New_York"
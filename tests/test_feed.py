@@ -0,0 +1,67 @@
+from google.protobuf.message import DecodeError
+import pytest
+
+import feed
+import gtfs_realtime_pb2 as gtfs
+
+
+def make_feed():
+    """ Returns a FeedMessage of two trips, one of which has no vehicle. """
+    feed_message = gtfs.FeedMessage()
+    feed_message.header.gtfs_realtime_version = "1.0"
+    feed_message.header.timestamp = 1478505600
+
+    entity = feed_message.entity.add(id="1")
+    trip = entity.trip_update.trip
+    trip.trip_id, trip.start_date, trip.route_id = \
+        "030048_1..N03R", "20161107", "1"
+    for stop_id, arrival_time in [("101N", 1478505660), ("102N", 0),
+                                  ("103N", 1478505780)]:
+        stop_time_update = entity.trip_update.stop_time_update.add(
+            stop_id=stop_id)
+        if arrival_time:
+            stop_time_update.arrival.time = arrival_time
+
+    entity = feed_message.entity.add(id="2")
+    entity.vehicle.trip.CopyFrom(trip)
+    entity.vehicle.stop_id = "101N"
+    entity.vehicle.current_stop_sequence = 7
+
+    # A trip update with no stop time updates, with a negative time
+    # elsewhere in the feed to exercise two's complement
+    entity = feed_message.entity.add(id="3")
+    entity.trip_update.trip.trip_id = "031000_A..S"
+    entity = feed_message.entity.add(id="4")
+    entity.trip_update.trip.trip_id = "032000_A..S"
+    entity.trip_update.stop_time_update.add(stop_id="A01S").arrival.time = -5
+
+    return feed_message
+
+
+def test_decode_feed_matches_protobuf():
+    feed_message = make_feed()
+    columns, fallback = feed.decode_feed(feed_message.SerializeToString())
+    expected = feed.get_columns(feed_message)
+
+    assert not fallback
+    assert columns.timestamp == expected.timestamp == 1478505600
+    assert columns.get_vehicles() == expected.get_vehicles()
+    assert columns.get_trips() == expected.get_trips()
+    assert columns.get_upcoming_stops() == expected.get_upcoming_stops()
+    assert columns.get_next_arrival_times() == \
+        expected.get_next_arrival_times()
+
+    vehicle, = columns.get_vehicles()
+    assert vehicle.trip.trip_id == "030048_1..N03R"
+    assert vehicle.current_stop_sequence == 7
+    assert columns.get_trips()["030048_1..N03R"] == \
+        ["1", ["101N", "102N", "103N"], [1478505660, 0, 1478505780]]
+    assert columns.get_trips()["032000_A..S"][2] == [-5]
+
+
+def test_decode_feed_of_truncated_feed():
+    raw = make_feed().SerializeToString()
+
+    # The full parser is left to raise the error
+    with pytest.raises(DecodeError):
+        feed.decode_feed(raw[:-3])
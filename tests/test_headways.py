@@ -0,0 +1,58 @@
+from headways import HeadwayTracker
+
+
+def depart(tracker, trip_id, timestamp, stop_id="101N"):
+    entry, = tracker.add_departures([(trip_id, "1", stop_id, timestamp)])
+    return entry
+
+
+def test_headways_of_departures():
+    tracker = HeadwayTracker()
+
+    entry = depart(tracker, "T1", 1000)
+    assert (entry["headway"], entry["samples"], entry["bunched"]) == \
+        (None, 0, False)
+    assert (entry["station"], entry["direction"]) == ("101", "N")
+
+    depart(tracker, "T2", 1300)
+    entry = depart(tracker, "T3", 1900)
+    assert entry["headway"] == 600
+    assert entry["median_headway"] == 600
+    assert entry["mean_headway"] == 450
+    assert entry["last_trip_id"] == "T3"
+
+    # Departures from the other direction are tracked separately
+    assert depart(tracker, "T4", 2000, "101S")["samples"] == 0
+
+
+def test_bunching():
+    tracker = HeadwayTracker()
+    for i in xrange(4):
+        depart(tracker, "T{}".format(i), i * 300)
+
+    # Well under a quarter of the median headway of 300 seconds
+    entry = depart(tracker, "T4", 960)
+    assert entry["headway"] == 60
+    assert entry["bunched"]
+    assert not depart(tracker, "T5", 1260)["bunched"]
+
+
+def test_no_bunching_without_enough_headways():
+    tracker = HeadwayTracker()
+    for i in xrange(3):
+        depart(tracker, "T{}".format(i), i * 300)
+
+    assert not depart(tracker, "T3", 660)["bunched"]
+
+
+def test_headways_are_reported_once_per_tick():
+    tracker = HeadwayTracker(ring_size=2)
+    entries = tracker.add_departures([("T1", "1", "101N", 0),
+                                      ("T2", "1", "101N", 100),
+                                      ("T3", "1", "101N", 300),
+                                      ("T4", "1", "101N", 600)])
+
+    entry, = entries
+    assert entry["last_trip_id"] == "T4"
+    # Only the latest headways are kept
+    assert (entry["samples"], entry["mean_headway"]) == (2, 250)
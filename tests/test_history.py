@@ -0,0 +1,94 @@
+import pytest
+
+from history import HistoryReader, HistoryWriter
+
+# Start of an hourly partition, 7 November 2016 08:00 UTC
+HOUR = 1478505600
+
+
+def make_vehicle(trip_id, route, progress):
+    return {"trip_id": trip_id, "route": route, "prev_stop": "101N",
+            "stop": "102N", "progress": progress, "remaining_time": 30}
+
+
+def make_tick(timestamp):
+    return {"timestamp": timestamp, "vehicles": [
+        make_vehicle("T1", "2", 0.5),
+        make_vehicle("T2", "1", 0.25),
+        make_vehicle("T3", "2", 0.75)
+    ]}
+
+
+@pytest.fixture
+def directory(tmpdir):
+    return str(tmpdir.join("history"))
+
+
+def test_ticks_round_trip(directory):
+    writer = HistoryWriter(directory)
+    assert writer.append(make_tick(HOUR + 10))
+    assert writer.append(make_tick(HOUR + 40))
+    # The next partition
+    assert writer.append(make_tick(HOUR + 3610))
+    writer.close()
+
+    reader = HistoryReader(directory)
+    ticks = list(reader.get_ticks(HOUR, HOUR + 3620))
+    assert [timestamp for timestamp, _ in ticks] == \
+        [HOUR + 10, HOUR + 40, HOUR + 3610]
+    # Rows are stored by route
+    assert [vehicle["trip_id"] for vehicle in ticks[0][1]] == \
+        ["T2", "T1", "T3"]
+    assert ticks[0][1][0] == make_vehicle("T2", "1", 0.25)
+    assert reader.get_range() == (HOUR + 10, HOUR + 3610)
+
+    # The end of the window is exclusive
+    assert [timestamp for timestamp, _
+            in reader.get_ticks(HOUR + 20, HOUR + 3610)] == [HOUR + 40]
+
+
+def test_ticks_of_routes(directory):
+    writer = HistoryWriter(directory)
+    writer.append(make_tick(HOUR + 10))
+    writer.close()
+
+    reader = HistoryReader(directory)
+    (_, vehicles), = reader.get_ticks(HOUR, HOUR + 60, routes=["2"])
+    assert [vehicle["trip_id"] for vehicle in vehicles] == ["T1", "T3"]
+    (_, vehicles), = reader.get_ticks(HOUR, HOUR + 60, routes=["2", "1"])
+    assert len(vehicles) == 3
+    (_, vehicles), = reader.get_ticks(HOUR, HOUR + 60, routes=["7"])
+    assert vehicles == []
+
+
+def test_ticks_not_newer_than_last_are_skipped(directory):
+    writer = HistoryWriter(directory)
+    assert writer.append(make_tick(HOUR + 10))
+    assert not writer.append(make_tick(HOUR + 10))
+    assert not writer.append(make_tick(HOUR + 5))
+    writer.close()
+
+    # A writer reopening a partition continues after its last tick
+    writer = HistoryWriter(directory)
+    assert not writer.append(make_tick(HOUR + 10))
+    assert writer.append(make_tick(HOUR + 20))
+    writer.close()
+
+    reader = HistoryReader(directory)
+    assert [timestamp for timestamp, _
+            in reader.get_ticks(HOUR, HOUR + 60)] == [HOUR + 10, HOUR + 20]
+
+
+def test_incomplete_index_record_is_cut_off(directory):
+    writer = HistoryWriter(directory)
+    writer.append(make_tick(HOUR + 10))
+    writer.close()
+    with open(directory + "/2016110708.idx", "ab") as index_f:
+        index_f.write("\x00" * 5)
+
+    reader = HistoryReader(directory)
+    assert reader.get_range() == (HOUR + 10, HOUR + 10)
+    writer = HistoryWriter(directory)
+    assert writer.append(make_tick(HOUR + 20))
+    writer.close()
+    assert reader.get_range() == (HOUR + 10, HOUR + 20)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from datasets import Dataset, NYCTSubway
+from feed import Trip, Vehicle
+import static
+
+# Three trip paths of route 1 through stop 103N, each with a different
+# previous stop at the same stop sequence: N01R and N03R go on to 104N
+# while N02R goes on to 106N.
+TRIP_PATHS = {
+    "1..N01R": ("030000", ["101N", "102N", "103N", "104N"]),
+    "1..N02R": ("060000", ["107N", "105N", "103N", "106N"]),
+    "1..N03R": ("090000", ["108N", "109N", "103N", "104N"])
+}
+GTFS = {
+    "agency.txt": [
+        "agency_id,agency_name,agency_url,agency_timezone",
+        "MTA,MTA New York City Transit,http://mta.info,America/New_York"
+    ],
+    "calendar.txt": [
+        "service_id,monday,tuesday,wednesday,thursday,friday,saturday," +
+        "sunday,start_date,end_date",
+        "A20161106WKD,1,1,1,1,1,0,0,20161106,20170101"
+    ],
+    "routes.txt": [
+        "route_id,agency_id,route_short_name,route_long_name,route_type",
+        "1,MTA,1,Broadway - 7 Av Local,1"
+    ],
+    "stops.txt": [
+        "stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station"
+    ] + [
+        "{0},{0} St,40.{1},-74.00,0,".format(stop_id, stop_id[:3])
+        for stop_id in sorted(set(
+            stop_id for _, stop_ids in TRIP_PATHS.itervalues()
+            for stop_id in stop_ids))
+    ],
+    "trips.txt": ["route_id,service_id,trip_id"] + [
+        "1,A20161106WKD,A20161106WKD_{}_{}".format(origin_time, trip_path)
+        for trip_path, (origin_time, _) in sorted(TRIP_PATHS.iteritems())
+    ],
+    "stop_times.txt": [
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence"
+    ] + [
+        "A20161106WKD_{0}_{1},0{2}:00:00,0{2}:00:00,{3},{2}".format(
+            origin_time, trip_path, i, stop_id)
+        for trip_path, (origin_time, stop_ids) in TRIP_PATHS.iteritems()
+        for i, stop_id in enumerate(stop_ids, 1)
+    ]
+}
+
+
+def make_vehicle(origin_time, stop_id, stop_sequence):
+    """ Returns a vehicle of a trip of route 1 on Monday 7 November 2016. """
+    trip_id = "{}_1..N01R".format(origin_time)
+    return Vehicle(Trip(trip_id, "20161107", "1"), stop_id, stop_sequence)
+
+
+@pytest.fixture(scope="module")
+def schedule(gtfs_loader):
+    return gtfs_loader(GTFS)
+
+
+@pytest.fixture(scope="module")
+def prev_stops(schedule):
+    return static.PrevStops(schedule, NYCTSubway())
+
+
+def test_unique_prev_stops(prev_stops):
+    assert prev_stops.get_prev_stop(make_vehicle("030000", "102N", 2)) == \
+        "101N"
+    assert prev_stops.get_prev_stop(make_vehicle("030000", "104N", 4)) == \
+        "103N"
+    assert prev_stops.get_prev_stop(make_vehicle("030000", "101N", 1)) is None
+
+
+def test_prev_stop_by_origin_time(prev_stops):
+    for origin_time, prev_stop in [("020000", "102N"), ("031000", "102N"),
+                                   ("055000", "105N"), ("085000", "109N"),
+                                   ("120000", "109N")]:
+        vehicle = make_vehicle(origin_time, "103N", 3)
+        assert prev_stops.get_prev_stop(vehicle) == prev_stop
+
+
+def test_prev_stop_by_upcoming_stops(prev_stops):
+    vehicle = make_vehicle("031000", "103N", 3)
+
+    # Only N02R goes on to 106N, whatever the origin time
+    assert prev_stops.get_prev_stop(vehicle, ["103N", "106N"]) == "105N"
+    # N01R and N03R share the remainder of their trip paths, so the origin
+    # time decides, as it does without upcoming stops
+    assert prev_stops.get_prev_stop(vehicle, ["103N", "104N"]) == "102N"
+    # Upcoming stops that do not start at the stop of the vehicle, or
+    # match no trip path, are ignored
+    assert prev_stops.get_prev_stop(vehicle, ["104N"]) == "102N"
+    assert prev_stops.get_prev_stop(vehicle, ["103N", "110N"]) == "102N"
+    assert prev_stops.get_prev_stop(vehicle, []) == "102N"
+
+
+def test_fingerprint_collisions_fall_back_to_origin_time(schedule,
+                                                         prev_stops,
+                                                         monkeypatch):
+    # Every sequence of stops has the same fingerprint
+    monkeypatch.setattr(static, "FINGERPRINT_MODULUS", 1)
+    colliding_prev_stops = static.PrevStops(schedule, NYCTSubway())
+
+    for origin_time in ["031000", "055000", "085000"]:
+        vehicle = make_vehicle(origin_time, "103N", 3)
+        for upcoming_stops in [None, ["103N", "104N"], ["103N", "106N"]]:
+            assert colliding_prev_stops.get_prev_stop(
+                vehicle, upcoming_stops) == prev_stops.get_prev_stop(vehicle)
+
+
+def test_prev_stops_of_generic_dataset(schedule):
+    prev_stops = static.PrevStops(schedule, Dataset("test"))
+
+    vehicle = make_vehicle("031000", "103N", 3)
+    assert prev_stops.get_prev_stop(vehicle, ["103N", "106N"]) == "105N"
+    # Trip IDs of generic datasets carry no origin time, so there is
+    # nothing to fall back to
+    with pytest.raises(KeyError):
+        prev_stops.get_prev_stop(vehicle, ["103N", "104N"])
+    with pytest.raises(KeyError):
+        prev_stops.get_prev_stop(make_vehicle("031000", "110N", 2),
+                                 ["110N"])
+
+
+def test_fingerprints_of_unicode_stop_ids():
+    assert static.get_fingerprint([u"103N", u"104N"]) == \
+        static.get_fingerprint(["103N", "104N"])
+    assert static.get_fingerprint([u"Saint-Lazare", u"Gare de l’Est"]) != \
+        static.get_fingerprint([u"Saint-Lazare"])
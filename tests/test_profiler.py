@@ -0,0 +1,42 @@
+import time
+
+import profiler
+from profiler import SamplingProfiler
+
+
+def spin(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+def test_samples_are_collapsed_stacks():
+    sampler = SamplingProfiler(0.001)
+    sampler.start()
+    spin(0.1)
+    sampler.stop()
+
+    stacks = sampler.collapsed().splitlines()
+    assert stacks
+    assert any("spin (test_profiler.py:" in stack for stack in stacks)
+    stack, count = stacks[0].rsplit(" ", 1)
+    assert int(count) > 0
+
+
+def test_interval_is_clamped():
+    assert SamplingProfiler(0).interval == profiler.MIN_INTERVAL
+    assert SamplingProfiler(60).interval == profiler.MAX_INTERVAL
+
+
+def test_stop_returns_quickly_with_large_interval(monkeypatch):
+    monkeypatch.setattr(profiler, "MAX_INTERVAL", 60)
+    sampler = SamplingProfiler(60)
+    sampler.start()
+    time.sleep(0.01)
+
+    start = time.time()
+    sampler.stop()
+    assert time.time() - start < 0.05
+    # The sampling thread stops soon after
+    time.sleep(0.05)
+    assert not sampler._thread.is_alive()
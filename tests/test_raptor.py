@@ -0,0 +1,56 @@
+from datetime import datetime
+
+import pytest
+import pytz
+
+from datasets import Dataset
+import raptor
+import static
+
+TIMEZONE = pytz.timezone("America/New_York")
+
+
+def get_time(hour, minute):
+    """ Returns a time on Monday 7 November 2016 in New York, the day after
+    the clocks went back, in seconds since the epoch.
+    """
+    time = TIMEZONE.localize(datetime(2016, 11, 7, hour, minute))
+    return int((time - pytz.utc.localize(datetime(1970, 1, 1)))
+               .total_seconds())
+
+
+@pytest.fixture
+def timetable(schedule, monkeypatch):
+    monkeypatch.setattr(raptor, "get_timezone", lambda: TIMEZONE)
+    return static.Timetable(schedule, Dataset("test"))
+
+
+def test_plan_with_transfer(timetable):
+    journeys = raptor.plan(timetable, "A", "D", get_time(8, 0))
+
+    # Y1 leaves C before the transfer from X1 could make it
+    journey, = journeys
+    assert journey["departure"] == get_time(8, 0)
+    assert journey["arrival"] == get_time(8, 25)
+    assert journey["transfers"] == 1
+    assert [(leg["type"], leg.get("trip_id"), leg["from_stop"],
+             leg["to_stop"]) for leg in journey["legs"]] == [
+        ("trip", "X1", "A1", "C1"),
+        ("transfer", None, "C1", "C2"),
+        ("trip", "Y2", "C2", "D1")
+    ]
+    assert journey["legs"][0]["stops"] == 2
+
+
+def test_plan_without_trips(timetable):
+    # X1 has left A, and nothing runs towards A
+    assert raptor.plan(timetable, "A", "D", get_time(8, 1)) == []
+    assert raptor.plan(timetable, "D", "A", get_time(7, 0)) == []
+    assert raptor.plan(timetable, "A", "A", get_time(7, 0)) == []
+
+
+def test_plan_from_platform_of_transfer(timetable):
+    journey, = raptor.plan(timetable, "C", "D", get_time(8, 11))
+    assert journey["transfers"] == 0
+    assert journey["legs"][0]["trip_id"] == "Y1"
+    assert journey["arrival"] == get_time(8, 20)
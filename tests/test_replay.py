@@ -0,0 +1,82 @@
+import pytest
+
+import replay
+
+
+class FakeClock:
+    """ Stands in for the time module of replay. """
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock(1000.0)
+    monkeypatch.setattr(replay, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def archive(tmpdir):
+    path = str(tmpdir.join("feeds.lsf"))
+    recorder = replay.FeedRecorder(path)
+    recorder.record(1, "first", timestamp=100.0)
+    recorder.record(2, "other", timestamp=105.0)
+    recorder.record(1, "second", timestamp=110.0)
+    recorder.close()
+    return path
+
+
+def test_records_are_read_back(archive):
+    assert list(replay.read_archive(archive)) == [
+        (100.0, 1, "first"), (105.0, 2, "other"), (110.0, 1, "second")]
+    assert [raw for _, _, raw in replay.read_archive(archive, feed_id=2)] \
+        == ["other"]
+
+
+def test_recording_appends_and_ignores_incomplete_record(archive):
+    recorder = replay.FeedRecorder(archive)
+    recorder.record(1, "third", timestamp=120.0)
+    recorder.close()
+    # A record cut short by a recorder killed mid-write
+    with open(archive, "ab") as archive_f:
+        archive_f.write(replay.RECORD_HEADER.pack(130.0, 1, 100) + "x")
+
+    assert [raw for _, _, raw in replay.read_archive(archive)] == \
+        ["first", "other", "second", "third"]
+
+
+def test_replay_follows_virtual_clock(archive, clock):
+    feed_replay = replay.FeedReplay(archive, speed=2.0)
+
+    # The clock starts at the first record; a feed not yet recorded by then
+    # is served its first record
+    assert feed_replay.get_time() == 100.0
+    assert feed_replay(1) == "first"
+    assert feed_replay(2) == "other"
+    clock.now += 2
+    assert feed_replay(1) == "first"
+    assert feed_replay(2) == "other"
+    clock.now += 3
+    assert feed_replay(1) == "second"
+    with pytest.raises(KeyError):
+        feed_replay(3)
+
+
+def test_replay_loops(archive, clock):
+    feed_replay = replay.FeedReplay(archive, loop=True)
+
+    clock.now += 12
+    assert feed_replay.get_time() == 102.0
+    assert feed_replay(1) == "first"
+
+
+def test_replay_of_archive_without_records(tmpdir):
+    path = str(tmpdir.join("empty.lsf"))
+    replay.FeedRecorder(path).close()
+
+    with pytest.raises(ValueError):
+        replay.FeedReplay(path)
@@ -0,0 +1,118 @@
+from datetime import datetime
+
+import pytest
+
+from datasets import Dataset
+import static
+
+# A weekday trip N1 running past midnight, and a Sunday trip S1
+GTFS = {
+    "agency.txt": [
+        "agency_id,agency_name,agency_url,agency_timezone",
+        "T,Test Transit,http://example.com,America/New_York"
+    ],
+    "calendar.txt": [
+        "service_id,monday,tuesday,wednesday,thursday,friday,saturday," +
+        "sunday,start_date,end_date",
+        "WEEKDAY,1,1,1,1,1,0,0,20160101,20171231",
+        "SUNDAY,0,0,0,0,0,0,1,20160101,20171231"
+    ],
+    "routes.txt": [
+        "route_id,agency_id,route_short_name,route_long_name,route_type",
+        "N,T,N,N Line,1",
+        "S,T,S,S Line,1"
+    ],
+    "stops.txt": [
+        "stop_id,stop_name,stop_lat,stop_lon",
+        "A1,A St,40.70,-74.00",
+        "B1,B St,40.71,-74.00",
+        "C1,C St,40.72,-74.00"
+    ],
+    "trips.txt": [
+        "route_id,service_id,trip_id",
+        "N,WEEKDAY,N1",
+        "S,SUNDAY,S1"
+    ],
+    "stop_times.txt": [
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence",
+        "N1,23:50:00,23:50:00,A1,1",
+        "N1,24:05:00,24:06:00,B1,2",
+        "N1,24:20:00,24:20:00,C1,3",
+        "S1,10:00:00,10:00:00,A1,1",
+        "S1,10:10:00,10:10:00,B1,2"
+    ]
+}
+BUCKET_SECONDS = 600
+
+
+def get_seconds(hours, minutes, seconds=0):
+    return hours * 3600 + minutes * 60 + seconds
+
+
+@pytest.fixture(scope="module")
+def index(gtfs_loader):
+    return static.ScheduleIndex(gtfs_loader(GTFS), Dataset("test"),
+                                bucket_seconds=BUCKET_SECONDS)
+
+
+def test_positions_between_stops(index):
+    position, = index.get_positions("WKD", get_seconds(23, 55))
+
+    assert (position.trip_id, position.route) == ("N1", "N")
+    assert (position.prev_stop, position.stop) == ("A1", "B1")
+    # 5 of the 15 minutes from departing A1 to arriving at B1
+    assert position.progress == pytest.approx(1 / 3.0)
+    assert position.remaining_time == 600
+
+
+def test_positions_at_bucket_boundaries(index):
+    # N1 leaves A1 at the start of a bucket
+    assert get_seconds(23, 50) % BUCKET_SECONDS == 0
+    position, = index.get_positions("WKD", get_seconds(23, 50))
+    assert (position.prev_stop, position.progress) == ("A1", 0.0)
+    assert index.get_positions("WKD", get_seconds(23, 50) - 1) == []
+
+    # A1 - B1 spans three buckets, and is found from each of them
+    for seconds in [get_seconds(23, 59, 59), get_seconds(24, 0),
+                    get_seconds(24, 4, 59)]:
+        position, = index.get_positions("WKD", seconds)
+        assert position.stop == "B1"
+
+    # Waiting at B1, the car stays at the end of the path
+    position, = index.get_positions("WKD", get_seconds(24, 5, 30))
+    assert (position.stop, position.progress, position.remaining_time) == \
+        ("B1", 1.0, 0)
+
+    # Leaving B1 ends the interval to B1 and starts the one to C1
+    position, = index.get_positions("WKD", get_seconds(24, 6))
+    assert (position.prev_stop, position.stop, position.progress) == \
+        ("B1", "C1", 0.0)
+    assert index.get_positions("WKD", get_seconds(24, 20)) == []
+
+    # Times outside of the buckets of the service day
+    assert index.get_positions("WKD", get_seconds(30, 0)) == []
+    assert index.get_positions("WKD", -1) == []
+
+
+def test_positions_of_service_codes(index):
+    position, = index.get_positions("SUN", get_seconds(10, 5))
+    assert position.trip_id == "S1"
+    assert index.get_positions("WKD", get_seconds(10, 5)) == []
+    assert index.get_positions("SAT", get_seconds(23, 55)) == []
+
+
+def test_positions_at_include_previous_service_day(index):
+    def get_trips(now):
+        return [(position.trip_id, position.stop)
+                for position in index.get_positions_at(now)]
+
+    # Monday 7 November 2016 is a weekday
+    assert get_trips(datetime(2016, 11, 7, 23, 55)) == [("N1", "B1")]
+    # N1 of Monday is still running early on Tuesday
+    assert get_trips(datetime(2016, 11, 8, 0, 10)) == [("N1", "C1")]
+    # Sunday has no trip running past midnight into Monday
+    assert get_trips(datetime(2016, 11, 7, 0, 10)) == []
+    # N1 of Friday runs into Saturday, which has no trips of its own
+    assert get_trips(datetime(2016, 11, 12, 0, 10)) == [("N1", "C1")]
+    assert get_trips(datetime(2016, 11, 12, 10, 5)) == []
+    assert get_trips(datetime(2016, 11, 13, 10, 5)) == [("S1", "B1")]
@@ -0,0 +1,257 @@
+import cPickle as pickle
+import os
+import types
+
+from array import array
+
+import pytest
+import simplejson as json
+import transitfeed
+
+from datasets import Dataset, TIMEZONE_FILE
+from feed import Trip, Vehicle
+import static
+from static import Edge, NO_STOP, Segment
+
+DATASET = Dataset("test")
+
+# Tracks of a line of stations A - B - C - D, and an isolated station E
+TRACKS = [
+    [[0, 0], [0, 1], [1, 1]],
+    [[1, 1], [2, 1]],
+    [[2, 1], [2, 2], [3, 2]]
+]
+SHAPES = {"tracks": TRACKS}
+
+
+def make_graph(edges):
+    """ Returns a StopGraph of edges, as loaded from graph.pkl. """
+    graph = types.InstanceType(static.StopGraph)
+    graph.__setstate__({"_edges": edges})
+    return graph
+
+
+@pytest.fixture
+def graph():
+    # B - C is stored in the opposite orientation
+    return make_graph({
+        Segment("A", "B"): Edge("S1", [0]),
+        Segment("C", "B"): Edge("S1", [~1]),
+        Segment("C", "D"): Edge("S1", [2])
+    })
+
+
+def test_trip_sequences_number_stops_by_position(schedule):
+    sequences = static.get_trip_sequences(schedule, DATASET)
+
+    stop_ids = [stop_id for stop_id, _ in sequences["stops"]]
+    x1 = sequences["lines"]["X1"]
+    assert x1[0] == NO_STOP
+    assert [stop_ids[i] for i in x1[1:]] == ["A1", "B1", "C1"]
+    assert [stop_ids[i] for i in sequences["lines"]["Y1"][1:]] == \
+        ["C2", "D1"]
+
+
+def test_prev_stops_of_generic_dataset(schedule):
+    prev_stops = static.PrevStops(schedule, DATASET)
+
+    # Stop sequences of the realtime feed are not positions for generic
+    # datasets, which is enough where a stop has one previous stop
+    vehicle = Vehicle(Trip("X1", "20161107", "X"), "C1", 30)
+    assert prev_stops.get_prev_stop(vehicle) == "B1"
+
+    vehicle = Vehicle(Trip("Z1", "20161107", "Z"), "Z1", 1)
+    with pytest.raises(KeyError):
+        prev_stops.get_prev_stop(vehicle)
+
+
+def test_get_path_of_adjacent_stations(graph):
+    assert graph.get_path("A", "B", SHAPES) == TRACKS[0]
+    assert graph.get_path("B", "C", SHAPES) == TRACKS[1]
+    assert graph.get_path("B", "A", SHAPES) == TRACKS[0][::-1]
+
+
+def test_get_path_across_stations(graph):
+    # A train that skipped B and C is rendered along every track between
+    assert graph.get_path("A", "D", SHAPES) == \
+        [[0, 0], [0, 1], [1, 1], [2, 1], [2, 2], [3, 2]]
+    assert graph.get_path("D", "B", SHAPES) == \
+        [[3, 2], [2, 2], [2, 1], [1, 1]]
+
+
+def test_get_path_without_path(graph):
+    for _ in xrange(2):
+        with pytest.raises(KeyError):
+            graph.get_path("A", "E", SHAPES)
+    assert graph.has_cached_path("A", "E")
+
+
+def test_get_path_cache_is_bounded(graph, monkeypatch):
+    monkeypatch.setattr(static, "MAX_CACHED_PATHS", 2)
+
+    graph.get_path("A", "B", SHAPES)
+    graph.get_path("A", "C", SHAPES)
+    graph.get_path("A", "B", SHAPES)
+    graph.get_path("A", "D", SHAPES)
+
+    # A - C was the least recently requested
+    assert graph.has_cached_path("A", "B")
+    assert not graph.has_cached_path("A", "C")
+    assert graph.has_cached_path("A", "D")
+
+
+def make_shape(shape_id, points):
+    """ Returns a transitfeed.Shape of (lat, lon) points. """
+    shape = transitfeed.Shape(shape_id)
+    for lat, lon in points:
+        shape.AddPoint(lat, lon)
+    return shape
+
+
+def test_track_network_shares_only_identical_tracks():
+    schedule = transitfeed.Schedule()
+    for stop_id, lat in [("A", 40.70), ("B", 40.71)]:
+        stop = transitfeed.Stop(lat, -74.00, stop_id, stop_id)
+        stop.location_type = 1
+        schedule.AddStopObject(stop)
+
+    # S2 runs along S1 in reverse, while S3 takes another route between the
+    # same stations
+    for shape in [
+        make_shape("S1", [(40.70, -74.00), (40.705, -74.00), (40.71, -74.00)]),
+        make_shape("S2", [(40.71, -74.00), (40.705, -74.00), (40.70, -74.00)]),
+        make_shape("S3", [(40.70, -74.00), (40.705, -74.01), (40.71, -74.00)])
+    ]:
+        schedule.AddShapeObject(shape)
+
+    network = static.TrackNetwork(schedule, DATASET)
+
+    assert len(network.tracks) == 2
+    assert network.shape_tracks["S1"] == [0]
+    assert network.shape_tracks["S2"] == [~0]
+    assert network.shape_tracks["S3"] == [1]
+    assert network.tracks[1][1] == [-74.01, 40.705]
+
+
+def test_arrays_are_pickled_as_machine_values():
+    values = array("i", [0, -1, 1 << 30])
+    pickled = pickle.dumps({"values": values}, pickle.HIGHEST_PROTOCOL)
+
+    assert "load_array" in pickled
+    assert pickle.loads(pickled) == {"values": values}
+
+
+def test_open_atomic_replaces_file_once_written(tmpdir):
+    path = str(tmpdir.join("stops.json"))
+    tmpdir.join("stops.json").write("old")
+
+    with static.open_atomic(path) as stops_f:
+        stops_f.write("new")
+        # Readers see the old file until the new one is complete
+        assert open(path).read() == "old"
+
+    assert open(path).read() == "new"
+    assert os.listdir(str(tmpdir)) == ["stops.json"]
+
+
+def test_open_atomic_keeps_file_if_writing_fails(tmpdir):
+    path = str(tmpdir.join("stops.json"))
+    tmpdir.join("stops.json").write("old")
+
+    with pytest.raises(ValueError):
+        with static.open_atomic(path) as stops_f:
+            stops_f.write("partial")
+            raise ValueError()
+
+    assert open(path).read() == "old"
+    assert os.listdir(str(tmpdir)) == ["stops.json"]
+
+
+def test_json_is_written_one_item_at_a_time(tmpdir):
+    path = str(tmpdir.join("shapes.json"))
+    with open(path, "w") as shapes_f:
+        shapes_f.write('{"tracks": ')
+        static.write_json_array(shapes_f, iter([[[0, 1]], []]))
+        shapes_f.write(', "shapes": ')
+        static.write_json_object(shapes_f, iter([("S1", {"tracks": [~0]}),
+                                                 ("S2", {})]))
+        shapes_f.write(', "empty": ')
+        static.write_json_object(shapes_f, iter([]))
+        shapes_f.write("}")
+
+    assert json.load(open(path)) == {
+        "tracks": [[[0, 1]], []],
+        "shapes": {"S1": {"tracks": [-1]}, "S2": {}},
+        "empty": {}
+    }
+
+
+def test_version_is_written_after_time_zone(schedule, tmpdir):
+    dataset = Dataset("test")
+    dataset.pickle_dir = str(tmpdir) + "/"
+
+    version = static.write_version(schedule, dataset)
+    assert tmpdir.join(static.VERSION_FILE).read() == version
+    assert tmpdir.join(TIMEZONE_FILE).read() == "America/New_York"
+    assert dataset.get_timezone().zone == "America/New_York"
+
+    # Versions of later builds sort after earlier ones
+    assert static.write_version(schedule, dataset) >= version
+    assert sorted(os.listdir(str(tmpdir))) == \
+        sorted([static.VERSION_FILE, TIMEZONE_FILE])
+
+
+@pytest.fixture
+def stop_search():
+    names = {
+        "101": "W 4 St - Washington Sq",
+        "102": "14 St - Union Sq",
+        "103": "Washington Av",
+        "104": "145 St",
+        "105": "Times Sq - 42 St",
+        "106": "Wall St",
+        "107": "42 St - Port Authority"
+    }
+    return static.StopSearch({stop_id: {"name": name, "coordinates": [0, 0]}
+                              for stop_id, name in names.iteritems()})
+
+
+def search_ids(stop_search, query, limit=10):
+    return [stop["stop_id"] for stop in stop_search.search(query, limit)]
+
+
+def test_stop_names_are_normalized(stop_search):
+    assert static.normalize_words("West 4th Street - Washington Square") == \
+        ["w", "4", "st", "washington", "sq"]
+    assert search_ids(stop_search, "West 4th Street") == ["101"]
+    assert search_ids(stop_search, "TIMES SQUARE") == ["105"]
+
+
+def test_last_word_of_search_is_a_prefix(stop_search):
+    assert sorted(search_ids(stop_search, "14")) == ["102", "104"]
+    # Unless followed by a space
+    assert search_ids(stop_search, "14 ") == ["102"]
+    # Prefixes of any spelling of a word match
+    assert sorted(search_ids(stop_search, "union squ")) == ["102"]
+    # Other words must be whole
+    assert search_ids(stop_search, "14 st") == ["102"]
+
+
+def test_search_with_typo_matches_trigrams(stop_search):
+    assert search_ids(stop_search, "Unoin Sq") == ["102"]
+    assert search_ids(stop_search, "Xyzzy") == []
+    assert search_ids(stop_search, " - ") == []
+
+
+def test_search_results_are_ranked(stop_search):
+    # Names starting with the search first
+    assert search_ids(stop_search, "42 st") == ["107", "105"]
+    assert search_ids(stop_search, "wa") == ["103", "106", "101"]
+    # Then shorter names, then stop IDs
+    assert search_ids(stop_search, "sq") == ["102", "105", "101"]
+
+
+def test_search_results_are_limited(stop_search):
+    assert search_ids(stop_search, "sq", 2) == ["102", "105"]
+    assert len(search_ids(stop_search, "st", 3)) == 3
+    assert search_ids(stop_search, "sq", 0) == []
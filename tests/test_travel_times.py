@@ -0,0 +1,82 @@
+import pytest
+
+import travel_times
+from travel_times import TravelTimeModel
+
+# 7 November 2016 08:00 in New York
+START = 1478523600
+
+
+def make_vehicle(trip_id, prev_stop, stop, remaining_time):
+    return {"trip_id": trip_id, "route": "1", "prev_stop": prev_stop,
+            "stop": stop, "progress": 0.0, "remaining_time": remaining_time}
+
+
+def make_tick(seconds, vehicles):
+    return {"timestamp": START + seconds,
+            "vehicles": [make_vehicle(*vehicle) for vehicle in vehicles]}
+
+
+@pytest.fixture
+def model():
+    """ Model that has seen T1 head to 102 and then to 103, and T2 head to
+    102.
+    """
+    model = TravelTimeModel()
+    model.update(make_tick(0, [("T1", "101N", "102N", 60)]))
+    model.update(make_tick(90, [("T1", "102N", "103N", 100),
+                                ("T2", "101N", "102N", 50)]))
+    return model
+
+
+def test_travel_times_are_learned(model):
+    # T1 was already heading to 102 when first seen, so it only starts
+    # timing the edge to 103 once it leaves 102
+    assert model.get_travel_time("102", "103", None) is None
+
+    tick = make_tick(210, [("T1", "103N", "104N", 45),
+                           ("T2", "102N", "103N", 200)])
+    departures = model.update(tick)
+
+    assert sorted(departures) == [("T1", "1", "103N", START + 210),
+                                  ("T2", "1", "102N", START + 210)]
+    bucket = model.get_bucket(START + 90)
+    assert model.get_travel_time("102", "103", bucket) == 120
+    # The learned time is used at other times of day too
+    assert model.get_travel_time("102", "103", bucket + 1) == 120
+    # T2 has just left 102, so it has the whole travel time ahead of it,
+    # while nothing has been learned of the edge of T1
+    t1, t2 = tick["vehicles"]
+    assert (t1["progress"], t1["remaining_time"]) == (0.0, 45)
+    assert (t2["progress"], t2["remaining_time"]) == (0.0, 120)
+
+
+def test_remaining_times_are_estimated(model):
+    model.update(make_tick(210, [("T1", "103N", "104N", 45),
+                                 ("T2", "102N", "103N", 200)]))
+    tick = make_tick(270, [("T2", "102N", "103N", 200),
+                           ("T3", "102N", "103N", 30)])
+    model.update(tick)
+
+    t2, t3 = tick["vehicles"]
+    # From the time since T2 left 102
+    assert (t2["progress"], t2["remaining_time"]) == (0.5, 60)
+    # T3 was first seen on the way, so its progress is estimated from its
+    # predicted arrival
+    assert (t3["progress"], t3["remaining_time"]) == (0.75, 30)
+
+
+def test_model_round_trip(model, tmpdir):
+    model.update(make_tick(210, [("T1", "103N", "104N", 45)]))
+    path = str(tmpdir.join(travel_times.TRAVEL_TIMES_FILE))
+    model.save(path)
+
+    loaded = travel_times.load_model(path)
+    assert loaded.get_travel_time("102", "103", None) == 120
+    assert loaded.get_travel_time("102", "103",
+                                  model.get_bucket(START + 90)) == 120
+    # Trips in progress are not saved
+    assert loaded.update(make_tick(300, [("T1", "104N", "105N", 45)])) == []
+
+    assert travel_times.load_model(str(tmpdir.join("missing.pkl"))) \
+        .get_travel_time("102", "103", None) is None
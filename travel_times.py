@@ -0,0 +1,240 @@
+import cPickle as pickle
+
+from array import array
+from datetime import datetime
+
+from feed import get_station_id, get_timezone
+import metrics
+from static import open_atomic
+
+# Saved to the pickle directory of the dataset (see app.py)
+TRAVEL_TIMES_FILE = "travel_times.pkl"
+# Travel times are learned separately for each bucket of the time of day
+# (in the time zone of the schedule, as for scheduled positions)
+BUCKET_SECONDS = 3600
+# Number of most recent travel times of which the median is used
+RING_SIZE = 16
+# Travel times longer than this are assumed to be delays or gaps in the
+# feed rather than travel between stops, and are not learned
+MAX_TRAVEL_SECONDS = 1800
+# Number of ticks between saves of the model
+SAVE_INTERVAL = 20
+
+SAMPLES = metrics.Counter(
+    "livesubway_travel_time_samples_total",
+    "Travel times between stops observed in the feed"
+)
+ESTIMATES = metrics.Counter(
+    "livesubway_travel_time_estimates_total",
+    "Remaining times of subway cars, by source of estimate",
+    ["source"]
+)
+
+
+class TravelTimeModel:
+    """ TravelTimeModel class.
+
+    Used primarily to estimate where each subway car is between its
+    previous and next stop, and how long until it reaches the next stop.
+    The feed only says which stop a train is headed to; travel times are
+    learned from consecutive feeds, as the time between a train heading to
+    a stop and heading to the following stop.
+
+    The model keeps the most recent travel times of each directed edge
+    between stations and bucket of the time of day in a ring buffer, along
+    with their median, which is updated whenever a travel time is added.
+    Estimating the position of a subway car is then a lookup of the median
+    of its edge, so that it costs the same whatever the number of travel
+    times learned.
+    """
+    def __init__(self, bucket_seconds=BUCKET_SECONDS, ring_size=RING_SIZE):
+        """ Constructor.
+
+        Arguments
+        ---------
+        bucket_seconds: int
+            Seconds of time of day per bucket
+        ring_size: int
+            Number of travel times kept per edge and bucket
+        """
+        self.bucket_seconds = bucket_seconds
+        self.ring_size = ring_size
+        # Map of (prev station ID, station ID, bucket) -> (array of travel
+        # times, index of next travel time to replace); bucket None holds
+        # the travel times of the edge at all times of day.
+        self._rings = {}
+        self._medians = {}
+        # Map of trip ID -> (prev station ID, station ID, time the trip was
+        # first seen heading to the station, or None if it was already
+        # heading there when first seen, stop ID of platform)
+        self._trips = {}
+        self._ticks = 0
+
+    def __getstate__(self):
+        # Trips in progress are not persisted, as their state is stale by
+        # the time the model is loaded.
+        return {"bucket_seconds": self.bucket_seconds,
+                "ring_size": self.ring_size, "rings": self._rings}
+
+    def __setstate__(self, state):
+        self.__init__(state["bucket_seconds"], state["ring_size"])
+        self._rings = state["rings"]
+        for key, (ring, _) in self._rings.iteritems():
+            self._medians[key] = sorted(ring)[len(ring) // 2]
+
+    def get_bucket(self, timestamp):
+        """ Returns the bucket of the time of day of a timestamp. """
+        local_time = datetime.fromtimestamp(timestamp, get_timezone())
+        return (local_time.hour * 3600 + local_time.minute * 60 +
+                local_time.second) // self.bucket_seconds
+
+    def add_travel_time(self, prev_station, station, bucket, seconds):
+        """ Adds a travel time of an edge to the model.
+
+        Arguments
+        ---------
+        prev_station: str
+            Station ID of start of edge
+        station: str
+            Station ID of end of edge
+        bucket: int
+            Bucket of time of day of travel (see get_bucket)
+        seconds: float
+            Travel time
+        """
+        SAMPLES.inc()
+        for key in [(prev_station, station, bucket),
+                    (prev_station, station, None)]:
+            ring, index = self._rings.get(key, (None, 0))
+            if ring is None:
+                ring = array("f")
+            if len(ring) < self.ring_size:
+                ring.append(seconds)
+            else:
+                ring[index] = seconds
+            self._rings[key] = (ring, (index + 1) % self.ring_size)
+            self._medians[key] = sorted(ring)[len(ring) // 2]
+
+    def get_travel_time(self, prev_station, station, bucket):
+        """ Returns the median travel time of an edge at a time of day, or
+        at any time of day if none have been learned for the bucket, or
+        None if none have been learned for the edge.
+        """
+        travel_time = self._medians.get((prev_station, station, bucket))
+        if travel_time is None:
+            travel_time = self._medians.get((prev_station, station, None))
+
+        return travel_time
+
+    def update(self, tick):
+        """ Learns the travel times of the subway cars of a tick, and sets
+        their progress and remaining time.
+
+        The remaining time of a subway car is its edge's median travel time
+        less the time since it was first seen heading to its next stop. If
+        it was already heading there when first seen, its remaining time
+        is the predicted time to arrival, from which its progress is
+        estimated; if the travel time of its edge is unknown, its progress
+        and remaining time are left as they are.
+
+        Arguments
+        ---------
+        tick: dict
+            Tick of subway cars (see app.process_feed)
+
+        Returns
+        -------
+        list[tuple[str, str, str, int]]
+            List of (trip ID, route ID, stop ID of platform, time of tick)
+            of each subway car that left the stop it was heading to in the
+            previous tick for the next stop along its path
+        """
+        timestamp = tick["timestamp"]
+        bucket = self.get_bucket(timestamp)
+        trips = {}
+        departures = []
+        sources = {"feed": 0, "model": 0, "prediction": 0}
+
+        for vehicle in tick["vehicles"]:
+            prev_station = get_station_id(vehicle["prev_stop"])
+            station = get_station_id(vehicle["stop"])
+            trip = self._trips.get(vehicle["trip_id"])
+
+            if trip is None:
+                start = None
+            elif trip[1] == station:
+                start = trip[2] if trip[2] <= timestamp else None
+            else:
+                start = timestamp
+                if trip[1] == prev_station:
+                    departures.append((vehicle["trip_id"], vehicle["route"],
+                                       trip[3], timestamp))
+                # A travel time is only learned if the trip was seen
+                # heading to both ends of the edge
+                if trip[2] is not None and trip[1] == prev_station and \
+                        0 < timestamp - trip[2] <= MAX_TRAVEL_SECONDS:
+                    self.add_travel_time(trip[0], trip[1],
+                                         self.get_bucket(trip[2]),
+                                         timestamp - trip[2])
+            trips[vehicle["trip_id"]] = (prev_station, station, start,
+                                         vehicle["stop"])
+
+            travel_time = self.get_travel_time(prev_station, station, bucket)
+            if travel_time is None:
+                sources["feed"] += 1
+                continue
+
+            if start is not None:
+                sources["model"] += 1
+                elapsed = timestamp - start
+                vehicle["remaining_time"] = max(travel_time - elapsed, 0)
+            else:
+                sources["prediction"] += 1
+                elapsed = travel_time - vehicle["remaining_time"]
+            vehicle["progress"] = min(max(elapsed / travel_time, 0.0), 1.0)
+
+        # Trips no longer in the feed are forgotten
+        self._trips = trips
+        self._ticks += 1
+        for source, count in sources.iteritems():
+            ESTIMATES.labels(source).inc(count)
+
+        return departures
+
+    def should_save(self):
+        """ Returns whether the model has been updated SAVE_INTERVAL times
+        since it was last saved.
+        """
+        return self._ticks >= SAVE_INTERVAL
+
+    def save(self, path):
+        """ Saves the model to a file, replacing it atomically.
+
+        Arguments
+        ---------
+        path: str
+            Path of file
+        """
+        with open_atomic(path, "wb") as model_f:
+            pickle.dump(self, model_f, pickle.HIGHEST_PROTOCOL)
+        self._ticks = 0
+
+
+def load_model(path):
+    """ Returns the model saved to a file, or a new model if there is none.
+
+    Arguments
+    ---------
+    path: str
+        Path of file
+
+    Returns
+    -------
+    TravelTimeModel
+        Model
+    """
+    try:
+        with open(path, "rb") as model_f:
+            return pickle.load(model_f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return TravelTimeModel()
@@ -0,0 +1,113 @@
+import cPickle as pickle
+import os
+import socket
+import traceback
+
+from eventlet import hubs
+from eventlet.queue import LightQueue
+
+from bus import recv_frame, send_frame
+
+
+class WorkerError(Exception):
+    """ Raised when a task fails or its worker process exits. """
+    pass
+
+
+class WorkerPool:
+    """ WorkerPool class.
+
+    Used primarily to run CPU-bound work, such as parsing and processing
+    feeds, outside of the eventlet hub, so that it doesn't stall every
+    socket and request while it runs. Each worker is a forked process
+    connected to the hub by a socket pair; waiting for a result is green,
+    so the hub keeps serving clients in the meantime.
+
+    Tasks are module-level functions and arguments that can be pickled, as
+    are their results. Workers are forked, so they start out with a copy of
+    everything already loaded in the parent process (e.g. the static data).
+    """
+    def __init__(self, size):
+        """ Constructor.
+
+        Arguments
+        ---------
+        size: int
+            Number of worker processes
+        """
+        self._idle = LightQueue()
+        for _ in xrange(size):
+            self._idle.put(WorkerPool._spawn())
+
+    @staticmethod
+    def _spawn():
+        """ Forks a worker process, and returns its process ID and socket. """
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+
+        if pid == 0:
+            parent_sock.close()
+            # The forked hub still holds the parent's green threads and
+            # sockets, so the worker starts over with a fresh hub.
+            hubs.use_hub()
+            try:
+                WorkerPool._work(child_sock)
+            finally:
+                os._exit(0)
+
+        child_sock.close()
+        return pid, parent_sock
+
+    @staticmethod
+    def _work(sock):
+        """ Runs tasks received over a socket until it is closed. """
+        while True:
+            frame = recv_frame(sock)
+            if frame is None:
+                return
+
+            function, args = pickle.loads(frame)
+            try:
+                result = (True, function(*args))
+            except Exception:
+                result = (False, traceback.format_exc())
+
+            send_frame(sock, pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+
+    def execute(self, function, *args):
+        """ Runs a function in a worker process and returns its result.
+
+        Arguments
+        ---------
+        function: function
+            Module-level function
+        args: list
+            Arguments of function
+
+        Returns
+        -------
+        object
+            Result of function
+        """
+        worker = self._idle.get()
+        pid, sock = worker
+
+        try:
+            send_frame(sock, pickle.dumps((function, args),
+                                          pickle.HIGHEST_PROTOCOL))
+            frame = recv_frame(sock)
+        except socket.error:
+            frame = None
+
+        if frame is None:
+            sock.close()
+            os.waitpid(pid, 0)
+            self._idle.put(WorkerPool._spawn())
+            raise WorkerError("Worker {} exited".format(pid))
+
+        self._idle.put(worker)
+        success, result = pickle.loads(frame)
+        if not success:
+            raise WorkerError(result)
+
+        return result